@@ -0,0 +1,158 @@
+"""Compare benchmark results against a stored baseline, and exit with a non-zero code if any operation has become slower, or used more memory, than the threshold allows, or is missing from the current results.
+
+Usage: python benchmarks/compare.py baseline.json [current.json] --threshold 0.1
+If the current results aren't given, the suite is run again with the same shapes, sizes and seed as the baseline.
+"""
+import os
+import sys
+import json
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import run
+
+RESAMPLES = 2000
+
+def median(samples):
+    ordered = sorted(samples)
+    middle = len(ordered) // 2
+    if len(ordered) % 2 == 1:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2
+
+def ratio_interval(baseline, current, confidence, rng):
+    """Return a bootstrap confidence interval for the ratio of the median of the current samples to the median of the baseline samples."""
+    ratios = []
+    for resample in range(0, RESAMPLES):
+        baseline_median = median([rng.choice(baseline) for sample in baseline])
+        current_median = median([rng.choice(current) for sample in current])
+        ratios.append(current_median / baseline_median if baseline_median > 0 else float('inf'))
+    ratios.sort()
+    tail = (1 - confidence) / 2
+    return (ratios[int(tail * (RESAMPLES - 1))], ratios[int((1 - tail) * (RESAMPLES - 1))])
+
+def compare(baseline, current, threshold, confidence, seed = 1):
+    """Compare each metric of each case that is in both sets of results, returning a row for each. A metric has regressed when the whole confidence interval of it's ratio to the baseline is above 1 + the threshold, and improved when it is all below 1 - the threshold."""
+    rng = random.Random(seed) # so that the same results are always reported the same way
+    baseline_cases = { (case['shape'], case['size_mb']): case for case in baseline['cases'] }
+    rows = []
+    for case in current['cases']:
+        key = (case['shape'], case['size_mb'])
+        if key not in baseline_cases:
+            continue
+        baseline_case = baseline_cases[key]
+        for metric, samples in case['metrics'].items():
+            if metric not in baseline_case['metrics']:
+                continue
+            baseline_samples = baseline_case['metrics'][metric]
+            low, high = ratio_interval(baseline_samples, samples, confidence, rng)
+            if low > 1 + threshold:
+                status = 'regressed'
+            elif high < 1 - threshold:
+                status = 'improved'
+            else:
+                status = 'unchanged'
+            rows.append({
+                'shape': case['shape'], 'size_mb': case['size_mb'], 'metric': metric,
+                'baseline': median(baseline_samples), 'current': median(samples), 'low': low, 'high': high, 'status': status
+            })
+        if case['peak_memory_mb'] is not None and baseline_case['peak_memory_mb'] is not None: # a single measurement, so there is no interval
+            ratio = case['peak_memory_mb'] / baseline_case['peak_memory_mb']
+            status = 'regressed' if ratio > 1 + threshold else 'improved' if ratio < 1 - threshold else 'unchanged'
+            rows.append({
+                'shape': case['shape'], 'size_mb': case['size_mb'], 'metric': 'peak_memory_mb',
+                'baseline': baseline_case['peak_memory_mb'], 'current': case['peak_memory_mb'], 'low': ratio, 'high': ratio, 'status': status
+            })
+    return rows
+
+def missing_from(baseline, current):
+    """Return a description of each case, and each metric of the cases that are in both, that is in the baseline but not in the current results, so that an operation which stopped being measured isn't mistaken for one that didn't regress."""
+    current_cases = { (case['shape'], case['size_mb']): case for case in current['cases'] }
+    missing = []
+    for case in baseline['cases']:
+        description = case['shape'] + ' ' + str(case['size_mb']) + ' MB'
+        current_case = current_cases.get((case['shape'], case['size_mb']), None)
+        if current_case is None:
+            missing.append(description)
+            continue
+        missing += [description + ' ' + metric for metric in case['metrics'] if metric not in current_case['metrics']]
+        if case['peak_memory_mb'] is not None and current_case['peak_memory_mb'] is None:
+            missing.append(description + ' peak_memory_mb')
+    return missing
+
+def format_rows(rows):
+    lines = []
+    for row in rows:
+        unit = ' MB' if row['metric'] == 'peak_memory_mb' else ' ms'
+        scale = 1 if row['metric'] == 'peak_memory_mb' else 1000
+        lines.append('{:<10} {:>8} {:<20} {:>12.4f}{} -> {:>12.4f}{}  x{:.2f} [{:.2f}, {:.2f}]  {}'.format(
+            row['shape'], str(row['size_mb']) + ' MB', row['metric'],
+            row['baseline'] * scale, unit, row['current'] * scale, unit,
+            row['current'] / row['baseline'] if row['baseline'] > 0 else float('inf'), row['low'], row['high'], row['status']
+        ))
+    return '\n'.join(lines)
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('baseline', help='the results to compare against, as written by run.py')
+    parser.add_argument('current', nargs='?', help='the results to compare, instead of running the suite again')
+    parser.add_argument('--threshold', type=float, default=0.1, help='the fraction by which a metric may become slower before it is reported as a regression')
+    parser.add_argument('--confidence', type=float, default=0.95, help='the confidence level of the intervals')
+    parser.add_argument('--repeat', type=int, help='the number of times each operation is timed when the suite is run again, which defaults to the number in the baseline. It must be at least ' + str(run.MIN_REPEAT) + ', to give meaningful intervals')
+    parser.add_argument('--output', help='the file to write the new results to, when the suite is run again, so that they can be used as the next baseline')
+    args = parser.parse_args(args)
+    if args.repeat is not None and args.repeat < run.MIN_REPEAT:
+        parser.error('--repeat must be at least ' + str(run.MIN_REPEAT))
+
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    if baseline['repeat'] < run.MIN_REPEAT:
+        print('error: the baseline has ' + str(baseline['repeat']) + ' samples of each operation, but at least ' + str(run.MIN_REPEAT) + ' are needed for meaningful intervals, so it must be run again with a higher --repeat', file=sys.stderr)
+        return 2
+    if args.current is not None:
+        with open(args.current, 'r') as f:
+            current = json.load(f)
+    else:
+        shapes = []
+        sizes = []
+        for case in baseline['cases']:
+            if case['shape'] not in shapes:
+                shapes.append(case['shape'])
+            if case['size_mb'] not in sizes:
+                sizes.append(case['size_mb'])
+        repeat = args.repeat or baseline['repeat']
+        current = {
+            'environment': run.environment(),
+            'seed': baseline['seed'],
+            'repeat': repeat,
+            'cases': run.run_suite(shapes, sizes, baseline['seed'], repeat, progress=lambda message: print(message, file=sys.stderr)),
+        }
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(current, f, indent=1)
+    if current['repeat'] < run.MIN_REPEAT:
+        print('error: the current results have ' + str(current['repeat']) + ' samples of each operation, but at least ' + str(run.MIN_REPEAT) + ' are needed for meaningful intervals', file=sys.stderr)
+        return 2
+
+    if baseline['seed'] != current['seed']:
+        print('warning: the results were generated from different seeds, so the documents differ', file=sys.stderr)
+    for name in ('python', 'lxml', 'libxml2', 'platform'):
+        if baseline['environment'].get(name) != current['environment'].get(name):
+            print('warning: the ' + name + ' version differs: ' + str(baseline['environment'].get(name)) + ' -> ' + str(current['environment'].get(name)), file=sys.stderr)
+
+    rows = compare(baseline, current, args.threshold, args.confidence)
+    print(format_rows(rows))
+    failed = False
+    missing = missing_from(baseline, current)
+    if len(missing) > 0:
+        print(str(len(missing)) + ' cases or metrics in the baseline are missing from the current results: ' + ', '.join(missing), file=sys.stderr)
+        failed = True
+    regressions = [row for row in rows if row['status'] == 'regressed']
+    if len(regressions) > 0:
+        print(str(len(regressions)) + ' of ' + str(len(rows)) + ' metrics regressed by more than ' + str(round(args.threshold * 100)) + '%', file=sys.stderr)
+        failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,111 @@
+import random
+
+# Each generator yields chunks of a well formed XML document of roughly the requested number of characters. The body of each document is produced in complete units, so that it can be closed after any of them. The same seed always produces the same document, so that runs can be compared.
+
+CHUNK_SIZE = 64 * 1024
+WORDS = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliet', 'kilo', 'lima', 'mike', 'november', 'oscar', 'papa', 'quebec', 'romeo', 'sierra', 'tango']
+NAMES = ['item', 'record', 'entry', 'value', 'group', 'node', 'field', 'row']
+
+def words(rng, count):
+    return ' '.join(rng.choice(WORDS) for index in range(0, count))
+
+def buffered(parts, size):
+    """Join the parts into chunks of about CHUNK_SIZE characters, stopping once at least the given number of characters have been produced, and then yield the closing text."""
+    chunk = []
+    chunk_length = 0
+    produced = 0
+    body, closing = parts
+    for part in body:
+        chunk.append(part)
+        chunk_length += len(part)
+        if chunk_length >= CHUNK_SIZE:
+            yield ''.join(chunk)
+            produced += chunk_length
+            chunk = []
+            chunk_length = 0
+            if produced >= size:
+                break
+    chunk.append(closing())
+    yield ''.join(chunk)
+
+def deep(size, seed):
+    """Chains of nested elements, hundreds of levels deep."""
+    rng = random.Random(seed)
+    def body():
+        yield '<root>'
+        while True:
+            depth = rng.randint(50, 500)
+            names = [rng.choice(NAMES) for level in range(0, depth)]
+            yield ''.join('<' + name + ' level="' + str(level) + '">' for level, name in enumerate(names)) + words(rng, 3) + ''.join('</' + name + '>' for name in reversed(names))
+    return buffered((body(), lambda: '</root>'), size)
+
+def wide(size, seed):
+    """A root element with a very large number of small children."""
+    rng = random.Random(seed)
+    def body():
+        yield '<root>'
+        index = 0
+        while True:
+            index += 1
+            name = rng.choice(NAMES)
+            yield '<' + name + ' id="' + str(index) + '">' + rng.choice(WORDS) + '</' + name + '>\n'
+    return buffered((body(), lambda: '</root>'), size)
+
+def namespaces(size, seed):
+    """Elements and attributes from many namespaces, with prefixes that are redeclared and default namespaces that change."""
+    rng = random.Random(seed)
+    uris = ['urn:benchmark:ns' + str(index) for index in range(0, 40)]
+    def body():
+        yield '<root xmlns="' + uris[0] + '" ' + ' '.join('xmlns:p' + str(index) + '="' + uri + '"' for index, uri in enumerate(uris)) + '>'
+        while True:
+            group = ['<group xmlns="' + rng.choice(uris) + '">']
+            for index in range(0, rng.randint(5, 20)):
+                prefix = 'p' + str(rng.randrange(0, len(uris)))
+                name = rng.choice(NAMES)
+                attribute_prefix = 'p' + str(rng.randrange(0, len(uris)))
+                if rng.random() < 0.2: # declare a prefix that is used for different namespaces in different places
+                    prefix = 'q' + str(rng.randrange(0, 5))
+                    group.append('<' + prefix + ':' + name + ' xmlns:' + prefix + '="' + rng.choice(uris) + '" ' + attribute_prefix + ':a="' + rng.choice(WORDS) + '">' + rng.choice(WORDS) + '</' + prefix + ':' + name + '>')
+                else:
+                    group.append('<' + prefix + ':' + name + ' ' + attribute_prefix + ':a="' + rng.choice(WORDS) + '"><' + name + '/></' + prefix + ':' + name + '>')
+            group.append('</group>\n')
+            yield ''.join(group)
+    return buffered((body(), lambda: '</root>'), size)
+
+def attributes(size, seed):
+    """Elements with many attributes each."""
+    rng = random.Random(seed)
+    def body():
+        yield '<root>'
+        index = 0
+        while True:
+            index += 1
+            attributes = ' '.join('attr' + str(number) + '="' + words(rng, rng.randint(1, 3)) + '"' for number in range(0, rng.randint(10, 30)))
+            yield '<record id="' + str(index) + '" ' + attributes + '/>\n'
+    return buffered((body(), lambda: '</root>'), size)
+
+def text(size, seed):
+    """Paragraphs of long text with some inline markup and comments."""
+    rng = random.Random(seed)
+    def body():
+        yield '<root>'
+        while True:
+            paragraph = ['<p>' + words(rng, rng.randint(50, 400))]
+            for index in range(0, rng.randint(0, 5)):
+                paragraph.append(' <b>' + words(rng, 2) + '</b> ' + words(rng, rng.randint(10, 100)))
+            if rng.random() < 0.1:
+                paragraph.append('<!-- ' + words(rng, 5) + ' -->')
+            paragraph.append('</p>\n')
+            yield ''.join(paragraph)
+    return buffered((body(), lambda: '</root>'), size)
+
+SHAPES = { 'deep': deep, 'wide': wide, 'namespaces': namespaces, 'attributes': attributes, 'text': text }
+
+# queries that are representative of each shape of document, for timing compilation and evaluation. Prefix-less namespaces are numbered, i.e. default1, default2 etc.
+QUERIES = {
+    'deep': ['//item', '//*[@level="100"]', '//record/ancestor::*[1]', 'count(//*)'],
+    'wide': ['//item', '/root/*[@id="1000"]', '//*[starts-with(text(), "a")]', 'count(/root/*)'],
+    'namespaces': ['//default2:group', '//p1:item', '//*[@p2:a]', 'count(//*[namespace-uri() = "urn:benchmark:ns3"])'],
+    'attributes': ['//record[@attr5]', '//@attr1', '//record[contains(@attr3, "echo")]', 'count(//@*)'],
+    'text': ['//p', '//b/text()', '//p[contains(., "tango")]', '//comment()'],
+}
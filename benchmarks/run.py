@@ -0,0 +1,183 @@
+"""Benchmarks for the parser, position lookup, path generation, queries and completions, on synthetic documents of various shapes and sizes. Each document is measured in a separate process, so that it's peak memory usage can be reported. The results are written as JSON, so that runs can be compared over time.
+
+Usage: python benchmarks/run.py --sizes 1,10,100 --shapes deep,wide --repeat 5 --output results.json
+"""
+import os
+import sys
+import gc
+import json
+import time
+import random
+import platform
+import argparse
+import subprocess
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the package folder, so that the modules that don't depend on Sublime can be imported
+from lxml import etree
+from lxml_parser import *
+from mapped_file import MappedFile
+from lxml_index import StructureSummary, completion_names_from_structure_summary
+from xpath_engine import nodes_at_positions, subqueries_for_completions
+import generators
+
+MB = 1024 * 1024
+CURSOR_LOOKUPS = 200 # the number of random cursor positions looked up in each sample
+COMPILATIONS = 100 # the number of times each query is compiled in each sample
+MIN_REPEAT = 5 # with fewer samples than this, the bootstrap intervals compare.py reports are degenerate, as they can only take a few values
+COMPLETION_QUERIES = [['/*/'], ['//'], ['//*/@'], ['/*/*/', '*/']] # the subqueries typed before the completions are requested, as parsed from the query
+TOKENIZED_QUERY = '//record[@attr1 = "alpha" and count(ancestor::*) > 2]/following-sibling::*[1]/@' # tokenizing this query is part of the completion latency
+
+def peak_memory_mb():
+    """Return the peak resident memory of this process, or None where it isn't available."""
+    try:
+        import resource
+    except ImportError: # i.e. on Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': # bytes on macOS, kilobytes elsewhere
+        return peak / MB
+    return peak / 1024
+
+def timed(function, repeat):
+    """Return the result of the function, and how long each of the given number of calls took, in seconds."""
+    samples = []
+    result = None
+    for index in range(0, repeat):
+        gc.collect() # so that collecting the garbage of the previous sample isn't timed
+        start = time.perf_counter()
+        result = function()
+        samples.append(time.perf_counter() - start)
+    return (result, samples)
+
+def run_case(shape, size_mb, seed, repeat):
+    """Measure each operation on a document of the given shape and size, returning the timings in seconds, or for batches of operations, the average time per operation."""
+    text_chunks = list(generators.SHAPES[shape](int(size_mb * MB), seed)) # generated up front, so that generating it isn't timed
+    characters = sum(len(chunk) for chunk in text_chunks)
+    baseline_memory = peak_memory_mb()
+    metrics = {}
+
+    def parse():
+        return lxml_etree_parse_xml_string_with_location(text_chunks)
+    tree = None
+    def parse_once():
+        nonlocal tree
+        tree = None # free the previous tree before parsing again
+        tree, all_elements = parse()
+        return all_elements
+    all_elements, metrics['parse'] = timed(parse_once, repeat)
+
+    with tempfile.NamedTemporaryFile(suffix='.xml', delete=False) as f: # parsed directly from the file, as unmodified files are in Sublime
+        for chunk in text_chunks:
+            f.write(chunk.encode('UTF-8'))
+    def parse_mapped_file():
+        nonlocal tree
+        tree = None
+        with MappedFile(f.name) as mapped_file:
+            tree, all_elements = lxml_etree_parse_xml_buffer_with_location(mapped_file.buffer, mapped_file.index)
+        return all_elements
+    try:
+        all_elements, metrics['parse_mapped_file'] = timed(parse_mapped_file, repeat)
+    finally:
+        os.remove(f.name)
+    root = tree.getroot()
+    namespaces = unique_namespace_prefixes(root.all_namespaces)
+    root.unique_namespaces = namespaces
+
+    rng = random.Random(seed)
+    positions = sorted(rng.randrange(0, characters) for index in range(0, CURSOR_LOOKUPS))
+    def lookup_cursors():
+        return [nodes_at_positions([root], [(position, position)]) for position in positions] # one cursor at a time, as when it is moved
+    found, samples = timed(lookup_cursors, repeat)
+    metrics['cursor_lookup'] = [sample / CURSOR_LOOKUPS for sample in samples]
+
+    nodes = [matches[0][0] for matches in found if len(matches) > 0]
+    exact = lambda: getNodePaths(nodes, lambda tree: namespaces, include_indexes=True, include_attributes=False)
+    paths, samples = timed(exact, repeat)
+    metrics['path_generation'] = [sample / max(1, len(nodes)) for sample in samples]
+
+    nsmap = { prefix: uri for prefix, (uri, original_prefix) in namespaces.items() }
+    for index, query in enumerate(generators.QUERIES[shape]):
+        result, samples = timed(lambda: [etree.XPath(query, namespaces=nsmap) for compilation in range(0, COMPILATIONS)], repeat)
+        metrics['query_compile_' + str(index)] = [sample / COMPILATIONS for sample in samples]
+        result, metrics['query_evaluate_' + str(index)] = timed(lambda: get_results_for_xpath_query(query, tree, None, namespaces), repeat)
+
+    summary, metrics['structure_summary'] = timed(lambda: StructureSummary(root), repeat)
+    root.structure_summary = summary
+    def complete():
+        subqueries_for_completions(TOKENIZED_QUERY)
+        return [completion_names_from_structure_summary(tree, [tree], queries[0:-1] + [queries[-1] + '*'], namespaces) for queries in COMPLETION_QUERIES]
+    result, samples = timed(complete, repeat)
+    metrics['completion'] = [sample / len(COMPLETION_QUERIES) for sample in samples]
+
+    return {
+        'shape': shape,
+        'size_mb': size_mb,
+        'characters': characters,
+        'nodes': len(all_elements),
+        'queries': generators.QUERIES[shape],
+        'metrics': metrics,
+        'peak_memory_mb': peak_memory_mb(),
+        'baseline_memory_mb': baseline_memory, # after generating the text, before parsing it
+    }
+
+def run_suite(shapes, sizes, seed, repeat, python = sys.executable, progress = None):
+    """Run each case in it's own process, and return their results."""
+    cases = []
+    for size_mb in sizes:
+        for shape in shapes:
+            if progress is not None:
+                progress('running ' + shape + ' ' + str(size_mb) + ' MB')
+            output = subprocess.check_output([python, os.path.abspath(__file__), '--case', shape, str(size_mb), '--seed', str(seed), '--repeat', str(repeat)])
+            cases.append(json.loads(output.decode('utf-8')))
+    return cases
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'lxml': '.'.join(str(part) for part in etree.LXML_VERSION),
+        'libxml2': '.'.join(str(part) for part in etree.LIBXML_VERSION),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+def parse_sizes(text):
+    return [float(size) if '.' in size else int(size) for size in text.split(',')]
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--shapes', default=','.join(generators.SHAPES.keys()), help='comma separated shapes of document: ' + ', '.join(generators.SHAPES.keys()))
+    parser.add_argument('--sizes', default='1,10', help='comma separated sizes of document, in megabytes, i.e. 1,10,100,1024')
+    parser.add_argument('--seed', type=int, default=1, help='the seed for the document generators and the cursor positions')
+    parser.add_argument('--repeat', type=int, default=MIN_REPEAT, help='the number of times each operation is timed, at least ' + str(MIN_REPEAT))
+    parser.add_argument('--output', help='the file to write the results to, instead of standard output')
+    parser.add_argument('--case', nargs=2, metavar=('SHAPE', 'SIZE_MB'), help=argparse.SUPPRESS) # used to run a single case in a child process
+    args = parser.parse_args(args)
+
+    if args.case is not None:
+        shape, size = args.case
+        json.dump(run_case(shape, parse_sizes(size)[0], args.seed, args.repeat), sys.stdout)
+        return 0
+
+    if args.repeat < MIN_REPEAT:
+        parser.error('--repeat must be at least ' + str(MIN_REPEAT) + ', so that the results can be compared')
+    shapes = args.shapes.split(',')
+    unknown = [shape for shape in shapes if shape not in generators.SHAPES]
+    if len(unknown) > 0:
+        parser.error('unknown shapes: ' + ', '.join(unknown))
+    results = {
+        'environment': environment(),
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'cases': run_suite(shapes, parse_sizes(args.sizes), args.seed, args.repeat, progress=lambda message: print(message, file=sys.stderr)),
+    }
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=1)
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,292 @@
+import os
+import sys
+import struct
+import pickle
+import threading
+import subprocess
+import traceback
+from lxml import etree
+
+try:
+    from .lxml_parser import *
+    from .xpath_engine import XMLDocument, element_xml_preview
+except ImportError: # when running as the worker process, the modules are imported from the package folder (or .sublime-package file) that is on the path
+    from lxml_parser import *
+    from xpath_engine import XMLDocument, element_xml_preview
+
+MESSAGE_HEADER = struct.Struct('>I') # each message is the length of the pickled data, followed by the data
+PICKLE_PROTOCOL = 4 # the worker may run on a different version of Python than the plugin host
+
+def write_message(stream, message):
+    data = pickle.dumps(message, PICKLE_PROTOCOL)
+    stream.write(MESSAGE_HEADER.pack(len(data)))
+    stream.write(data)
+    stream.flush()
+
+def read_exactly(stream, length):
+    data = stream.read(length)
+    if data is None or len(data) < length:
+        raise EOFError('the pipe was closed')
+    return data
+
+def read_message(stream):
+    length, = MESSAGE_HEADER.unpack(read_exactly(stream, MESSAGE_HEADER.size))
+    return pickle.loads(read_exactly(stream, length))
+
+
+class DocumentServerError(Exception):
+    pass
+
+
+class DocumentServer:
+    """A worker process that owns parsed trees and runs queries on them, so that large documents don't use the plugin host's memory, and slow queries can be cancelled by killing it. It is reached over a pipe, with one request at a time."""
+    def __init__(self, python, timeout):
+        self.python = python # the worker needs a Python interpreter with lxml, as the plugin host can't run scripts
+        self.timeout = timeout # seconds a request may take before the worker is killed
+        self.process = None
+        self.generation = 0 # incremented whenever the worker is stopped, because the documents it had parsed are gone
+        self.lock = threading.Lock()
+
+    def start(self):
+        package_path = os.path.dirname(os.path.abspath(__file__))
+        self.process = subprocess.Popen(
+            [self.python, '-c', 'import sys; sys.path.insert(0, sys.argv[1]); import document_server; document_server.serve()', package_path],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0) # don't show a console window on Windows
+        )
+
+    def request(self, op, *args, timeout = None):
+        """Send a request to the worker, starting it if necessary, and return the response. If it takes longer than the timeout, the worker is killed."""
+        if timeout is None:
+            timeout = self.timeout
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                self.start()
+            process = self.process
+            watchdog = None
+            if timeout > 0:
+                watchdog = threading.Timer(timeout, self.kill)
+                watchdog.start()
+            try:
+                write_message(process.stdin, (op, args))
+                status, value = read_message(process.stdout)
+            except (OSError, EOFError, pickle.UnpicklingError) as e:
+                self.kill()
+                raise DocumentServerError('the document server stopped while handling ' + op + ': ' + repr(e))
+            finally:
+                if watchdog is not None:
+                    watchdog.cancel()
+        if status == 'xpath_error':
+            raise etree.XPathEvalError(value)
+        elif status == 'error':
+            raise DocumentServerError(value)
+        return value
+
+    def kill(self):
+        """Stop the worker, cancelling the request it is handling and freeing the memory used by it's documents."""
+        process = self.process
+        self.process = None
+        self.generation += 1
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait()
+
+    def close(self):
+        """Ask the worker to exit once it has finished the request it is handling."""
+        process = self.process
+        if process is not None and process.poll() is None:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+        self.process = None
+        self.generation += 1
+
+
+class RemoteDocument:
+    """A region of a view that has been parsed by the document server."""
+    CHUNK_SIZE = 1024 * 1024 # characters sent to the worker per request
+
+    def __init__(self, server, doc_id, begin, end):
+        self.server = server
+        self.doc_id = doc_id
+        self.begin = begin
+        self.end = end
+        self.generation = server.generation
+        self.namespaces = None
+        self.error = None # the line, column and message of the parse error, if there was one
+
+    def parse(self, chunks, default_namespace_prefix):
+        self.request('parse_begin', self.begin, default_namespace_prefix)
+        for chunk in chunks:
+            self.request('feed', chunk)
+        result = self.request('parse_end')
+        self.namespaces = result['namespaces']
+        self.error = result['error']
+
+    def is_current(self):
+        """Return whether the worker that parsed the document is still running."""
+        return self.generation == self.server.generation
+
+    def contains(self, position):
+        return self.begin <= position <= self.end
+
+    def request(self, op, *args, **kwargs):
+        return self.server.request(op, self.doc_id, *args, **kwargs)
+
+
+class RemoteResult:
+    """A result of a query that was executed by the document server, identified by the id of the results and it's index in them."""
+    __slots__ = ('document', 'results_id', 'index', 'preview')
+
+    def __init__(self, document, results_id, index):
+        self.document = document
+        self.results_id = results_id
+        self.index = index
+        self.preview = None
+
+
+class WorkerDocument(XMLDocument):
+    """A document parsed in the worker process, together with the results of the last query executed on it, so that they can be requested a page at a time."""
+    def __init__(self, offset, default_namespace_prefix):
+        super().__init__(offset, default_namespace_prefix)
+        self.results = []
+        self.results_id = None
+
+
+class DocumentStore:
+    """Handles the requests made to the worker process."""
+    def __init__(self):
+        self.documents = {}
+        self.queries = 0
+
+    def handle(self, op, args):
+        return getattr(self, 'op_' + op)(*args)
+
+    def results(self, doc_id, results_id):
+        """Return the results of the last query executed on the document, if they have the given id."""
+        document = self.documents[doc_id]
+        if document.results_id != results_id:
+            raise ValueError('the results are no longer available, because another query has been executed since')
+        return document.results
+
+    def op_parse_begin(self, doc_id, offset, default_namespace_prefix):
+        self.documents.pop(doc_id, None) # free the memory used by the previous version of the document first
+        self.documents[doc_id] = WorkerDocument(offset, default_namespace_prefix)
+
+    def op_feed(self, doc_id, chunk):
+        self.documents[doc_id].feed(chunk) # a parse error is reported once all the text has been received
+
+    def op_parse_end(self, doc_id):
+        document = self.documents[doc_id]
+        try:
+            document.close()
+        except etree.XMLSyntaxError as e:
+            del self.documents[doc_id]
+            line, column = e.position
+            return { 'error': (line, column, e.msg), 'namespaces': None }
+        return { 'error': None, 'namespaces': document.namespaces }
+
+    def op_parse_serialized(self, text, offset):
+        """Parse the text without keeping it, and return the tree serialized with it's positions, so that it can be recreated in the plugin host without being parsed again there."""
+        try:
+            tree, all_elements = lxml_etree_parse_xml_string_with_location([text], offset)
+        except etree.XMLSyntaxError as e:
+            log_entry = e.error_log[0] # the same error that is shown when the region is parsed in the plugin host
+            return { 'error': (log_entry.line, log_entry.column, log_entry.message), 'tree': None }
+        return { 'error': None, 'tree': serialize_tree_with_location(tree, all_elements) }
+
+    def op_release(self, doc_id):
+        self.documents.pop(doc_id, None)
+
+    def op_query(self, doc_id, query, positions, variables):
+        """Execute the query, keeping the results so that their previews and positions can be requested a page at a time. Return the id of the results and how many there are."""
+        document = self.documents[doc_id]
+        document.results = document.query(query, positions, variables)
+        self.queries += 1
+        document.results_id = self.queries
+        return (document.results_id, len(document.results))
+
+    def op_count(self, doc_id, query, positions, variables):
+        document = self.documents[doc_id]
+        return int(sum(document.query('count(' + query + '\n)', positions, variables)))
+
+    def op_previews(self, doc_id, results_id, start, end, maxlen, normalize_whitespace):
+        """Return the previews of the results at the given indexes, with three lines for elements and one line for other results."""
+        document = self.documents[doc_id]
+        return [document.preview(result, maxlen, normalize_whitespace) for result in self.results(doc_id, results_id)[start:end]]
+
+    def op_ranges(self, doc_id, results_id, start, end, element_position_type, attribute_position_type):
+        """Return the number of the results at the given indexes that are nodes in the document, and their positions."""
+        document = self.documents[doc_id]
+        nodes = [result for result in self.results(doc_id, results_id)[start:end] if documentOrderKey(result) is not None]
+        return (len(nodes), document.ranges(nodes, element_position_type, attribute_position_type))
+
+    def op_paths(self, doc_id, positions, options):
+        """Return the XPath of the node at each of the given positions, or None where there is no node."""
+        document = self.documents[doc_id]
+        paths = []
+        for position in positions:
+            node = document.node_at(position)
+            paths.append(None if node is None else document.paths([node], **options)[0])
+        return paths
+
+    def op_completion_names(self, doc_id, positions, queries):
+        """Return the names of the elements and attributes the queries could return from the nodes at the given positions, if they can be determined from the structure summary, otherwise None."""
+        return self.documents[doc_id].completion_names(positions, queries)
+
+    def op_find_in_file(self, path, query, maxlen, default_namespace_prefix, variables):
+        """Parse the file and execute the query from it's root, without keeping the tree. Return the line, column and preview of each result, or the position of the parse error."""
+        try:
+            document = XMLDocument.from_file(path, default_namespace_prefix) # newlines are normalized, like they are in the editor, so that the positions match
+        except etree.XMLSyntaxError as e:
+            line, column = e.position
+            return { 'error': (line, column, e.msg), 'results': [] }
+        except (UnicodeDecodeError, LookupError) as e: # i.e. the file isn't in the encoding it declares, or declares one Python doesn't know
+            return { 'error': None, 'results': [], 'failure': 'unable to decode the file - ' + str(e) }
+
+        results = []
+        for result in document.query(query, None, variables):
+            position = None
+            if isinstance(result, etree.ElementBase):
+                position = getNodeTagRange(result, 'open')[0]
+            elif documentOrderKey(result) is not None:
+                position = next(iter(document.ranges([result], 'open', 'value')), (None, ))[0]
+            if position is None: # the result isn't a node in the document, i.e. the query returned a number
+                results.append((None, None, collapseWhitespace(str(result), maxlen)))
+            elif isinstance(result, etree.ElementBase):
+                results.append(document.line_and_column(position) + (element_xml_preview(result, maxlen, document.substr), ))
+            else:
+                results.append(document.line_and_column(position) + (collapseWhitespace(str(result), maxlen), ))
+        return { 'error': None, 'results': results }
+
+    def op_stats(self):
+        stats = { 'documents': { doc_id: len(document.all_elements or []) for doc_id, document in self.documents.items() } }
+        try:
+            import resource
+            stats['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        except ImportError: # not available on Windows
+            pass
+        return stats
+
+def serve():
+    """Handle requests from the plugin host until the pipe is closed."""
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+    sys.stdout = sys.stderr # anything printed, i.e. by the print xpath function, must not be mixed with the responses
+
+    store = DocumentStore()
+    register_xpath_extensions(lambda nodes: getNodePaths(nodes, lambda tree: tree.getroot().unique_namespaces))
+    while True:
+        try:
+            op, args = read_message(stdin)
+        except EOFError:
+            return
+        try:
+            response = ('ok', store.handle(op, args))
+        except etree.XPathError as e:
+            response = ('xpath_error', str(e))
+        except Exception as e:
+            traceback.print_exc()
+            response = ('error', repr(e))
+        write_message(stdout, response)
@@ -0,0 +1,102 @@
+import os
+import fnmatch
+import queue
+import threading
+from lxml import etree
+from .document_server import DocumentServer, DocumentServerError
+
+def find_files(folders, patterns, should_stop):
+    """Yield the paths and sizes of the files in the given folders, and their subfolders, whose names match any of the given patterns."""
+    for folder in folders:
+        for dirpath, dirnames, filenames in os.walk(folder):
+            if should_stop():
+                return
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if any(fnmatch.fnmatch(filename, pattern) for pattern in patterns):
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        size = os.path.getsize(path)
+                    except OSError: # i.e. the file was deleted after the folder was listed
+                        continue
+                    yield (path, size)
+
+class FileSearch:
+    """Executes an XPath query on all the matching files in some folders, spreading them across a pool of document server processes, and reports the results of each file as soon as it has been searched."""
+    def __init__(self, python, processes, timeout, query, options, on_file_searched, on_finished):
+        self.python = python
+        self.processes = max(1, processes)
+        self.timeout = timeout # seconds a single file may take before the process searching it is stopped
+        self.query = query
+        self.options = options # the preview length, the default namespace prefix and the variables passed to the workers
+        self.on_file_searched = on_file_searched # called from a worker thread with the path and the response for each file
+        self.on_finished = on_finished # called from a worker thread once all files have been searched, or the search was cancelled
+        self.cancelled = False
+        self.files = queue.Queue()
+        self.servers = []
+        self.lock = threading.Lock()
+        self.running = 0
+        self.found = 0 # the number of files to search, which increases while the folders are still being listed
+        self.listed = False
+        self.searched = 0
+        self.skipped = 0 # files larger than the maximum size
+        self.matched = 0
+        self.results = 0
+
+    def start(self, folders, patterns, max_size):
+        """Start searching, listing the folders on a thread of their own, as they could contain a lot of files."""
+        self.running = self.processes
+        for index in range(0, self.processes):
+            server = DocumentServer(self.python, self.timeout)
+            self.servers.append(server)
+            threading.Thread(target=self.search_files, args=(server, ), name='xpath_find_in_files_' + str(index), daemon=True).start()
+        threading.Thread(target=self.list_files, args=(folders, patterns, max_size), name='xpath_find_in_files_listing', daemon=True).start()
+
+    def list_files(self, folders, patterns, max_size):
+        """Queue the files in the folders to be searched by the worker threads."""
+        for path, size in find_files(folders, patterns, lambda: self.cancelled):
+            if size > max_size:
+                self.skipped += 1
+            else:
+                self.found += 1
+                self.files.put(path)
+        self.listed = True
+        for server in self.servers: # tell each worker thread that there are no more files
+            self.files.put(None)
+
+    def search_files(self, server):
+        try:
+            while not self.cancelled:
+                path = self.files.get()
+                if path is None:
+                    break
+                try:
+                    response = server.request('find_in_file', path, self.query, self.options['maxlen'], self.options['default_namespace_prefix'], self.options['variables'])
+                except (DocumentServerError, etree.XPathError) as e: # i.e. the query took too long on this file, or it couldn't be read. The process is started again for the next file
+                    response = { 'error': None, 'results': [], 'failure': str(e) }
+                if self.cancelled:
+                    break
+                with self.lock:
+                    self.searched += 1
+                    if len(response['results']) > 0:
+                        self.matched += 1
+                        self.results += len(response['results'])
+                self.on_file_searched(path, response)
+        finally:
+            server.close()
+            with self.lock:
+                self.running -= 1
+                finished = self.running == 0
+            if finished:
+                self.on_finished(self)
+
+    def cancel(self):
+        """Stop searching, killing the processes so that the files they are parsing are abandoned."""
+        self.cancelled = True
+        for server in self.servers:
+            server.kill()
+        for server in self.servers: # wake up any worker threads that are waiting for files
+            self.files.put(None)
+
+    def progress(self):
+        return str(self.searched) + ' of ' + str(self.found) + ('' if self.listed else '+') + ' files searched, ' + str(self.results) + ' results in ' + str(self.matched) + ' files'
@@ -0,0 +1,240 @@
+from lxml import etree
+import collections
+import re
+
+class PathSummary:
+    """Summary of all the elements in a document that share the same path of element names from the root."""
+    __slots__ = ('label', 'parent', 'children', 'names', 'attributes')
+
+    def __init__(self, label, parent):
+        self.label = label # tuple of the tags (in Clark notation) from the root element to these elements
+        self.parent = parent # id of the parent path, or None for the document node
+        self.children = {} # tag -> id of child path
+        self.names = collections.Counter() # (tag, prefix) -> number of elements with this name at this path
+        self.attributes = collections.Counter() # attribute name (in Clark notation) -> number of elements at this path with this attribute
+
+class StructureSummary:
+    """A structure summary of a document (a DataGuide) - for each distinct path of element names from the root, the names of the elements and attributes found there and how often they occur."""
+    DOCUMENT = 0 # the id of the path that represents the document node
+
+    def __init__(self, root):
+        self.paths = [PathSummary((), None)]
+        self.ids = { (): self.DOCUMENT }
+
+        path_stack = [self.DOCUMENT]
+        for event, element in etree.iterwalk(root, events=('start', 'end')):
+            if event == 'start':
+                path_id = self.child_path(path_stack[-1], element.tag)
+                path = self.paths[path_id]
+                path.names[(element.tag, element.prefix)] += 1
+                path.attributes.update(element.attrib.keys())
+                path_stack.append(path_id)
+            else:
+                path_stack.pop()
+
+    def child_path(self, parent_id, tag):
+        """Return the id of the path for child elements with the given tag of the elements at the given path, creating it if necessary."""
+        parent = self.paths[parent_id]
+        path_id = parent.children.get(tag, None)
+        if path_id is None:
+            path_id = len(self.paths)
+            label = parent.label + (tag, )
+            self.paths.append(PathSummary(label, parent_id))
+            self.ids[label] = path_id
+            parent.children[tag] = path_id
+        return path_id
+
+    def path_id_of(self, node):
+        """Return the id of the path of the given element or tree, or None if it is not part of the summary."""
+        if isinstance(node, etree._ElementTree):
+            return self.DOCUMENT
+        if not isinstance(node, etree._Element) or not isinstance(node.tag, str): # comments and processing instructions are not summarized
+            return None
+        label = tuple(reversed([node.tag] + [ancestor.tag for ancestor in node.iterancestors()]))
+        return self.ids.get(label, None)
+
+    def descendants(self, path_ids, include_self):
+        """Return the ids of all paths below the given paths."""
+        found = set()
+        pending = list(path_ids)
+        if include_self:
+            found.update(pending)
+        while pending:
+            for child_id in self.paths[pending.pop()].children.values():
+                if child_id not in found:
+                    found.add(child_id)
+                    pending.append(child_id)
+        return found
+
+    def evaluate(self, steps, path_ids):
+        """Evaluate the location steps of a simple path, as returned by parse_simple_location_path, from the given paths. Return the ids of the paths matched by the last element step, and the attribute names matched by the last step if it is on the attribute axis."""
+        path_ids = set(path_ids)
+        attributes = None
+        for axis, test in steps:
+            if axis == 'attribute':
+                attributes = collections.Counter()
+                for path_id in path_ids:
+                    for name, count in self.paths[path_id].attributes.items():
+                        if test(name):
+                            attributes[name] += count
+                break
+
+            if axis == 'child':
+                candidates = [child_id for path_id in path_ids for child_id in self.paths[path_id].children.values()]
+            elif axis in ('descendant', 'descendant-or-self'):
+                candidates = self.descendants(path_ids, axis == 'descendant-or-self')
+            elif axis == 'parent':
+                candidates = [self.paths[path_id].parent for path_id in path_ids if self.paths[path_id].parent is not None]
+            else: # self
+                candidates = path_ids
+            path_ids = set(path_id for path_id in candidates if test is None or (path_id != self.DOCUMENT and test(self.paths[path_id].label[-1])))
+
+        return (path_ids, attributes)
+
+    def element_count(self):
+        """Return the number of elements in the document."""
+        return sum(sum(path.names.values()) for path in self.paths)
+
+    def local_names(self):
+        """Return the sets of the local names of all the elements and of all the attributes in the document."""
+        element_names = set()
+        attribute_names = set()
+        for path in self.paths[1:]:
+            element_names.add(etree.QName(path.label[-1]).localname)
+            attribute_names.update(etree.QName(name).localname for name in path.attributes.keys())
+        return (element_names, attribute_names)
+
+    def names_at(self, path_ids):
+        """Return the (tag, prefix) of the elements at the given paths, and how often they occur."""
+        names = collections.Counter()
+        for path_id in path_ids:
+            names.update(self.paths[path_id].names)
+        return names
+
+class ValueIndex:
+    """The most frequent values of each attribute, and the most frequent text content of each leaf element, in a document."""
+    MAX_VALUE_LENGTH = 200 # longer values are unlikely to be typed in a query, so they are not indexed
+
+    def __init__(self, root, max_values):
+        attribute_values = collections.defaultdict(collections.Counter) # attribute name (in Clark notation) -> value -> number of occurrences
+        text_values = collections.defaultdict(collections.Counter) # element tag (in Clark notation) -> text -> number of occurrences
+        for element in root.iter(etree.Element): # comments and processing instructions have no attributes
+            for name, value in element.attrib.items():
+                if len(value) <= self.MAX_VALUE_LENGTH:
+                    attribute_values[name][value] += 1
+            if len(element) == 0 and element.text is not None:
+                text = element.text.strip()
+                if text != '' and len(text) <= self.MAX_VALUE_LENGTH:
+                    text_values[element.tag][text] += 1
+
+        # only keep the top values for each name, as there could be millions of unique values
+        self.attribute_values = { name: counter.most_common(max_values) for name, counter in attribute_values.items() }
+        self.text_values = { tag: counter.most_common(max_values) for tag, counter in text_values.items() }
+
+    def values_for(self, name, is_attribute, start = ''):
+        """Return the most frequent values, and how often they occur, of the attribute or leaf element with the given name (in Clark notation) that start with the given text."""
+        values = (self.attribute_values if is_attribute else self.text_values).get(name, [])
+        return [(value, count) for value, count in values if value.startswith(start)]
+
+def structure_summary_for_tree(tree):
+    """Return the structure summary of the given tree, building it if it hasn't been built since the tree was parsed."""
+    root = tree.getroot()
+    if not hasattr(root, 'structure_summary'):
+        root.structure_summary = StructureSummary(root)
+    return root.structure_summary
+
+def completion_names_from_structure_summary(tree, context_nodes, queries, namespaces):
+    """Return the names of the elements, as (tag, prefix) tuples, and the names of the attributes, in Clark notation, that the last of the given queries could return when they are executed one after the other from the given context nodes. Return None if the result depends on more than the names of the nodes, i.e. on predicates, so the queries need to be evaluated against the tree."""
+    parsed_queries = []
+    for query in queries:
+        if query != '':
+            parsed = parse_simple_location_path(query, namespaces)
+            if parsed is None:
+                return None
+            parsed_queries.append(parsed)
+
+    summary = structure_summary_for_tree(tree)
+    path_ids = set()
+    for node in context_nodes:
+        path_id = summary.path_id_of(node)
+        if path_id is None:
+            return None
+        path_ids.add(path_id)
+
+    attributes = None
+    for absolute, steps in parsed_queries:
+        if attributes is not None: # the previous query returned attributes, which have no children
+            return None
+        if absolute:
+            path_ids = set([summary.DOCUMENT])
+        path_ids, attributes = summary.evaluate(steps, path_ids)
+
+    if attributes is not None:
+        return ([], list(attributes.keys()))
+    return (list(summary.names_at(path_ids).keys()), [])
+
+RE_NAME_TEST = re.compile(r'^(?:((?![\d.\-])[\w.\-]+):)?((?![\d.\-])[\w.\-]+|\*)$')
+RE_AXIS_STEP = re.compile(r'^(child|descendant|descendant-or-self|self|parent|attribute)\s*::\s*(.*)$')
+
+def parse_simple_location_path(query, namespaces):
+    """Parse a location path consisting only of name tests on the child, descendant, self, parent and attribute axes, without predicates, into a tuple of whether it is absolute and it's steps. Return None for any other kind of expression."""
+    if re.search(r'[\[\]()$|"\'=<>!,+]', query):
+        return None
+    query = query.strip()
+
+    absolute = query.startswith('/')
+    if absolute:
+        query = query[1:]
+    segments = query.split('/')
+    if absolute and segments == ['']: # the query is just "/"
+        return (True, [])
+
+    def name_test(test):
+        match = RE_NAME_TEST.match(test.strip())
+        if match is None:
+            return False
+        prefix, local_name = match.groups()
+        uri = ''
+        if prefix is not None:
+            if prefix not in namespaces:
+                return False
+            uri = namespaces[prefix][0]
+        elif local_name == '*':
+            return lambda name: True # any element or attribute, regardless of namespace
+
+        def test_name(name):
+            q = etree.QName(name)
+            return (local_name == '*' or q.localname == local_name) and (q.namespace or '') == uri
+        return test_name
+
+    steps = []
+    for index, segment in enumerate(segments):
+        segment = segment.strip()
+        if segment == '':
+            if index == len(segments) - 1: # a trailing slash is not a valid location path
+                return None
+            steps.append(('descendant-or-self', None)) # abbreviation for //
+            continue
+        elif segment == '.':
+            steps.append(('self', None))
+            continue
+        elif segment == '..':
+            steps.append(('parent', None))
+            continue
+
+        axis = 'child'
+        if segment.startswith('@'):
+            axis = 'attribute'
+            segment = segment[1:]
+        else:
+            match = RE_AXIS_STEP.match(segment)
+            if match is not None:
+                axis, segment = match.groups()
+        test = name_test(segment)
+        if test is False:
+            return None
+        if axis == 'attribute' and index != len(segments) - 1: # attributes have no children
+            return None
+        steps.append((axis, test))
+
+    return (absolute, steps)
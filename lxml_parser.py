@@ -1,7 +1,14 @@
 from lxml import etree
 from lxml.html import fromstring as fromhtmlstring
 import collections
+from array import array
+import gc
 import re
+import heapq
+
+XML_NAMESPACE = 'http://www.w3.org/XML/1998/namespace' # the namespace of the xml prefix, which is bound implicitly, so isn't in the nsmap of any element
+RE_TAG_NAME_END_POS = re.compile(r'[>\s/]')
+RE_TAG_ATTRIBUTES = re.compile(r'\s+((\w+(?::\w+)?)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'))')
 
 def clean_html(html_soup):
     """Convert the given html tag soup string into a valid xml string."""
@@ -31,6 +38,7 @@ class TagPos(CommonEqualityMixin):
 class LocationAwareElement(etree.ElementBase):
     open_tag_pos = None
     close_tag_pos = None
+    ordinal = None # the index of the node in document order, amongst all the elements, comments and processing instructions in the tree
     
     def is_self_closing(self):
         """If the start and end tag positions are the same, then it is self closing."""
@@ -39,10 +47,12 @@ class LocationAwareElement(etree.ElementBase):
 
 class LocationAwareComment(etree.CommentBase):
     tag_pos = None
+    ordinal = None
 
 
 class LocationAwareProcessingInstruction(etree.PIBase):
     tag_pos = None
+    ordinal = None
 
 
 # http://stackoverflow.com/questions/36246014/lxml-use-default-class-element-lookup-and-treebuilder-parser-target-at-the-sam
@@ -205,6 +215,7 @@ class LocationAwareTreeBuilder(LocationAwareXMLParser):
         else:
             # store this element to add before the root node when we encounter it
             self._addprevious.append(node)
+        node.ordinal = len(self._all_elements) # nodes are created in document order
         self._all_elements.append(node)
         self._most_recent = node
     
@@ -213,6 +224,90 @@ class LocationAwareTreeBuilder(LocationAwareXMLParser):
         return (self._root, self._all_namespaces, self._all_elements)
 
 
+class AppendableTreeBuilder(LocationAwareTreeBuilder):
+    """A tree builder that is never closed, so that text appended to the end of the document can be fed to it later, without parsing the whole document again."""
+    TAIL_LENGTH = 64
+    
+    def _reset(self):
+        super()._reset()
+        self.fed_length = 0
+        self.tail = '' # the last few characters fed so far, to cheaply detect most changes that are not appends
+    
+    @property
+    def begin_offset(self):
+        return self._initial_position_offset
+    
+    @property
+    def end_offset(self):
+        return self._initial_position_offset + self.fed_length
+    
+    def feed(self, chunk):
+        super().feed(chunk)
+        self.fed_length += len(chunk)
+        self.tail = (self.tail + chunk)[-self.TAIL_LENGTH:]
+    
+    def current_tree(self):
+        """Return the tree parsed so far and a list of all it's elements. Elements which haven't been closed yet are treated as though they are closed at the end of the text fed so far."""
+        if self._root is None:
+            return (None, None)
+        
+        end = (self.end_offset, self.end_offset)
+        for element in self._element_stack:
+            element.close_tag_pos = TagPos(end, end) # when the close tag is found later, this will be replaced with the real position
+        
+        self._root.all_namespaces = self._all_namespaces
+        return (etree.ElementTree(self._root), self._all_elements)
+
+
+class LocationAwareBufferTreeBuilder(LocationAwareTreeBuilder):
+    """A tree builder that is fed UTF-8 bytes from a buffer, i.e. a memory mapped file, instead of strings, so the text doesn't have to be taken from the view and encoded again. The byte offsets of the XML control characters are converted to character offsets with the index, or by decoding the chunks that aren't plain ASCII, so the positions are the same as when the text is parsed as a string."""
+    RE_SPLIT_XML = re.compile(rb'<!\[CDATA\[|\]\]>|[<>]')
+    
+    def __init__(self, buffer, offset_index, position_offset = 0, **parser_options):
+        self._buffer = buffer
+        self._offset_index = offset_index
+        super().__init__(position_offset, **parser_options)
+    
+    def _reset(self):
+        super()._reset()
+        self._fed_until = self._offset_index.origin
+    
+    def feed_until(self, end):
+        """Feed the buffer from where the last feed ended up to the given byte offset, which must be just after a `>`, so that no control sequence, character or CRLF is split."""
+        buffer = self._buffer
+        feed = self._parser.feed
+        append_position = self._positions.append
+        text_begin = self._fed_until
+        text_begin_position = self._initial_position_offset + self._offset_index.character_offset(text_begin)
+        results = list(self.RE_SPLIT_XML.finditer(buffer, text_begin, end))
+        if self._offset_index.is_plain(text_begin, end): # each byte is a character
+            character_delta = text_begin_position - text_begin
+            positions = [character_delta + result.start() for result in results]
+        else: # find the same control sequences in the decoded text to know their character offsets
+            text = buffer[text_begin:end].decode('UTF-8').replace('\r\n', '\n')
+            positions = [text_begin_position + result.start() for result in LocationAwareXMLParser.RE_SPLIT_XML.finditer(text)]
+        
+        for result, begin_position in zip(results, positions):
+            result_begin, result_end = result.span()
+            end_position = begin_position + result_end - result_begin # the control sequences are ASCII, so have as many characters as bytes
+            append_position((text_begin_position, begin_position))
+            feed(buffer[text_begin:result_begin])
+            
+            append_position((begin_position, end_position))
+            feed(buffer[result_begin:result_end])
+            text_begin = result_end
+            text_begin_position = end_position
+        self._fed_until = text_begin
+    
+    def close(self):
+        character_offset = self._offset_index.character_offset
+        self._positions.append((self._initial_position_offset + character_offset(self._fed_until), self._initial_position_offset + character_offset(len(self._buffer))))
+        self._parser.feed(self._buffer[self._fed_until:len(self._buffer)])
+        result = self._parser.close()
+        self._reset()
+        return result
+
+
 def lxml_etree_parse_xml_string_with_location(xml_chunks, position_offset = 0, should_stop = None):
     target = LocationAwareTreeBuilder(position_offset=position_offset, collect_ids=False, huge_tree=True, remove_blank_text=False)
     
@@ -231,6 +326,354 @@ def lxml_etree_parse_xml_string_with_location(xml_chunks, position_offset = 0, s
     
     return (tree, all_elements)
 
+def lxml_etree_parse_xml_buffer_with_location(buffer, offset_index, position_offset = 0, should_stop = None, chunk_size = 1048576):
+    """Parse the UTF-8 XML in the buffer, i.e. a memory mapped file, with the positions of the nodes being character offsets like those of lxml_etree_parse_xml_string_with_location."""
+    target = LocationAwareBufferTreeBuilder(buffer, offset_index, position_offset=position_offset, collect_ids=False, huge_tree=True, remove_blank_text=False)
+    
+    if should_stop is None or not callable(should_stop):
+        should_stop = lambda: False
+    
+    begin = offset_index.origin
+    while begin < len(buffer):
+        if should_stop():
+            break
+        end = buffer.find(b'>', begin + chunk_size) + 1 # end each chunk after a > so that no control sequence is split between chunks
+        if end == 0:
+            end = len(buffer)
+        target.feed_until(end)
+        begin = end
+    
+    root, all_namespaces, all_elements = target.close()
+    tree = etree.ElementTree(root)
+    
+    root.all_namespaces = all_namespaces
+    
+    return (tree, all_elements)
+
+def iterDocumentNodes(tree):
+    """Return a generator for all elements, comments and processing instructions in the tree, in document order, including those before and after the root element."""
+    root = tree.getroot()
+    yield from reversed(list(root.itersiblings(preceding=True)))
+    yield from root.iter()
+    yield from root.itersiblings()
+
+def serialize_tree_with_location(tree, all_elements):
+    """Serialize a tree parsed with location information into a compact form, consisting of the xml itself, a flat table of tag positions for each node in document order and the namespaces found in the document."""
+    positions = array('q')
+    for node in all_elements:
+        if isinstance(node, LocationAwareElement):
+            tag_positions = (node.open_tag_pos, node.close_tag_pos)
+        else:
+            tag_positions = (node.tag_pos, None)
+        for pos in tag_positions:
+            if pos is None:
+                positions.extend((-1, -1, -1, -1))
+            else:
+                positions.extend(pos.start_pos + pos.end_pos)
+    
+    root = tree.getroot()
+    return {
+        'xml': etree.tostring(tree, encoding='UTF-8'),
+        'positions': positions,
+        'namespaces': list(root.all_namespaces.items())
+    }
+
+def deserialize_tree_with_location(serialized):
+    """Recreate a tree and it's list of all elements from the output of serialize_tree_with_location, without having to parse the original document again."""
+    parser = etree.XMLParser(collect_ids=False, huge_tree=True, remove_blank_text=False)
+    parser.set_element_class_lookup(etree.ElementDefaultClassLookup(element=LocationAwareElement, comment=LocationAwareComment, pi=LocationAwareProcessingInstruction))
+    tree = etree.ElementTree(etree.fromstring(serialized['xml'], parser))
+    
+    def tagPos(quad):
+        if quad[0] == -1:
+            return None
+        return TagPos(quad[0:2], quad[2:4])
+    
+    gc_was_enabled = gc.isenabled()
+    gc.disable() # creating a proxy for every node triggers lots of pointless garbage collection runs, which take much longer than the deserialization itself
+    try:
+        all_elements = list(iterDocumentNodes(tree)) # keep the proxies alive, so they will retain the positions we set on them
+        positions = serialized['positions']
+        if len(all_elements) * 8 != len(positions):
+            raise ValueError('Serialized position table does not match the tree')
+        
+        quads = zip(*[iter(positions)] * 4) # each tag position is stored as 4 consecutive integers
+        for node, open_quad, close_quad in zip(all_elements, quads, quads):
+            if isinstance(node, LocationAwareElement):
+                node.open_tag_pos = tagPos(open_quad)
+                node.close_tag_pos = tagPos(close_quad)
+            else:
+                node.tag_pos = tagPos(open_quad)
+        setDocumentOrdinals(all_elements)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    
+    tree.getroot().all_namespaces = collections.OrderedDict(serialized['namespaces'])
+    return (tree, all_elements)
+
+def setDocumentOrdinals(all_elements):
+    """Given all the nodes of a tree in document order, set the ordinal of each node, as the tree builder does while parsing."""
+    for ordinal, node in enumerate(all_elements):
+        node.ordinal = ordinal
+
+def lastDescendantOrdinal(node):
+    """Return the ordinal of the last node inside the given node, or it's own ordinal if it is empty, by following the last children down, in time proportional to the depth of the tree."""
+    while len(node) > 0:
+        node = node[-1]
+    return node.ordinal
+
+def documentOrderKey(node):
+    """Return a key that sorts the given xpath result in document order amongst the other results from the same tree, or None if it is not a node from a tree parsed with location information."""
+    kind = 0
+    name = 0
+    if isinstance(node, etree._ElementUnicodeResult): # if the node is an attribute or text node etc.
+        parent = node.getparent()
+        if parent is None or parent.ordinal is None:
+            return None
+        if node.is_attribute: # attributes come after their element and before it's children, in the order they appear in it's open tag
+            kind = 1
+            name = list(parent.attrib.keys()).index(node.attrname)
+        elif node.is_text:
+            kind = 2
+        elif node.is_tail: # the tail comes after all the descendants of the node it follows, and the tail of a deeper node comes first
+            return (lastDescendantOrdinal(parent), 3, -parent.ordinal)
+        else:
+            return None
+        node = parent
+    elif not isinstance(node, (LocationAwareElement, LocationAwareComment, LocationAwareProcessingInstruction)) or node.ordinal is None:
+        return None
+    return (node.ordinal, kind, name)
+
+def merge_results_in_document_order(result_lists):
+    """Given (tree order, results) pairs, where the results of each are in document order, and the tree orders sort the trees in the order they appear in the view, merge the results into a single list in document order without duplicates. Results from different trees can't be interleaved or duplicated, so only those from the same tree are merged, in O(n log k) time, and the trees are then concatenated. If any of the results being merged is not a node, i.e. a number or a string, they are concatenated instead."""
+    results_of_trees = collections.OrderedDict()
+    for tree_order, results in sorted(result_lists, key=lambda pair: pair[0]): # the sort is stable, so lists from the same tree keep their order
+        results_of_trees.setdefault(tree_order, []).append(results)
+    
+    merged = []
+    for tree_order, tree_result_lists in results_of_trees.items():
+        if len(tree_result_lists) == 1:
+            merged += tree_result_lists[0]
+            continue
+        
+        keyed = []
+        for results in tree_result_lists:
+            keys = [documentOrderKey(result) for result in results]
+            if None in keys:
+                keyed = None
+                break
+            keyed.append(zip(keys, results))
+        if keyed is None:
+            merged += [result for results in tree_result_lists for result in results]
+            continue
+        
+        previous_key = None
+        for key, result in heapq.merge(*keyed, key=lambda item: item[0]):
+            if key != previous_key: # duplicates are next to each other once merged
+                merged.append(result)
+                previous_key = key
+    return merged
+
+def getRangesOfNodes(nodes, element_position_type, attribute_position_type, substr):
+    """Generate (begin, end) tuples of the positions of the given nodes in the document, using the substr function to read the text between two positions from it."""
+    
+    def ensureTagNameEndPosIsSet(node, open_begin, open_end):
+        try:
+            pos = node.tag_name_end_pos
+        except AttributeError:
+            node.tag_name_end_pos = open_begin + RE_TAG_NAME_END_POS.search(substr(open_begin, open_end)).start()
+    
+    for node in nodes:
+        attr_name = None
+        is_text = None
+        is_tail = None
+        if isinstance(node, etree._ElementUnicodeResult): # if the node is an attribute or text node etc.
+            attr_name = node.attrname
+            is_text = node.is_text
+            is_tail = node.is_tail
+            node = node.getparent() # get the parent
+        
+        open_begin, open_end = getNodeTagRange(node, 'open')
+        
+        if is_text or is_tail:
+            text_begin_pos = None
+            text_end_pos = None
+            next_node = None
+            if is_text:
+                text_begin_pos = open_end
+                text_end_pos = getNodeTagRange(node, 'close')[0]
+                next_node = node.iterchildren()
+            elif is_tail:
+                text_begin_pos = getNodeTagRange(node, 'close')[1]
+                text_end_pos = getNodeTagRange(node.getparent(), 'close')[0]
+                next_node = node.itersiblings()
+            
+            next_node = next(next_node, None)
+            if next_node is not None:
+                text_end_pos = getNodeTagRange(next_node, 'open')[0]
+            yield (text_begin_pos, text_end_pos)
+        elif isinstance(node, etree.CommentBase) or isinstance(node, etree.PIBase):
+            yield (open_begin, open_end)
+        elif attr_name is None or attribute_position_type is None or attribute_position_type in ('element', 'parent'):
+            # position type 'open' <|name| attr1="test"></name> "Goto name in open tag"
+            # position type 'close' <name attr1="test"></|name|> "Goto name in close tag"
+            # position type 'names' <|name| attr1="test"></|name|> "Goto name in open and close tags"
+            # position type 'content' <name>|content<subcontent />|</name> "Goto content"
+            # position type 'entire' |<name>content<subcontent /></name>| "Select entire element" # the idea being, that you can even paste it into a single-selection app, and it will have only the selected elements - useful for filtering out only useful/relevant parts of a document after a xpath query etc.
+            # position type 'open_attributes' <name| attr1="test" attr2="hello" |/>
+            
+            if element_position_type in ('open', 'close', 'names', 'open_attributes'):
+                # select only the tag name with the prefix
+                ensureTagNameEndPosIsSet(node, open_begin, open_end)
+                
+                if element_position_type == 'open_attributes':
+                    chars_before_end = len('>')
+                    if node.is_self_closing():
+                        chars_before_end += len('/')
+                    yield (node.tag_name_end_pos, open_end - chars_before_end)
+                else:
+                    chars_before_tag = len('<')
+                    if element_position_type in ('open', 'names') or node.is_self_closing():
+                        yield (open_begin + chars_before_tag, node.tag_name_end_pos)
+                    if element_position_type in ('close', 'names') and not node.is_self_closing():
+                        chars_before_tag += len('/')
+                        close_begin = getNodeTagRange(node, 'close')[0]
+                        yield (close_begin + chars_before_tag, close_begin + len('/') + (node.tag_name_end_pos - open_begin))
+            elif element_position_type == 'content':
+                if node.is_self_closing():
+                    yield (open_end, open_end)
+                else:
+                    yield (open_end, getNodeTagRange(node, 'close')[0])
+            elif element_position_type == 'entire':
+                yield (open_begin, getNodeTagRange(node, 'close')[1])
+        elif attribute_position_type != 'none':
+            # position type 'name' <element |attr1|="test"></element> "Goto attribute name in open tag"
+            # position type 'content' <element attr1="|test|"></element> "Goto attribute value in open tag"
+            # position type 'entire' <element |attr1="test"|></element> "Goto attribute declaration in open tag"
+            
+            ensureTagNameEndPosIsSet(node, open_begin, open_end)
+            attrs = substr(node.tag_name_end_pos, open_end)
+            q = etree.QName(attr_name)
+            
+            for match in RE_TAG_ATTRIBUTES.finditer(attrs):
+                is_this = False
+                prefixed_name = match.group(2).split(':')
+                if len(prefixed_name) == 2 and prefixed_name[0] != 'xmlns':
+                    if prefixed_name[1] == q.localname and q.namespace == (XML_NAMESPACE if prefixed_name[0] == 'xml' else node.nsmap.get(prefixed_name[0], None)):
+                        is_this = True
+                is_this = is_this or match.group(2) == attr_name
+                
+                if is_this:
+                    group = (1, None)
+                    if attribute_position_type in ('name'):
+                        group = (2, None)
+                    elif attribute_position_type in ('value', 'content'):
+                        group = (3, 4)
+                    
+                    group = next(g for g in group if match.group(g) is not None) # find first value match group (i.e. if double quotes, group 3, if single quotes, group 4)
+                    yield (node.tag_name_end_pos + match.start(group), node.tag_name_end_pos + match.end(group))
+                    break
+
+def getNodePaths(nodes, namespaces_for_tree, include_indexes = True, include_attributes = True, show_namespace_prefixes_from_query = True, case_sensitive = True, all_attributes = False, wanted_attributes = []):
+    """Return the XPath of each of the given nodes, using the prefixes in the namespace map that the namespaces_for_tree function returns for the tree of each node."""
+    if not case_sensitive:
+        wanted_attributes = [attrib.lower() for attrib in wanted_attributes]
+
+    def getTagNameWithMappedPrefix(node, namespaces):
+        tag = getTagName(node)
+        if show_namespace_prefixes_from_query and tag[0] is not None: # if the element belongs to a namespace
+            unique_prefix = next((prefix for prefix in namespaces.keys() if namespaces[prefix] == (tag[0], node.prefix or '')), None) # find the first prefix in the map that relates to this uri
+            if unique_prefix is not None:
+                tag = (tag[0], tag[1], unique_prefix + ':' + tag[1]) # ensure that the path we display can be used to query the element
+
+        if not case_sensitive:
+            tag = (tag[0], tag[1].lower(), tag[2].lower())
+
+        return tag
+
+    def getNodePathPart(node, namespaces):
+        tag = getTagNameWithMappedPrefix(node, namespaces)
+
+        output = tag[2]
+
+        if include_indexes:
+            siblings = node.itersiblings(preceding = True)
+            index = 1
+
+            def compare(sibling):
+                if not isinstance(sibling, LocationAwareElement): # skip comments
+                    return False
+                sibling_tag = getTagNameWithMappedPrefix(sibling, namespaces)
+                return sibling_tag == tag # namespace uri, prefix and tag name must all match
+
+            for sibling in siblings:
+                if compare(sibling):
+                    index += 1
+
+            # if there are no previous sibling matches, check next siblings to see if we should index this node
+            multiple = index > 1
+            if not multiple:
+                siblings = node.itersiblings()
+                for sibling in siblings:
+                    if compare(sibling):
+                        multiple = True
+                        break
+
+            if multiple:
+                output += '[' + str(index) + ']'
+
+        if include_attributes:
+            attributes_to_show = []
+            for attr_name in node.attrib:
+                include_attribue = False
+                if all_attributes:
+                    include_attribute = True
+                else:
+                    if not case_sensitive:
+                        attr_name = attr_name.lower()
+                    attr = attr_name.split(':')
+                    include_attribute = attr_name in wanted_attributes
+                    if not include_attribue and len(attr) == 2:
+                        include_attribue = attr[0] + ':*' in wanted_attributes or '*:' + attr[1] in wanted_attributes
+
+                if include_attribute:
+                    attributes_to_show.append('@' + attr_name + ' = "' + node.get(attr_name) + '"')
+
+            if len(attributes_to_show) > 0:
+                output += '[' + ' and '.join(attributes_to_show) + ']'
+
+        return output
+
+    def getNodePathSegments(node, namespaces, root):
+        if isinstance(node, etree.CommentBase):
+            node = node.getparent()
+        while node != root:
+            yield getNodePathPart(node, namespaces)
+            node = node.getparent()
+        yield getNodePathPart(node, namespaces)
+        yield ''
+
+    def getNodePath(node, namespaces, root):
+        return '/'.join(reversed(list(getNodePathSegments(node, namespaces, root))))
+
+    roots = {}
+    for node in nodes:
+        tree = node.getroottree()
+        root = tree.getroot()
+        roots.setdefault(root, []).append(node)
+
+    paths = []
+    for root in roots.keys():
+        for node in roots[root]:
+            namespaces = None
+            if show_namespace_prefixes_from_query:
+                namespaces = namespaces_for_tree(root.getroottree())
+
+            paths.append(getNodePath(node, namespaces, root))
+
+    return paths
+
 # TODO: consider moving to LocationAwareElement class
 def getNodeTagRange(node, position_type):
     """Given a node and position type (open or close), return the node's position."""
@@ -270,11 +713,23 @@ def getTagName(node):
         full_name = node.prefix + ':' + full_name
     return (q.namespace, q.localname, full_name)
 
+RE_LEADING_WHITESPACE = re.compile(r'\s*')
+RE_TRAILING_WHITESPACE = re.compile(r'\s*$')
+RE_COLLAPSIBLE_WHITESPACE = re.compile(r'[ \n\t]{2,}|[\n\t]')
+
 def collapseWhitespace(text, maxlen):
     """Replace tab characters and new line characters with spaces, trim the text and convert multiple spaces into a single space, and optionally truncate the result at maxlen characters."""
-    text = (text or '').strip()[0:maxlen + 1].replace('\n', ' ').replace('\t', ' ')
-    while '  ' in text:
-        text = text.replace('  ', ' ')
+    text = text or ''
+    if maxlen < 0:
+        text = text.strip()
+    else: # only look at as much of the text as could be shown, so that very long text isn't copied
+        start = RE_LEADING_WHITESPACE.match(text).end()
+        end = start + maxlen + 1
+        if RE_TRAILING_WHITESPACE.match(text, end) is not None: # the rest of the text is only whitespace, which is trimmed
+            text = text[start:].rstrip()[0:maxlen + 1]
+        else:
+            text = text[start:end]
+    text = RE_COLLAPSIBLE_WHITESPACE.sub(' ', text)
     if maxlen < 0: # a negative maxlen means infinite/no limit
         return text
     else:
@@ -283,6 +738,76 @@ def collapseWhitespace(text, maxlen):
             append = '...'
         return text[0:maxlen - len(append)] + append
 
+def register_xpath_extensions(paths_of_nodes):
+    """Register the custom XPath functions, using the given function to describe nodes when printing them."""
+    # http://lxml.de/extensions.html
+    ns = etree.FunctionNamespace(None)
+
+    def applyFuncToTextForItem(item, func):
+        if isinstance(item, etree._Element):
+            return func(item.xpath('string(.)'))
+        else:
+            return func(str(item))
+
+    # TODO: xpath 1 functions deal with lists by just taking the first node
+    #     - maybe we can provide optional arg to return nodeset by applying to all
+    def applyTransformFuncToTextForItems(nodes, func):
+        """If a nodeset is given, apply the transformation function to each item."""
+        if isinstance(nodes, list):
+            return [applyFuncToTextForItem(item, func) for item in nodes]
+        else:
+            return applyFuncToTextForItem(nodes, func)
+
+    def applyFilterFuncToTextForItems(nodes, func):
+        """If a nodeset is given, filter out items whose transformation function returns False.  Otherwise, return the value from the predicate."""
+        if isinstance(nodes, list):
+            return [item for item in nodes if applyFuncToTextForItem(item, func)]
+        else:
+            return applyFuncToTextForItem(nodes, func)
+
+    def printValueAndReturnUnchanged(context, nodes, title = None):
+        print_value = nodes
+        if isinstance(nodes, list):
+            if len(nodes) > 0 and isinstance(nodes[0], etree._Element):
+                paths = paths_of_nodes(nodes)
+                print_value = paths
+
+        if title is None:
+            title = ''
+        else:
+            title = title + ':'
+        print('XPath:', title, 'context_node', paths_of_nodes([context.context_node])[0], 'eval_context', context.eval_context, 'values', print_value)
+        return nodes
+
+    ns['upper-case'] = lambda context, nodes: applyTransformFuncToTextForItems(nodes, str.upper)
+    ns['lower-case'] = lambda context, nodes: applyTransformFuncToTextForItems(nodes, str.lower)
+    ns['ends-with'] = lambda context, nodes, ending: applyFilterFuncToTextForItems(nodes, lambda item: item.endswith(ending))
+    #ns['trim'] = lambda context, nodes: applyTransformFuncToTextForItems(nodes, str.strip) # according to the XPath 1.0 spec, the built in normalize-space function will trim the text on both sides, making this unnecessary http://www.w3.org/TR/xpath/#function-normalize-space
+    ns['print'] = printValueAndReturnUnchanged
+
+    def xpathRegexFlagsToPythonRegexFlags(xpath_regex_flags):
+        flags = 0
+        if 's' in xpath_regex_flags:
+            flags = flags | re.DOTALL
+        if 'm' in xpath_regex_flags:
+            flags = flags | re.MULTILINE
+        if 'i' in xpath_regex_flags:
+            flags = flags | re.IGNORECASE
+        if 'x' in xpath_regex_flags:
+            flags = flags | re.VERBOSE
+
+        return flags
+
+    ns['tokenize'] = lambda context, item, pattern, xpath_regex_flags = None: applyFuncToTextForItem(item, lambda text: re.split(pattern, text, maxsplit = 0, flags = xpathRegexFlagsToPythonRegexFlags(xpath_regex_flags)))
+    ns['matches'] = lambda context, item, pattern, xpath_regex_flags = None: applyFuncToTextForItem(item, lambda text: re.search(pattern, text, flags = xpathRegexFlagsToPythonRegexFlags(xpath_regex_flags)) is not None)
+    # replace
+    # avg
+    # min
+    # max
+    # abs
+    # ? adjust-dateTime-to-timezone, current-dateTime, day-from-dateTime, month-from-dateTime, days-from-duration, months-from-duration, etc.
+    # insert-before, remove, subsequence, index-of, distinct-values, reverse, unordered, empty, exists
+
 def unique_namespace_prefixes(namespaces, replaceNoneWith = 'default', start = 1):
     """Given an ordered dictionary of unique namespace prefixes and their URIs in document order, create a dictionary with unique namespace prefixes and their mappings."""
     unique = collections.OrderedDict()
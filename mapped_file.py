@@ -0,0 +1,72 @@
+import mmap
+
+BLOCK_SIZE = 65536 # the number of bytes between the precomputed character offsets
+CONTINUATION_BYTES = bytes(range(0x80, 0xC0)) # the bytes after the first of a multi-byte UTF-8 character
+UTF8_BOM = b'\xef\xbb\xbf'
+
+
+class CharacterOffsetIndex:
+    """Converts byte offsets in UTF-8 text to the character offsets Sublime uses, where a CRLF line ending is a single character. The character offset at the start of each block of the text is precomputed, along with whether the block is plain ASCII without CRLF line endings, so offsets in plain blocks are converted with arithmetic, and the rest by counting the characters since the start of their block."""
+    def __init__(self, buffer, origin = 0):
+        self.buffer = buffer
+        self.origin = origin # the byte offset of the first character, i.e. after a byte order mark
+        self.block_characters = []
+        self.plain_blocks = []
+        characters = 0
+        for start in range(origin, len(buffer), BLOCK_SIZE):
+            end = min(start + BLOCK_SIZE, len(buffer))
+            plain = buffer[start:end].isascii() and buffer.find(b'\r\n', max(origin, start - 1), end) == -1 # a CRLF could straddle the start of the block
+            self.block_characters.append(characters)
+            self.plain_blocks.append(plain)
+            characters += end - start if plain else self.count_characters(start, end)
+        self.characters = characters
+
+    def count_characters(self, begin, end):
+        """Return the number of characters whose first byte is in the given range of bytes, not counting the LF of a CRLF."""
+        if begin <= self.origin:
+            data = self.buffer[begin:end]
+            return len(data.translate(None, CONTINUATION_BYTES)) - data.count(b'\r\n')
+        data = self.buffer[begin - 1:end] # include the byte before the range, in case it is the CR of a CRLF
+        return len(data.translate(None, CONTINUATION_BYTES)) - data.count(b'\r\n') - (0 if data[0] in CONTINUATION_BYTES else 1)
+
+    def character_offset(self, byte_offset):
+        """Return the character offset of the character that starts at the given byte offset."""
+        block = (byte_offset - self.origin) // BLOCK_SIZE
+        if block >= len(self.plain_blocks):
+            return self.characters
+        block_start = self.origin + block * BLOCK_SIZE
+        if self.plain_blocks[block]:
+            return self.block_characters[block] + byte_offset - block_start
+        return self.block_characters[block] + self.count_characters(block_start, byte_offset)
+
+    def is_plain(self, begin, end):
+        """Return whether the given range of bytes is all in plain blocks, so that each byte is a character."""
+        return all(self.plain_blocks[(begin - self.origin) // BLOCK_SIZE:(end - 1 - self.origin) // BLOCK_SIZE + 1])
+
+
+class MappedFile:
+    """A UTF-8 file mapped into memory read only, with an index to convert it's byte offsets to character offsets. It should be closed as soon as it is no longer needed, as some platforms don't allow a mapped file to be saved."""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) # the mapping stays valid after the file is closed
+        origin = len(UTF8_BOM) if self.buffer[0:len(UTF8_BOM)] == UTF8_BOM else 0 # Sublime doesn't include the byte order mark in the view
+        self.index = CharacterOffsetIndex(self.buffer, origin)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self.buffer.close()
+
+    def text_sample(self, length, from_end = False):
+        """Return up to the given number of characters from the start or end of the file, with CRLF line endings converted to LF like they are in the view."""
+        if from_end:
+            data = self.buffer[max(self.index.origin, len(self.buffer) - length * 4):len(self.buffer)] # a character is at most 4 bytes
+        else:
+            data = self.buffer[self.index.origin:self.index.origin + length * 4]
+        text = data.decode('utf-8', errors='ignore').replace('\r\n', '\n') # a character split at either end of the sample is ignored
+        return text[-length:] if from_end else text[:length]
@@ -0,0 +1,116 @@
+import cProfile
+import datetime
+import functools
+import json
+import os
+import platform
+import threading
+import time
+from lxml import etree
+
+threshold = None # seconds an operation must take for it's profile to be kept, or None when profiling is disabled
+directory = None
+max_profiles = 20
+active = threading.local() # the profile of the outermost operation running on each thread, as only one profiler can be enabled per thread
+write_lock = threading.Lock()
+
+def configure(profile_directory, threshold_ms, max_count):
+    """Profile operations that take longer than the threshold, keeping at most the given number of the most recent profiles in the directory. A threshold of 0 disables profiling."""
+    global threshold
+    global directory
+    global max_profiles
+    directory = profile_directory
+    max_profiles = max(1, max_count)
+    threshold = threshold_ms / 1000 if threshold_ms > 0 else None
+
+class NullProfiledOperation:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_PROFILED_OPERATION = NullProfiledOperation()
+
+class ProfiledOperation:
+    """Profiles the code inside it, and writes the profile and the details of the operation to the profile directory if it took longer than the threshold. Operations inside another profiled operation on the same thread are part of the outer profile."""
+    __slots__ = ('operation', 'details', 'profile', 'start')
+
+    def __init__(self, operation, details):
+        self.operation = operation
+        self.details = details # called only if the profile is kept, to return a dictionary of details like the document size and the query
+
+    def __enter__(self):
+        self.profile = None
+        if getattr(active, 'profile', None) is None:
+            self.profile = cProfile.Profile()
+            active.profile = self.profile
+            self.start = time.perf_counter()
+            self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profile is not None:
+            self.profile.disable()
+            duration = time.perf_counter() - self.start
+            active.profile = None
+            if threshold is not None and duration >= threshold:
+                metadata = {
+                    'operation': self.operation,
+                    'duration_ms': duration * 1000,
+                    'threshold_ms': threshold * 1000,
+                    'time': datetime.datetime.now().isoformat(),
+                    'python': platform.python_version(),
+                    'lxml': '.'.join(str(part) for part in etree.LXML_VERSION),
+                    'platform': platform.platform(),
+                }
+                try:
+                    metadata.update(self.details())
+                except Exception as e: # the details are secondary to the profile itself
+                    metadata['details_error'] = repr(e)
+                threading.Thread(target=write_profile, args=(directory, self.profile, metadata), name='xpath_profile_writer', daemon=True).start() # the operation was already slow, so don't make it slower
+        return False
+
+def profile(operation, details):
+    """Return a context manager that profiles the code inside it if profiling is enabled, i.e. `with profile('parse', lambda: { 'query': query }):`"""
+    if threshold is None:
+        return NULL_PROFILED_OPERATION
+    return ProfiledOperation(operation, details)
+
+def profile_if_slow(operation, details):
+    """Decorate a function so that calls to it are profiled, with the details function being called with the same arguments."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if threshold is None:
+                return function(*args, **kwargs)
+            with ProfiledOperation(operation, lambda: details(*args, **kwargs)):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def write_profile(profile_directory, profile, metadata):
+    """Write the profile as a .pstats file, which can be read with the pstats module or a viewer like snakeviz, and it's metadata as a .json file with the same name, then remove the oldest profiles."""
+    name = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f') + '-' + metadata['operation']
+    try:
+        with write_lock:
+            os.makedirs(profile_directory, exist_ok=True)
+            profile.dump_stats(os.path.join(profile_directory, name + '.pstats'))
+            with open(os.path.join(profile_directory, name + '.json'), 'w', encoding='utf-8') as f:
+                json.dump(metadata, f, indent=1, default=str)
+            rotate_profiles(profile_directory, max_profiles)
+        print('XPath: ' + metadata['operation'] + ' took ' + str(round(metadata['duration_ms'])) + 'ms, profile written to', os.path.join(profile_directory, name + '.pstats'))
+    except OSError as e:
+        print('XPath: unable to write profile to', profile_directory, repr(e))
+
+def rotate_profiles(profile_directory, max_count):
+    """Remove the oldest profiles and their metadata, so that at most the given number remain."""
+    names = sorted(filename[:-len('.pstats')] for filename in os.listdir(profile_directory) if filename.endswith('.pstats')) # the names start with the time they were written
+    for name in names[0:max(0, len(names) - max_count)]:
+        for extension in ('.pstats', '.json'):
+            try:
+                os.remove(os.path.join(profile_directory, name + extension))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,88 @@
+import os
+import hashlib
+import pickle
+
+class ParseCache:
+    """Store the serialized trees of parsed files on disk, so that unmodified files don't need to be parsed again after Sublime is restarted."""
+    FORMAT_VERSION = 1 # increment whenever the format of the stored data changes, so that old cache files are ignored and evicted
+    FILE_EXTENSION = '.xpathcache'
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def cache_file_path(self, file_name, region, encoding):
+        """Return the path of the cache file that relates to the given region of the given file."""
+        key = '\n'.join([os.path.normcase(os.path.abspath(file_name)), str(region[0]), str(region[1]), encoding or ''])
+        return os.path.join(self.directory, 'v' + str(self.FORMAT_VERSION) + '-' + hashlib.sha1(key.encode('UTF-8')).hexdigest() + self.FILE_EXTENSION)
+
+    def fingerprint(self, file_name):
+        """Return the modification time and size of the given file. The content isn't hashed, as that would mean reading the whole of a large file just to use it's cached tree."""
+        stat = os.stat(file_name)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def load(self, file_name, region, encoding):
+        """Return the serialized tree stored for the given region of the given file, or None if there is no valid cache entry for it."""
+        path = self.cache_file_path(file_name, region, encoding)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                header = pickle.load(f) # the header is stored separately to the data, so the data doesn't need to be read if the cache entry is stale
+                if header.get('version') != self.FORMAT_VERSION or header.get('fingerprint') != self.fingerprint(file_name):
+                    stale = True
+                else:
+                    stale = False
+                    serialized = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+            stale = True
+
+        if stale:
+            self.remove(path)
+            return None
+
+        os.utime(path, None) # mark the cache entry as recently used, for the eviction policy
+        return serialized
+
+    def store(self, file_name, region, encoding, serialized):
+        """Store the serialized tree for the given region of the given file, and evict the least recently used entries if the cache is now too big."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.cache_file_path(file_name, region, encoding)
+        header = { 'version': self.FORMAT_VERSION, 'fingerprint': self.fingerprint(file_name), 'file_name': file_name }
+
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(serialized, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path) # so that a partially written cache file can never be read
+
+        self.evict()
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        """Remove cache files from previous format versions, and then the least recently used cache files until the total size is within the limit."""
+        if not os.path.isdir(self.directory):
+            return
+
+        current_prefix = 'v' + str(self.FORMAT_VERSION) + '-'
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(self.FILE_EXTENSION):
+                continue
+            if not entry.name.startswith(current_prefix):
+                self.remove(entry.path)
+            else:
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(entry[1] for entry in entries)
+        for mtime, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            self.remove(path)
+            total_size -= size
@@ -0,0 +1,150 @@
+import collections
+import os
+import threading
+import time
+
+SAMPLES_PER_OPERATION = 500 # the number of most recent timings kept for each operation in each view
+
+enabled = False # when disabled, measuring an operation only costs checking this flag
+lock = threading.Lock() # operations are measured from the async thread, the main thread and the thread pools
+view_stats = {} # view id -> the stats of that view
+
+class RollingHistogram:
+    """The most recent timings of an operation, from which the percentiles are calculated when they are shown."""
+    __slots__ = ('samples', 'count')
+
+    def __init__(self):
+        self.samples = collections.deque(maxlen=SAMPLES_PER_OPERATION)
+        self.count = 0 # including the timings that are no longer in the window
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def percentile(self, fraction):
+        ordered = sorted(self.samples)
+        return ordered[max(0, min(len(ordered) - 1, int(fraction * len(ordered) + 0.5) - 1))] # nearest rank
+
+class ViewStats:
+    __slots__ = ('timings', 'counters')
+
+    def __init__(self):
+        self.timings = collections.OrderedDict() # operation -> RollingHistogram, in the order the operations were first measured
+        self.counters = collections.Counter() # i.e. tree cache hits and misses
+
+class Timer:
+    __slots__ = ('view', 'operation', 'start')
+
+    def __init__(self, view, operation):
+        self.view = view
+        self.operation = operation
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(self.view, self.operation, time.perf_counter() - self.start)
+        return False
+
+class NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_TIMER = NullTimer()
+
+def set_enabled(value):
+    """Start or stop collecting stats. The stats collected so far are discarded when it is stopped, so they use no memory."""
+    global enabled
+    enabled = bool(value)
+    if not enabled:
+        clear()
+
+def view_name(view):
+    return os.path.basename(view.file_name() or view.name() or 'untitled')
+
+def stats_for_view(view):
+    stats = view_stats.get(view.id(), None)
+    if stats is None:
+        stats = ViewStats()
+        view_stats[view.id()] = stats
+    return stats
+
+def measure(view, operation):
+    """Return a context manager that records how long the code inside it takes against the view, i.e. `with measure(view, 'parse'):`"""
+    if not enabled or view is None:
+        return NULL_TIMER
+    return Timer(view, operation)
+
+def record(view, operation, seconds):
+    if not enabled or view is None:
+        return
+    with lock:
+        timings = stats_for_view(view).timings
+        histogram = timings.get(operation, None)
+        if histogram is None:
+            histogram = RollingHistogram()
+            timings[operation] = histogram
+        histogram.add(seconds)
+
+def increment(view, counter, amount = 1):
+    if not enabled or view is None:
+        return
+    with lock:
+        stats_for_view(view).counters[counter] += amount
+
+def forget(view):
+    with lock:
+        view_stats.pop(view.id(), None)
+
+def clear():
+    with lock:
+        view_stats.clear()
+
+def format_bytes(count):
+    for unit in ('bytes', 'KB', 'MB'):
+        if count < 1024:
+            return str(round(count, 1)) + ' ' + unit
+        count /= 1024
+    return str(round(count, 1)) + ' GB'
+
+def format_memory_usage(memory_usage):
+    return ', '.join(component + ': ' + format_bytes(size) for component, size in memory_usage.items() if size > 0)
+
+def format_document(index, characters, nodes, memory_usage):
+    """Return the lines describing the size of a document, and the estimated memory used by each component of it's tree."""
+    line = '  document ' + str(index + 1) + ': ' + '{:,}'.format(characters) + ' characters'
+    if nodes is None:
+        return [line + ', parsed by the document server or not parsed']
+    return [line + ', ' + '{:,}'.format(nodes) + ' nodes, about ' + format_bytes(sum(memory_usage.values())), '    ' + format_memory_usage(memory_usage)]
+
+def format_report(views, documents_of_view):
+    """Return the stats of the given views as text, including the documents in each view, which documents_of_view returns as a list of (characters, nodes, estimated memory usage) tuples, with None for the nodes and memory usage of documents that weren't parsed in the plugin host."""
+    lines = []
+    if not enabled:
+        lines.append('Timings are not being collected. Set "collect_performance_stats" to true in the XPath settings to collect them.')
+    else:
+        lines.append('Timings of the last ' + str(SAMPLES_PER_OPERATION) + ' times each operation was performed, in milliseconds.')
+    with lock:
+        stats = { view.id(): (view_stats[view.id()].timings.copy(), view_stats[view.id()].counters.copy()) for view in views if view.id() in view_stats }
+
+    for view in views:
+        lines.append('')
+        lines.append(view_name(view) + ' (view ' + str(view.id()) + ')')
+        for index, (characters, nodes, memory_usage) in enumerate(documents_of_view(view)):
+            lines += format_document(index, characters, nodes, memory_usage)
+        if view.id() not in stats:
+            continue
+        timings, counters = stats[view.id()]
+        if len(counters) > 0:
+            lines.append('  ' + ', '.join(name + ': ' + str(counters[name]) for name in sorted(counters.keys())))
+        if len(timings) > 0:
+            lines.append('  {:<20} {:>8} {:>10} {:>10} {:>10}'.format('operation', 'count', 'p50', 'p95', 'max'))
+            for operation, histogram in timings.items():
+                lines.append('  {:<20} {:>8} {:>10.3f} {:>10.3f} {:>10.3f}'.format(operation, histogram.count, histogram.percentile(0.5) * 1000, histogram.percentile(0.95) * 1000, max(histogram.samples) * 1000))
+    return '\n'.join(lines) + '\n'
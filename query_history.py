@@ -0,0 +1,258 @@
+import os
+import json
+import collections
+import threading
+import queue
+import math
+
+class QueryHistory:
+    """The history of xpath queries, and the keys (usually the file names of the views) they were used with, indexed in memory and persisted as an append-only journal of changes that is written from a background thread."""
+    COMPACT_AFTER_RECORDS = 1000 # the journal is rewritten from the index once it contains more than twice as many records as the index has entries, plus this many
+    RECENCY_WEIGHT = 2.0 # how the recency, the number of uses and being used with the current key are weighted when ranking search results
+    FREQUENCY_WEIGHT = 1.0
+    KEY_WEIGHT = 1.0
+    MAX_CANDIDATES_TO_RANK = 500 # when more queries than this match a search, only the most recently used of them are ranked
+
+    def __init__(self, path, max_history):
+        self.path = path
+        self.max_history = max_history
+        self.lock = threading.RLock()
+        self.entries = collections.OrderedDict() # (query, key) -> sequence number of the last use, ordered from least to most recently used
+        self.keys = {} # key -> ordered set (OrderedDict with None values) of the queries used with that key, from least to most recently used
+        self.counts = {} # (query, key) -> number of times used
+        self.query_keys = {} # query -> set of keys it was used with
+        self.trigrams = collections.defaultdict(set) # trigram of the lower case query -> set of queries containing it
+        self.sequence = 0
+        self.journal_records = 0
+        self.writes = queue.Queue()
+        self.writer = None
+
+    def load(self):
+        """Replay the journal to rebuild the index. Return False if there is no journal yet."""
+        if not os.path.isfile(self.path):
+            return False
+        with self.lock:
+            with open(self.path, 'r', encoding='UTF-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError: # i.e. the last record was only partially written
+                        continue
+                    self.apply(record)
+                    self.journal_records += 1
+        return True
+
+    def import_items(self, items):
+        """Add the given [query, key] pairs, from least to most recently used, and write a new journal containing them."""
+        with self.lock:
+            for query, key in items:
+                self.index_add(query, key)
+            self.compact()
+
+    def apply(self, record):
+        """Update the index with the change described by the given journal record."""
+        op = record.get('op')
+        if op == 'add':
+            self.index_add(record['query'], record['key'], record.get('count', 1))
+        elif op == 'remove':
+            self.index_remove(record['query'], record['key'])
+        elif op == 'rename':
+            self.index_rename(record['old'], record['new'])
+
+    def index_add(self, query, key, count = 1):
+        item = (query, key)
+        self.sequence += 1
+        self.entries[item] = self.sequence
+        self.entries.move_to_end(item)
+        self.counts[item] = self.counts.get(item, 0) + count
+        queries = self.keys.setdefault(key, collections.OrderedDict())
+        queries[query] = None
+        queries.move_to_end(query)
+        if query not in self.query_keys:
+            self.query_keys[query] = set()
+            for trigram in trigrams_of(query):
+                self.trigrams[trigram].add(query)
+        self.query_keys[query].add(key)
+
+        # if there are more than the specified maximum number of history items, remove the oldest
+        while len(self.entries) > self.max_history:
+            old_query, old_key = next(iter(self.entries))
+            self.index_remove(old_query, old_key)
+
+    def index_remove(self, query, key):
+        if self.entries.pop((query, key), None) is not None:
+            del self.counts[(query, key)]
+            queries = self.keys[key]
+            del queries[query]
+            if len(queries) == 0:
+                del self.keys[key]
+            keys = self.query_keys[query]
+            keys.discard(key)
+            if len(keys) == 0: # the query is no longer in the history for any key
+                del self.query_keys[query]
+                for trigram in trigrams_of(query):
+                    queries = self.trigrams[trigram]
+                    queries.discard(query)
+                    if len(queries) == 0:
+                        del self.trigrams[trigram]
+
+    def index_rename(self, old_key, new_key):
+        if old_key not in self.keys or old_key == new_key:
+            return
+        # rebuild the order, because the renamed items keep their position in the history
+        entries = collections.OrderedDict()
+        counts = {}
+        for (query, key), sequence in self.entries.items():
+            count = self.counts[(query, key)]
+            if key == old_key:
+                key = new_key
+                self.query_keys[query].discard(old_key)
+                self.query_keys[query].add(new_key)
+            if (query, key) in entries: # the most recent use of a query with the new key takes precedence
+                del entries[(query, key)]
+            entries[(query, key)] = sequence
+            counts[(query, key)] = counts.get((query, key), 0) + count
+        self.entries = entries
+        self.counts = counts
+        self.keys = {}
+        for query, key in self.entries.keys():
+            self.keys.setdefault(key, collections.OrderedDict())[query] = None
+
+    def record(self, record):
+        """Apply the change to the index, and write it to the journal in the background."""
+        with self.lock:
+            self.apply(record)
+            self.writes.put(json.dumps(record) + '\n')
+            self.journal_records += 1
+            if self.journal_records > 2 * len(self.entries) + self.COMPACT_AFTER_RECORDS:
+                self.compact()
+        self.ensure_writer()
+
+    def add(self, key, query):
+        """Add the specified query to the history for the given key, or make it the most recent item if it is already present."""
+        self.record({ 'op': 'add', 'query': query, 'key': key })
+
+    def remove(self, key, query):
+        """If the given query exists in the history for the given key, remove it."""
+        if (query, key) in self.entries:
+            self.record({ 'op': 'remove', 'query': query, 'key': key })
+
+    def change_key(self, old_key, new_key):
+        """For all items in the history with the given old key, change the key to the specified new key."""
+        if old_key in self.keys:
+            self.record({ 'op': 'rename', 'old': old_key, 'new': new_key })
+
+    def queries_for_keys(self, keys):
+        """Return all previously used xpath queries with any of the given keys, from least to most recently used, without duplicates. If keys is None, return history across all keys."""
+        with self.lock:
+            if keys is not None and len(keys) == 1:
+                return list(self.keys.get(keys[0], {}).keys())
+            unique = collections.OrderedDict()
+            for query, key in reversed(self.entries.keys()):
+                if keys is None or key in keys:
+                    unique.setdefault(query, None)
+            return list(reversed(unique.keys()))
+
+    def search(self, text, keys = None, current_key = None, is_valid = None, limit = 200):
+        """Return the queries that contain all the whitespace separated terms of the given text, ignoring case, ranked by how recently and how often they were used, and whether they were used with the current key. Only queries used with any of the given keys are included, unless keys is None. If given, is_valid is called to filter out queries."""
+        with self.lock:
+            terms = text.lower().split()
+
+            # all the trigrams of the terms must be in a query for it to match
+            trigram_sets = []
+            for term in terms:
+                for trigram in trigrams_of(term):
+                    queries = self.trigrams.get(trigram, None)
+                    if queries is None:
+                        return []
+                    trigram_sets.append(queries)
+            indexed = None
+            if len(trigram_sets) > 0:
+                trigram_sets.sort(key=len)
+                indexed = trigram_sets[0].intersection(*trigram_sets[1:])
+
+            def matches(query):
+                if keys is not None and self.query_keys[query].isdisjoint(keys):
+                    return False
+                lower = query.lower()
+                return all(term in lower for term in terms)
+
+            if indexed is not None and len(indexed) <= self.MAX_CANDIDATES_TO_RANK * 4:
+                candidates = [query for query in indexed if matches(query)]
+            else: # for broad searches, only rank the most recently used matches, found by walking the history backwards
+                if keys is not None and len(keys) == 1:
+                    recent = reversed(self.keys.get(keys[0], {}).keys())
+                else:
+                    recent = (query for query, key in reversed(self.entries.keys()))
+                candidates = collections.OrderedDict()
+                for query in recent:
+                    if query not in candidates and (indexed is None or query in indexed) and matches(query):
+                        candidates[query] = None
+                        if len(candidates) >= self.MAX_CANDIDATES_TO_RANK:
+                            break
+
+            def score(query):
+                query_keys = self.query_keys[query]
+                if keys is not None:
+                    query_keys = query_keys.intersection(keys)
+                last_used = max(self.entries[(query, key)] for key in query_keys)
+                uses = sum(self.counts[(query, key)] for key in query_keys)
+                recency = 1 - (self.sequence - last_used) / max(1, len(self.entries))
+                return self.RECENCY_WEIGHT * recency + self.FREQUENCY_WEIGHT * math.log(1 + uses) / math.log(2 + len(self.entries)) + (self.KEY_WEIGHT if current_key in query_keys else 0)
+
+            ranked = sorted(((score(query), query) for query in candidates), reverse=True)
+
+        results = []
+        for value, query in ranked: # validate the queries only until there are enough results, as that can be slower than ranking them
+            if is_valid is None or is_valid(query):
+                results.append(query)
+                if len(results) >= limit:
+                    break
+        return results
+
+    def compact(self):
+        """Replace the journal with one that only contains the current history, once all pending writes have been made."""
+        with self.lock:
+            items = [(query, key, self.counts[(query, key)]) for query, key in self.entries.keys()] # the records are serialized on the background thread
+            self.writes.put(items)
+            self.journal_records = len(items)
+        self.ensure_writer()
+
+    def ensure_writer(self):
+        with self.lock:
+            if self.writer is None or not self.writer.is_alive():
+                self.writer = threading.Thread(target=self.write_journal, name='xpath_query_history', daemon=True)
+                self.writer.start()
+
+    def write_journal(self):
+        """Append records to the journal as they are queued, or rewrite it when a list of (query, key, count) items is queued, until None is queued."""
+        while True:
+            write = self.writes.get()
+            if write is None:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                if isinstance(write, list):
+                    temp_path = self.path + '.tmp'
+                    with open(temp_path, 'w', encoding='UTF-8') as f:
+                        f.writelines(json.dumps({ 'op': 'add', 'query': query, 'key': key, 'count': count }) + '\n' for query, key, count in write)
+                    os.replace(temp_path, self.path) # so that a partially compacted journal can never be read
+                else:
+                    writes = [write]
+                    while not self.writes.empty() and isinstance(self.writes.queue[0], str): # write all the records that are waiting at once
+                        writes.append(self.writes.get())
+                    with open(self.path, 'a', encoding='UTF-8') as f:
+                        f.writelines(writes)
+            except OSError as e:
+                print('XPath: unable to write query history to', self.path, repr(e))
+
+    def close(self, timeout = 5):
+        """Wait for any pending writes to be made, and stop the background writer."""
+        if self.writer is not None and self.writer.is_alive():
+            self.writes.put(None)
+            self.writer.join(timeout)
+
+def trigrams_of(text):
+    """Return the set of the sequences of three characters in the given text, in lower case."""
+    text = text.lower()
+    return set(text[index:index + 3] for index in range(0, len(text) - 2))
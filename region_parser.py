@@ -0,0 +1,36 @@
+import queue
+from .document_server import DocumentServer
+from .lxml_parser import deserialize_tree_with_location
+
+MIN_REGION_SIZE = 4096 # smaller regions are parsed in the plugin host, as sending them to a process would take about as long as parsing them
+
+
+class RegionParseError(Exception):
+    """The XML in a region isn't well formed. The arguments are the line and column of the error, relative to the start of the region, and the message."""
+    pass
+
+
+class RegionParserPool:
+    """A pool of document server processes that the XML regions of a view are parsed in concurrently. Each tree is sent back serialized with it's positions, and recreated in the plugin host, which takes a fraction of the time that parsing it there would."""
+    def __init__(self, python, processes, timeout):
+        self.python = python
+        self.processes = processes
+        self.servers = [DocumentServer(python, timeout) for index in range(0, max(1, processes))] # each is started when it is first used
+        self.idle = queue.Queue()
+        for server in self.servers:
+            self.idle.put(server)
+
+    def parse(self, text, offset):
+        """Parse the text in the next process that is free, and return the tree and the list of all it's nodes. A DocumentServerError is raised if the process failed."""
+        server = self.idle.get()
+        try:
+            response = server.request('parse_serialized', text, offset)
+        finally:
+            self.idle.put(server)
+        if response['error'] is not None:
+            raise RegionParseError(*response['error'])
+        return deserialize_tree_with_location(response['tree'])
+
+    def close(self):
+        for server in self.servers:
+            server.close()
@@ -62,6 +62,10 @@ class RunXpathTestsCommand(sublime_plugin.WindowCommand): # sublime.active_windo
                 test_xpath_completion('//*[starts-with (name (), "foobar")]/', ['//*[starts-with (name (), "foobar")]/'])
                 test_xpath_completion('//*[number(text())*2=246]/', ['//*[number(text())*2=246]/'])
                 test_xpath_completion('//*[number(text())*', ['//*', ''])
+                test_xpath_completion('//*[@id = 2 div ', ['//*', ''])
+                test_xpath_completion('//div/', ['//div/'])
+                test_xpath_completion('//*[@id = "a]"]/', ['//*[@id = "a]"]/'])
+                test_xpath_completion('count(//a) = count(//b/', ['//b/'])
 
             def sublime_lxml_goto_node_tests():
                 self.window.run_command('new_file')
@@ -178,6 +182,21 @@ class RunXpathTestsCommand(sublime_plugin.WindowCommand): # sublime.active_windo
                 view.window().run_command('close')
 
 
+            def document_order_tests():
+                nodes = list(iterDocumentNodes(tree))
+                assert [node.ordinal for node in nodes] == list(range(0, len(nodes)))
+                root = tree.getroot()
+                assert lastDescendantOrdinal(root) == list(root.iter())[-1].ordinal
+
+                results = tree.xpath('//node() | //@*')
+                reversed_halves = [(0, results[len(results) // 2:]), (0, results[0:len(results) // 2 + 1])]
+                merged = merge_results_in_document_order(reversed_halves)
+                assert merged == results, 'merged: ' + repr(merged) + '\nexpected: ' + repr(results)
+
+                deserialized, all_deserialized = deserialize_tree_with_location(serialize_tree_with_location(tree, all_elements))
+                assert [node.ordinal for node in all_deserialized] == [node.ordinal for node in all_elements]
+
+            document_order_tests()
             sublime_lxml_completion_tests()
             sublime_lxml_goto_node_tests()
 
@@ -0,0 +1,73 @@
+import collections
+import sys
+
+LIBXML2_NODE_SIZE = 120 # the approximate number of bytes libxml2 uses for each element, comment or processing instruction, not including it's text
+LIBXML2_ATTRIBUTE_SIZE = 100 # the approximate number of bytes libxml2 uses for each attribute, including the text node of it's value
+SAMPLE_SIZE = 200 # the number of nodes, or items in a collection, whose size is measured, from which the size of all of them is extrapolated
+
+COMPONENTS = ('libxml2_nodes', 'element_proxies', 'all_elements_list', 'tag_positions', 'tag_name_end_positions', 'namespaces', 'structure_summary', 'value_index')
+
+def evenly_spaced_sample(items):
+    step = max(1, len(items) // SAMPLE_SIZE)
+    return items[::step]
+
+def deep_size(obj, seen = None):
+    """Estimate the number of bytes used by the object and everything it refers to, measuring a sample of the items in large collections."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+        return size
+
+    if isinstance(obj, dict):
+        items = list(obj.keys()) + list(obj.values())
+    elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+        items = list(obj)
+    else:
+        items = []
+        if hasattr(obj, '__dict__'):
+            items.append(obj.__dict__)
+        for slot in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, slot):
+                items.append(getattr(obj, slot))
+        return size + sum(deep_size(item, seen) for item in items)
+
+    sample = evenly_spaced_sample(items)
+    if len(sample) > 0:
+        size += sum(deep_size(item, seen) for item in sample) * len(items) // len(sample)
+    return size
+
+def tree_memory_usage(root, all_elements):
+    """Estimate the number of bytes used by each component of a parsed tree, and the structures derived from it, by measuring a sample of it's nodes."""
+    usage = collections.OrderedDict((component, 0) for component in COMPONENTS)
+    if not all_elements:
+        return usage
+
+    sample = evenly_spaced_sample(all_elements)
+    seen = set() # the attribute names and positions that are shared between nodes are only counted once
+    for node in sample:
+        usage['libxml2_nodes'] += LIBXML2_NODE_SIZE + len(node.text or '') + len(node.tail or '') # the text is stored as UTF-8, so this is exact for ASCII
+        if isinstance(node.tag, str): # elements, rather than comments or processing instructions
+            usage['libxml2_nodes'] += len(node.tag) + sum(LIBXML2_ATTRIBUTE_SIZE + len(value) for value in node.attrib.values())
+
+        attributes = getattr(node, '__dict__', {})
+        usage['element_proxies'] += sys.getsizeof(node) + sys.getsizeof(attributes) + (sys.getsizeof(attributes['ordinal']) if 'ordinal' in attributes else 0)
+        for name in ('open_tag_pos', 'close_tag_pos', 'tag_pos'):
+            position = attributes.get(name, None)
+            if position is not None:
+                usage['tag_positions'] += deep_size(position, seen)
+        if 'tag_name_end_pos' in attributes: # cached when the names of the element are first selected
+            usage['tag_name_end_positions'] += sys.getsizeof(attributes['tag_name_end_pos'])
+
+    for component in ('libxml2_nodes', 'element_proxies', 'tag_positions', 'tag_name_end_positions'):
+        usage[component] = usage[component] * len(all_elements) // len(sample)
+    usage['all_elements_list'] = sys.getsizeof(all_elements)
+
+    if root is not None:
+        usage['namespaces'] = deep_size(getattr(root, 'all_namespaces', None), seen) + deep_size(getattr(root, 'unique_namespaces', None), seen)
+        usage['structure_summary'] = deep_size(getattr(root, 'structure_summary', None), seen)
+        usage['value_index'] = deep_size(getattr(root, 'value_index', None), seen)
+    return usage
@@ -4,9 +4,25 @@ import os
 from lxml import etree
 from xml.sax import SAXParseException
 import re
+import collections
+import bisect
+import concurrent.futures
+import threading
+import time
 from .lxml_parser import *
 from .sublime_lxml import *
 from .sublime_input_quickpanel import QuickPanelFromInputCommand
+from .parse_cache import ParseCache
+from .lxml_index import ValueIndex, structure_summary_for_tree, completion_names_from_structure_summary
+from .query_history import QueryHistory
+from .document_server import DocumentServer, DocumentServerError, RemoteDocument, RemoteResult
+from .find_in_files import FileSearch
+from .region_parser import RegionParserPool, RegionParseError, MIN_REGION_SIZE
+from .mapped_file import MappedFile
+from .xpath_tokenizer import XPathTokenizer
+from .tree_memory import tree_memory_usage
+from . import performance_stats
+from . import operation_profiler
 import traceback
 
 change_counters = {}
@@ -16,6 +32,23 @@ previous_first_selection = {}
 settings = None
 parse_error = 'XPath - error parsing XML at '
 html_cleaning_answer = {}
+parse_cache = None
+appendable_tree_builders = {}
+text_changes_since_fed = {} # view id -> the change count of the view when it's text changes were last recorded, and the earliest position modified since it's text was fed to it's appendable tree builder
+completions_executor = None
+running_completions = {} # tree or remote document -> the future evaluating completions for it, that was still running when the latency budget was exceeded
+window_query_executor = None
+query_history = None
+active_query_commands = {} # view id -> the query command that was most recently run in that view, so that it's results can be navigated
+document_server = None
+remote_documents = {} # view id -> region index -> the document that was parsed by the document server for that region, or None if it couldn't be parsed
+file_searches = {} # window id -> the find in files search that is running in that window
+region_parse_executor = None
+region_parser_pool = None
+pending_parses = {} # view id -> the roots of the trees being parsed from that view, the futures of the regions that are being parsed in the background, and those of the regions being parsed by the document server by region index
+trees_last_used = {} # view id -> when the trees parsed from that view were last used, so that the least recently used can be discarded when they use too much memory
+loaded_file_stats = {} # view id -> the file name, modification time and size of the file when it was last loaded into or saved from that view, so that it can be told whether the file still matches the view
+tree_cache_lock = threading.RLock() # guards the trees parsed from the views, as they are parsed from the main thread, the async thread and the background threads
 
 def settingsChanged():
     """Clear change counters and cached xpath regions for all views, and reparse xml regions for the current view."""
@@ -23,10 +56,35 @@ def settingsChanged():
     global xml_roots
     global xml_elements
     global previous_first_selection
-    change_counters.clear()
-    xml_roots.clear()
-    xml_elements.clear()
-    previous_first_selection.clear()
+    global parse_cache
+    global appendable_tree_builders
+    global text_changes_since_fed
+    global remote_documents
+    global trees_last_used
+    global pending_parses
+    global region_parse_executor
+    global region_parser_pool
+    with tree_cache_lock:
+        change_counters.clear()
+        xml_roots.clear()
+        xml_elements.clear()
+        previous_first_selection.clear()
+        parse_cache = None
+        appendable_tree_builders.clear()
+        text_changes_since_fed.clear()
+        remote_documents.clear()
+        trees_last_used.clear()
+        pending_parses.clear()
+    if region_parse_executor is not None: # it's size may have changed
+        region_parse_executor.shutdown(wait=False)
+        region_parse_executor = None
+    if region_parser_pool is not None:
+        region_parser_pool.close()
+        region_parser_pool = None
+    if document_server is not None:
+        document_server.kill() # the documents will be parsed again, so free the memory used by the old ones
+    performance_stats.set_enabled(settings.get('collect_performance_stats', False))
+    operation_profiler.configure(settings.get('profile_directory', '') or os.path.join(sublime.cache_path(), 'xpath', 'profiles'), float(settings.get('profile_slow_operations_ms', 0)), int(settings.get('profile_max_count', 20)))
     updateStatusToCurrentXPathIfSGML(sublime.active_window().active_view())
 
 def getSGMLRegions(view):
@@ -62,61 +120,441 @@ def isCursorInsideSGML(view):
     """Return True if at least one cursor is within XML or HTML syntax."""
     return next(getSGMLRegionsContainingCursors(view), None) is not None
 
-def buildTreesForView(view):
-    """Create an xml tree for each XML region in the specified view."""
-    trees = []
-    for region in getSGMLRegions(view):
-        trees.append(buildTreeForViewRegion(view, region))
-    return trees
+def buildTreesForView(view, parse_cursor_regions = True):
+    """Create an xml tree for each XML region in the specified view, returning lists of their roots and of all their nodes, which are filled in as the regions are parsed, the futures of the regions still being parsed, and those of the regions being parsed by the document server, by region index. Unless told not to, the regions containing cursors are parsed first, on this thread. Regions that are large enough are parsed by the document server instead, in the background, if it is enabled, and have no tree in the plugin host. The rest are parsed in the background - concurrently, in separate processes, if parallel_parsing_processes is set."""
+    global settings
+    server = get_document_server()
+    min_remote_size = int(settings.get('document_server_min_region_size', 10000000))
+
+    regions = getSGMLRegions(view)
+    roots = [None] * len(regions)
+    elements = [None] * len(regions)
+    change_count = view.change_count()
+    def parse_region(region_index, region_parser):
+        if view.change_count() != change_count: # the view has been modified since it's regions were found, so they will be parsed again
+            return
+        tree, all_elements = buildTreeForViewRegion(view, regions[region_index], region_parser)
+        elements[region_index] = all_elements
+        if tree is not None:
+            roots[region_index] = tree.getroot()
+
+    remote_region_indexes = [region_index for region_index, region in enumerate(regions) if server is not None and region.size() >= min_remote_size]
+    cursor_region_indexes = set(region_index for region, region_index, cursor in getSGMLRegionsContainingCursors(view) if region_index not in remote_region_indexes) if parse_cursor_regions else set()
+    for region_index in sorted(cursor_region_indexes):
+        parse_region(region_index, None)
+
+    global remote_documents
+    for region_index, document in remote_documents.pop(view.id(), {}).items():
+        if document is not None and region_index not in remote_region_indexes and document.is_current():
+            sublime.set_timeout_async(lambda document=document: releaseRemoteDocument(document), 0)
+    documents = {} # filled in as the document server parses the regions
+    if len(remote_region_indexes) > 0:
+        remote_documents[view.id()] = documents
+    def parse_remote_region(region_index):
+        if view.change_count() != change_count:
+            return
+        documents[region_index] = buildRemoteDocumentForViewRegion(view, regions[region_index], region_index, server)
+
+    region_parser = get_region_parser_pool()
+    futures = []
+    for region_index in range(0, len(regions)):
+        if region_index not in cursor_region_indexes and region_index not in remote_region_indexes:
+            futures.append(get_region_parse_executor().submit(parse_region, region_index, region_parser if regions[region_index].size() >= MIN_REGION_SIZE else None))
+    remote_futures = { region_index: get_region_parse_executor().submit(parse_remote_region, region_index) for region_index in remote_region_indexes } # submitted last, so that waiting for the other regions doesn't wait for the document server too
+    return (roots, elements, futures, remote_futures)
+
+def get_region_parse_executor():
+    """Return the thread pool that the regions without cursors are parsed on, creating it if necessary."""
+    global region_parse_executor
+    if region_parse_executor is None:
+        region_parse_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, int(settings.get('parallel_parsing_processes', 0))), thread_name_prefix='xpath_region_parse')
+    return region_parse_executor
+
+def get_region_parser_pool():
+    """Return the pool of processes that regions are parsed in concurrently if it is enabled, creating it if necessary, otherwise None."""
+    global settings
+    global region_parser_pool
+    python = settings.get('document_server_python', '')
+    processes = int(settings.get('parallel_parsing_processes', 0))
+    if not python or processes <= 0:
+        return None
+    if region_parser_pool is None:
+        region_parser_pool = RegionParserPool(python, processes, float(settings.get('document_server_timeout', 60)))
+    return region_parser_pool
+
+def get_document_server():
+    """Return the document server if it is enabled, creating it if necessary, otherwise None."""
+    global settings
+    global document_server
+    python = settings.get('document_server_python', '')
+    if not python:
+        return None
+    if document_server is None or document_server.python != python:
+        if document_server is not None:
+            document_server.close()
+        document_server = DocumentServer(python, 0)
+    document_server.timeout = float(settings.get('document_server_timeout', 60))
+    return document_server
+
+def buildRemoteDocumentForViewRegion(view, region_scope, region_index, server):
+    """Send the XML in the specified view region to the document server to be parsed, and return the document, or None if it couldn't be parsed."""
+    global settings
+    change_count = view.change_count()
+    document = RemoteDocument(server, str(view.id()) + ':' + str(region_index), region_scope.begin(), region_scope.end())
+    try:
+        document.parse(region_chunks(view, region_scope, RemoteDocument.CHUNK_SIZE), settings.get('default_namespace_prefix', 'default'))
+    except DocumentServerError as e:
+        print('XPath: unable to parse', view.file_name(), 'with the document server', repr(e))
+        view.set_status('xpath_error', 'XPath - document server error: ' + str(e))
+        return None
+    if document.error is not None:
+        if settings.get('show_xml_parser_errors', True) and view.change_count() == change_count: # the error may have been fixed since
+            showParseError(view, region_scope, *document.error)
+        return None
+    return document
+
+def releaseRemoteDocument(document):
+    """Free the memory used by the document in the document server."""
+    try:
+        document.request('release')
+    except DocumentServerError as e:
+        print('XPath: unable to release document', document.doc_id, repr(e))
+
+def remoteDocumentsAreCurrent(view):
+    """Return whether the document server still has all the documents that were parsed by it for the specified view."""
+    global remote_documents
+    return all(document is None or document.is_current() for document in list(remote_documents.get(view.id(), {}).values())) # copied, as the documents are added as they are parsed
+
+def get_remote_document_at(view, position):
+    """Return the document parsed by the document server that contains the given position in the view, or None."""
+    global remote_documents
+    return next((document for document in list(remote_documents.get(view.id(), {}).values()) if document is not None and document.contains(position)), None)
+
+def isParsingRemoteDocuments(view):
+    """Return whether any of the regions of the view are still being parsed by the document server."""
+    global pending_parses
+    pending = pending_parses.get(view.id(), None)
+    return pending is not None and not all(future.done() for future in pending[2].values())
+
+def get_remote_contexts_from_cursors(view, wait = True):
+    """Return the documents parsed by the document server that contain cursors, and the positions of those cursors. Unless told not to, wait for the regions still being parsed by the document server, so it should only be called from the async thread then, otherwise those documents are left out."""
+    ensureTreeCacheIsCurrent(view, wait)
+    global pending_parses
+    pending = pending_parses.get(view.id(), None)
+    if wait and pending is not None:
+        waitForRegionsToBeParsed(pending[2].values())
+    global remote_documents
+    documents = remote_documents.get(view.id(), {})
+    contexts = collections.OrderedDict()
+    for region, region_index, cursor in getSGMLRegionsContainingCursors(view):
+        document = documents.get(region_index, None)
+        if document is not None:
+            contexts.setdefault(document, []).append(cursor.begin())
+    return contexts
+
+def merge_remote_items_by_region(local_items, local_position, remote_items):
+    """Merge the items from the documents parsed by the document server, given as (document, items) pairs, into the local items, which are in document order, so that all of them are in the order of the regions they are from. As the regions don't overlap, each document's items are inserted before the first local item that is positioned after the start of the document. If any local item has no position, i.e. it isn't part of the document, the remote items are appended instead."""
+    if len(remote_items) == 0:
+        return local_items
+    positions = [local_position(item) for item in local_items]
+    if None in positions:
+        return local_items + [item for document, items in remote_items for item in items]
+    merged = []
+    start = 0
+    for document, items in sorted(remote_items, key=lambda pair: pair[0].begin):
+        index = bisect.bisect_left(positions, document.begin, start)
+        merged += local_items[start:index]
+        merged += items
+        start = index
+    return merged + local_items[start:]
+
+def local_result_position(result):
+    """Return the position in the view of the given result of a local query, or None if it isn't part of the document."""
+    node = result.getparent() if isinstance(result, etree._ElementUnicodeResult) else result
+    if not isinstance(node, (etree.ElementBase, etree.CommentBase, etree.PIBase)):
+        return None
+    return getNodeTagRange(node, 'open')[0]
+
+def getParseCacheForViewRegion(view, region_scope):
+    """Return the on-disk parse cache if it is enabled and applicable to the specified view region, otherwise None."""
+    global settings
+    if not settings.get('parse_cache', True) or view.file_name() is None or view.is_dirty():
+        return None
+    if region_scope.size() < int(settings.get('parse_cache_min_region_size', 1000000)) or not os.path.isfile(view.file_name()):
+        return None
+
+    global parse_cache
+    if parse_cache is None:
+        parse_cache = ParseCache(os.path.join(sublime.cache_path(), 'xpath'), int(settings.get('parse_cache_max_size_mb', 256)) * 1024 * 1024)
+    return parse_cache
+
+def storeTreeInParseCache(view, cache, cache_key, change_count, tree, all_elements):
+    """Store the parsed tree in the on-disk parse cache, if the view hasn't been modified since it was parsed."""
+    if view.change_count() != change_count or view.is_dirty():
+        return
+    try:
+        cache.store(*cache_key, serialize_tree_with_location(tree, all_elements))
+    except OSError as e:
+        print('XPath: unable to store parsed tree in cache for', view.file_name(), repr(e))
+
+def isAppendOnlyChange(view, region_scope, builder):
+    """Return True if the text that was fed to the builder is still present, unchanged, at the beginning of the specified view region, according to the text changes recorded since it was fed."""
+    if region_scope.begin() != builder.begin_offset or region_scope.end() < builder.end_offset:
+        return False
+    seen_change_count, earliest_change = text_changes_since_fed.get(view.id(), (None, None))
+    if seen_change_count is None or seen_change_count < view.change_count(): # some changes haven't been recorded yet
+        return False
+    if earliest_change < builder.end_offset:
+        return False
+    return view.substr(sublime.Region(builder.end_offset - len(builder.tail), builder.end_offset)) == builder.tail # in case a change was made while no listener was attached to the buffer
+
+def buildTreeForViewRegionIncrementally(view, region_scope, stop):
+    """Create an xml tree for the XML in the specified view region, parsing only the text appended to it since it was last parsed if nothing else has changed."""
+    global appendable_tree_builders
+    global text_changes_since_fed
+    builder = appendable_tree_builders.pop(view.id(), None)
+    if builder is None or not isAppendOnlyChange(view, region_scope, builder):
+        builder = AppendableTreeBuilder(position_offset=region_scope.begin(), collect_ids=False, huge_tree=True, remove_blank_text=False)
+
+    text_changes_since_fed[view.id()] = (view.change_count(), float('inf')) # changes made while the text is being fed are recorded too
+    for chunk in region_chunks(view, sublime.Region(builder.end_offset, region_scope.end()), 8096):
+        if stop is not None and stop():
+            return (None, None) # the builder has been fed text that is no longer current, so it can't be used again
+        builder.feed(chunk)
+
+    appendable_tree_builders[view.id()] = builder
+    tree, all_elements = builder.current_tree()
+    if tree is not None:
+        clearDerivedTreeData(tree.getroot())
+    return (tree, all_elements)
+
+def clearDerivedTreeData(root):
+    """Remove data cached on the root element that was derived from the tree, because the tree has changed."""
+    for attribute in ('unique_namespaces', 'structure_summary', 'value_index'):
+        if hasattr(root, attribute):
+            delattr(root, attribute)
 
-def buildTreeForViewRegion(view, region_scope):
-    """Create an xml tree for the XML in the specified view region."""
+def buildTreeForViewRegion(view, region_scope, region_parser = None):
+    """Create an xml tree for the XML in the specified view region, parsing it in one of the region parser's processes if given."""
     tree = None
     all_elements = None
     change_count = view.change_count()
     stop = lambda: change_count < view.change_count() # stop parsing if the document is modified
     if view.is_read_only():
         stop = None # no need to check for modifications if the view is read only
+
+    global settings
+    incremental = settings.get('incremental_parsing', False) and region_scope.end() == view.size() # only text appended to the end of the view can be parsed incrementally
+
+    cache = None
+    if not incremental:
+        cache = getParseCacheForViewRegion(view, region_scope)
+    cache_key = (view.file_name(), (region_scope.begin(), region_scope.end()), view.encoding())
+    if cache is not None:
+        try:
+            with performance_stats.measure(view, 'parse_cache_load'):
+                serialized = cache.load(*cache_key)
+                if serialized is not None:
+                    performance_stats.increment(view, 'parse_cache_hits')
+                    return deserialize_tree_with_location(serialized)
+            performance_stats.increment(view, 'parse_cache_misses')
+        except (OSError, ValueError, etree.XMLSyntaxError) as e:
+            print('XPath: unable to load parsed tree from cache for', view.file_name(), repr(e))
+
     try:
-        tree, all_elements = lxml_etree_parse_xml_string_with_location(region_chunks(view, region_scope, 8096), region_scope.begin(), stop)
+        with performance_stats.measure(view, 'parse'), operation_profiler.profile('parse', lambda: dict(getProfileDetailsForView(view), region_characters=region_scope.size(), region_nodes=len(all_elements) if all_elements is not None else None)):
+            if region_parser is not None and not incremental:
+                try:
+                    tree, all_elements = region_parser.parse(view.substr(region_scope), region_scope.begin())
+                except DocumentServerError as e: # i.e. the process couldn't be started
+                    print('XPath: unable to parse', view.file_name(), 'in a separate process, parsing it in the plugin host instead', repr(e))
+            mapped_file = getMappedFileForViewRegion(view, region_scope) if region_parser is None and not incremental else None
+            if incremental:
+                tree, all_elements = buildTreeForViewRegionIncrementally(view, region_scope, stop)
+            elif mapped_file is not None:
+                with mapped_file:
+                    tree, all_elements = lxml_etree_parse_xml_buffer_with_location(mapped_file.buffer, mapped_file.index, region_scope.begin(), stop)
+            elif tree is None:
+                tree, all_elements = lxml_etree_parse_xml_string_with_location(region_chunks(view, region_scope, 8096), region_scope.begin(), stop)
+        if cache is not None:
+            sublime.set_timeout_async(lambda: storeTreeInParseCache(view, cache, cache_key, change_count, tree, all_elements), 0) # store it after the status bar has been updated
     except etree.XMLSyntaxError as e:
-        global settings
-        show_parse_errors = settings.get('show_xml_parser_errors', True)
+        show_parse_errors = settings.get('show_xml_parser_errors', True) and view.change_count() == change_count # the error may have been fixed since
         if show_parse_errors:
-            global parse_error
-            offset = view.rowcol(region_scope.begin())
             log_entry = e.error_log[0]
-            text = 'line ' + str(log_entry.line + offset[0]) + ', column ' + str(log_entry.column + offset[1]) + ' - ' + log_entry.message
-            view.set_status('xpath_error', parse_error + text)
+            showParseError(view, region_scope, log_entry.line, log_entry.column, log_entry.message)
+    except RegionParseError as e:
+        if settings.get('show_xml_parser_errors', True) and view.change_count() == change_count:
+            showParseError(view, region_scope, *e.args)
 
     return (tree, all_elements)
 
-def ensureTreeCacheIsCurrent(view):
-    """If the document has been modified since the xml was parsed, parse it again to recreate the trees."""
-    global change_counters
-    new_count = view.change_count()
-    old_count = change_counters.get(view.id(), None)
+def getMappedFileForViewRegion(view, region_scope):
+    """If the region is the whole of a view that is an unmodified copy of a UTF-8 file, whose modification time and size are still those recorded when it was loaded or saved, at least as large as the memory_mapped_parsing_min_size setting, return the file mapped into memory, so that it can be parsed directly instead of taking the text from the view. Otherwise return None."""
+    global settings
+    min_size = int(settings.get('memory_mapped_parsing_min_size', 1000000))
+    file_name = view.file_name()
+    if min_size <= 0 or view.size() < min_size or file_name is None or view.is_dirty() or view.encoding() not in ('UTF-8', 'UTF-8 with BOM'):
+        return None
+    if region_scope.begin() != 0 or region_scope.end() != view.size():
+        return None
+
+    global loaded_file_stats
+    recorded = loaded_file_stats.get(view.id(), None)
+    try:
+        stat = os.stat(file_name)
+        if recorded != (file_name, stat.st_mtime_ns, stat.st_size): # the file has changed since it was loaded into the view, or it wasn't loaded while the plugin was running
+            return None
+        mapped_file = MappedFile(file_name)
+    except (OSError, ValueError) as e: # i.e. the file was deleted or is empty
+        print('XPath: unable to map', file_name, 'into memory, parsing the text of the view instead', repr(e))
+        return None
+    sample_length = 256
+    if len(mapped_file.buffer) != recorded[2] or mapped_file.index.characters != view.size() or mapped_file.text_sample(sample_length) != view.substr(sublime.Region(0, sample_length)) or mapped_file.text_sample(sample_length, True) != view.substr(sublime.Region(max(0, view.size() - sample_length), view.size())):
+        mapped_file.close() # the file has changed since it was loaded into the view
+        return None
+    return mapped_file
+
+def recordLoadedFileStat(view):
+    """Remember the modification time and size of the view's file, when it has just been loaded into or saved from the view, so that it can be parsed directly while it still matches them."""
+    global loaded_file_stats
+    file_name = view.file_name()
+    try:
+        stat = os.stat(file_name) if file_name is not None else None
+    except OSError:
+        stat = None
+    if stat is None:
+        loaded_file_stats.pop(view.id(), None)
+    else:
+        loaded_file_stats[view.id()] = (file_name, stat.st_mtime_ns, stat.st_size)
 
+def showParseError(view, region_scope, line, column, message):
+    """Show the error that was encountered at the given line and column, relative to the start of the region, while parsing the XML in the view region."""
+    global parse_error
+    offset = view.rowcol(region_scope.begin())
+    text = 'line ' + str(line + offset[0]) + ', column ' + str(column + offset[1]) + ' - ' + message
+    view.set_status('xpath_error', parse_error + text)
+
+def ensureTreeCacheIsCurrent(view, wait = True, parse_cursor_regions = True):
+    """If the document has been modified since the xml was parsed, parse it again to recreate the trees. Unless told to wait for all of them, return as soon as the regions containing cursors have been parsed, or straight away if told not to parse those first, with None for the roots of the regions that are still being parsed in the background."""
+    global change_counters
     global xml_roots
     global xml_elements
-    if old_count is None or new_count > old_count:
-        change_counters[view.id()] = new_count
-        view.set_status('xpath', 'XML being parsed...')
-        view.erase_status('xpath_error')
+    global trees_last_used
+    global pending_parses
+    with tree_cache_lock: # so that a view isn't parsed on two threads at once, and the trees of other views aren't discarded while they are being changed
+        new_count = view.change_count()
+        old_count = change_counters.get(view.id(), None)
+        roots = xml_roots.get(view.id(), None)
+        if roots is None or old_count is None or new_count > old_count or not remoteDocumentsAreCurrent(view): # the trees may also have been discarded to free memory
+            performance_stats.increment(view, 'tree_cache_misses')
+            change_counters[view.id()] = new_count
+            view.set_status('xpath', 'XML being parsed...')
+            view.erase_status('xpath_error')
+
+            cancelParsingInBackground(pending_parses.pop(view.id(), None))
+            roots, elements, futures, remote_futures = buildTreesForView(view, parse_cursor_regions)
+            pending_parses[view.id()] = (roots, futures, remote_futures)
+            xml_roots[view.id()] = roots
+            xml_elements[view.id()] = elements
+
+            view.erase_status('xpath')
+            if len(futures) + len(remote_futures) > 0:
+                view.set_status('xpath_parsing', 'XPath: parsing ' + str(len(futures) + len(remote_futures)) + ' more XML regions')
+                for future in futures + list(remote_futures.values()):
+                    future.add_done_callback(lambda future: finishParsingInBackground(view, roots))
+            else:
+                finishParsingInBackground(view, roots)
+            global previous_first_selection
+            previous_first_selection[view.id()] = None
+            discardLeastRecentlyUsedTrees(view)
+        else:
+            performance_stats.increment(view, 'tree_cache_hits')
+        trees_last_used[view.id()] = time.monotonic()
+        pending = pending_parses.get(view.id(), None)
+
+    if wait and pending is not None and pending[0] is roots:
+        waitForRegionsToBeParsed(pending[1])
+    return roots
+
+def waitForRegionsToBeParsed(futures):
+    """Wait for the regions being parsed in the background, other than those that were cancelled because the view is being parsed again."""
+    for future in futures:
+        try:
+            future.result()
+        except concurrent.futures.CancelledError:
+            pass
+
+def cancelParsingInBackground(pending):
+    """Cancel parsing the regions of a view that haven't started being parsed yet, because the trees they would be parsed into are no longer current."""
+    if pending is not None:
+        for future in pending[1] + list(pending[2].values()):
+            future.cancel()
+
+def isParsingInBackground(view):
+    """Return whether any of the regions of the view are still being parsed in the background, including by the document server."""
+    global pending_parses
+    pending = pending_parses.get(view.id(), None)
+    return pending is not None and not all(future.done() for future in pending[1] + list(pending[2].values()))
+
+def finishParsingInBackground(view, roots):
+    """Once all the regions of the view that were being parsed in the background have been, forget them, and update the status bar."""
+    global pending_parses
+    with tree_cache_lock:
+        pending = pending_parses.get(view.id(), None)
+        if pending is None or pending[0] is not roots or not all(future.done() for future in pending[1] + list(pending[2].values())):
+            return
+        pending_parses.pop(view.id(), None)
+    view.erase_status('xpath_parsing')
+    sublime.set_timeout_async(lambda: updateStatusToCurrentXPathIfSGML(view), 0) # in case the cursor was moved to one of the regions while it was being parsed
 
-        xml_roots[view.id()] = []
-        xml_elements[view.id()] = []
-        for tree, all_elements in buildTreesForView(view):
-            root = None
-            if tree is not None:
-                root = tree.getroot()
-            xml_roots[view.id()].append(root)
-            xml_elements[view.id()].append(all_elements)
+def discardParsedTreesOfView(view_id):
+    """Forget the trees parsed from the view, so that they will be parsed again when they are next needed."""
+    global change_counters
+    global xml_roots
+    global xml_elements
+    global previous_first_selection
+    global appendable_tree_builders
+    global text_changes_since_fed
+    global trees_last_used
+    global pending_parses
+    with tree_cache_lock:
+        change_counters.pop(view_id, None)
+        xml_roots.pop(view_id, None)
+        xml_elements.pop(view_id, None)
+        previous_first_selection.pop(view_id, None)
+        appendable_tree_builders.pop(view_id, None)
+        text_changes_since_fed.pop(view_id, None)
+        trees_last_used.pop(view_id, None)
+        cancelParsingInBackground(pending_parses.pop(view_id, None))
+
+def getMemoryUsageOfParsedTrees():
+    """Return the estimated memory used by the trees parsed from each view, as a dictionary of view id to a list of the number of nodes in, and memory usage of, each tree, or None for regions that weren't parsed in the plugin host."""
+    global xml_roots
+    global xml_elements
+    usage = {}
+    for view_id, roots in list(xml_roots.items()): # copied, as regions are parsed in the background
+        usage[view_id] = [None if all_elements is None else (len(all_elements), tree_memory_usage(root, all_elements)) for root, all_elements in zip(roots, xml_elements.get(view_id, []))]
+    return usage
 
-        view.erase_status('xpath')
-        global previous_first_selection
-        previous_first_selection[view.id()] = None
-    return xml_roots[view.id()]
+def discardLeastRecentlyUsedTrees(current_view):
+    """If the trees parsed from all the views are estimated to use more memory than the max_parsed_trees_mb setting allows, discard those of the least recently used views, other than the current one, until they don't."""
+    global settings
+    limit = float(settings.get('max_parsed_trees_mb', 0)) * 1024 * 1024
+    if limit <= 0:
+        return
+    global trees_last_used
+    global remote_documents
+    with tree_cache_lock:
+        usage = { view_id: sum(sum(tree[1].values()) for tree in trees if tree is not None) for view_id, trees in getMemoryUsageOfParsedTrees().items() }
+        total = sum(usage.values())
+        for view_id in sorted(usage.keys(), key=lambda view_id: trees_last_used.get(view_id, 0)):
+            if total <= limit:
+                break
+            if view_id == current_view.id() or view_id in remote_documents: # the documents parsed by the document server would be parsed again too
+                continue
+            discardParsedTreesOfView(view_id)
+            total -= usage[view_id]
 
 class GotoXmlParseErrorCommand(sublime_plugin.TextCommand):
     def run(self, edit, **args):
@@ -138,112 +576,23 @@ class GotoXmlParseErrorCommand(sublime_plugin.TextCommand):
     def is_visible(self, **args):
         return containsSGML(self.view)
 
-def getXPathOfNodes(nodes, args):
+def getXPathOptions(args):
+    """Return the options for generating XPaths, from the args if present, otherwise the settings."""
     include_indexes = not getBoolValueFromArgsOrSettings('show_hierarchy_only', args, False)
-    unique = getBoolValueFromArgsOrSettings('copy_unique_path_only', args, True)
-    include_attributes = include_indexes or getBoolValueFromArgsOrSettings('show_attributes_in_hierarchy', args, False)
-    show_namespace_prefixes_from_query = getBoolValueFromArgsOrSettings('show_namespace_prefixes_from_query', args, True)
-    case_sensitive = getBoolValueFromArgsOrSettings('case_sensitive', args, True)
-    all_attributes = getBoolValueFromArgsOrSettings('show_all_attributes', args, False)
-
     global settings
-    wanted_attributes = settings.get('attributes_to_include', [])
-    if not case_sensitive:
-        wanted_attributes = [attrib.lower() for attrib in wanted_attributes]
-
-    def getTagNameWithMappedPrefix(node, namespaces):
-        tag = getTagName(node)
-        if show_namespace_prefixes_from_query and tag[0] is not None: # if the element belongs to a namespace
-            unique_prefix = next((prefix for prefix in namespaces.keys() if namespaces[prefix] == (tag[0], node.prefix or '')), None) # find the first prefix in the map that relates to this uri
-            if unique_prefix is not None:
-                tag = (tag[0], tag[1], unique_prefix + ':' + tag[1]) # ensure that the path we display can be used to query the element
-
-        if not case_sensitive:
-            tag = (tag[0], tag[1].lower(), tag[2].lower())
-
-        return tag
-
-    def getNodePathPart(node, namespaces):
-        tag = getTagNameWithMappedPrefix(node, namespaces)
-
-        output = tag[2]
-
-        if include_indexes:
-            siblings = node.itersiblings(preceding = True)
-            index = 1
-
-            def compare(sibling):
-                if not isinstance(sibling, LocationAwareElement): # skip comments
-                    return False
-                sibling_tag = getTagNameWithMappedPrefix(sibling, namespaces)
-                return sibling_tag == tag # namespace uri, prefix and tag name must all match
-
-            for sibling in siblings:
-                if compare(sibling):
-                    index += 1
-
-            # if there are no previous sibling matches, check next siblings to see if we should index this node
-            multiple = index > 1
-            if not multiple:
-                siblings = node.itersiblings()
-                for sibling in siblings:
-                    if compare(sibling):
-                        multiple = True
-                        break
-
-            if multiple:
-                output += '[' + str(index) + ']'
-
-        if include_attributes:
-            attributes_to_show = []
-            for attr_name in node.attrib:
-                include_attribue = False
-                if all_attributes:
-                    include_attribute = True
-                else:
-                    if not case_sensitive:
-                        attr_name = attr_name.lower()
-                    attr = attr_name.split(':')
-                    include_attribute = attr_name in wanted_attributes
-                    if not include_attribue and len(attr) == 2:
-                        include_attribue = attr[0] + ':*' in wanted_attributes or '*:' + attr[1] in wanted_attributes
-
-                if include_attribute:
-                    attributes_to_show.append('@' + attr_name + ' = "' + node.get(attr_name) + '"')
-
-            if len(attributes_to_show) > 0:
-                output += '[' + ' and '.join(attributes_to_show) + ']'
-
-        return output
-
-    def getNodePathSegments(node, namespaces, root):
-        if isinstance(node, etree.CommentBase):
-            node = node.getparent()
-        while node != root:
-            yield getNodePathPart(node, namespaces)
-            node = node.getparent()
-        yield getNodePathPart(node, namespaces)
-        yield ''
-
-    def getNodePath(node, namespaces, root):
-        return '/'.join(reversed(list(getNodePathSegments(node, namespaces, root))))
-
-    roots = {}
-    for node in nodes:
-        tree = node.getroottree()
-        root = tree.getroot()
-        roots.setdefault(root, []).append(node)
+    return {
+        'include_indexes': include_indexes,
+        'include_attributes': include_indexes or getBoolValueFromArgsOrSettings('show_attributes_in_hierarchy', args, False),
+        'show_namespace_prefixes_from_query': getBoolValueFromArgsOrSettings('show_namespace_prefixes_from_query', args, True),
+        'case_sensitive': getBoolValueFromArgsOrSettings('case_sensitive', args, True),
+        'all_attributes': getBoolValueFromArgsOrSettings('show_all_attributes', args, False),
+        'wanted_attributes': settings.get('attributes_to_include', [])
+    }
 
-    paths = []
-    for root in roots.keys():
-        for node in roots[root]:
-            namespaces = None
-            if show_namespace_prefixes_from_query:
-                namespaces = namespace_map_for_tree(root.getroottree())
-
-            paths.append(getNodePath(node, namespaces, root))
+def getXPathOfNodes(nodes, args):
+    paths = getNodePaths(nodes, namespace_map_for_tree, **getXPathOptions(args))
 
-    if unique:
+    if getBoolValueFromArgsOrSettings('copy_unique_path_only', args, True):
         paths = list(getUniqueItems(paths))
 
     return paths
@@ -252,12 +601,13 @@ def getExactXPathOfNodes(nodes):
     args = { 'show_namespace_prefixes_from_query': True, 'show_hierarchy_only': False, 'case_sensitive': True } # ensure the exact node path is returned
     return getXPathOfNodes(nodes, args)
 
+@operation_profiler.profile_if_slow('update_status', lambda view: getProfileDetailsForView(view))
 def updateStatusToCurrentXPathIfSGML(view):
     """Update the status bar with the relevant xpath at the first cursor."""
     status = None
     if isCursorInsideSGML(view):
         if not getBoolValueFromArgsOrSettings('only_show_xpath_if_saved', None, False) or not view.is_dirty() or view.is_read_only():
-            trees = ensureTreeCacheIsCurrent(view)
+            trees = ensureTreeCacheIsCurrent(view, False) # the status can be shown as soon as the region containing the cursor has been parsed
             if trees is None: # don't hide parse errors by overwriting status
                 return
             else:
@@ -267,17 +617,26 @@ def updateStatusToCurrentXPathIfSGML(view):
                 
                 current_first_sel = view.sel()[0]
                 nodes = []
-                if prev is not None and regionIntersects(prev[0], sublime.Region(current_first_sel.begin(), current_first_sel.begin()), False): # current first selection matches xpath region from previous first selection
-                    nodes.append(prev[1])
-                else: # current first selection doesn't match xpath region from previous first selection or is not cached
-                    results = getNodesAtPositions(view, trees, [current_first_sel]) # get nodes at first selection
-                    if len(results) > 0:
-                        result = results[0]
-                        previous_first_selection[view.id()] = (sublime.Region(result[2], result[3]), result[0]) # cache node and xpath region
-                        nodes.append(result[0])
-
-                # calculate xpath of node
-                xpaths = getXPathOfNodes(nodes, None)
+                remote_document = get_remote_document_at(view, current_first_sel.begin())
+                if remote_document is not None: # the node is in a document parsed by the document server, so ask it for the xpath
+                    try:
+                        xpaths = [xpath for xpath in remote_document.request('paths', [current_first_sel.begin()], getXPathOptions(None)) if xpath is not None]
+                    except DocumentServerError as e:
+                        print('XPath: unable to get the xpath at the cursor from the document server', repr(e))
+                        xpaths = []
+                else:
+                    if prev is not None and regionIntersects(prev[0], sublime.Region(current_first_sel.begin(), current_first_sel.begin()), False): # current first selection matches xpath region from previous first selection
+                        nodes.append(prev[1])
+                    else: # current first selection doesn't match xpath region from previous first selection or is not cached
+                        results = getNodesAtPositions(view, trees, [current_first_sel]) # get nodes at first selection
+                        if len(results) > 0:
+                            result = results[0]
+                            previous_first_selection[view.id()] = (sublime.Region(result[2], result[3]), result[0]) # cache node and xpath region
+                            nodes.append(result[0])
+
+                    # calculate xpath of node
+                    with performance_stats.measure(view, 'xpath_generation'):
+                        xpaths = getXPathOfNodes(nodes, None)
                 if len(xpaths) == 1:
                     xpath = xpaths[0]
                     intro = 'XPath'
@@ -306,19 +665,35 @@ def copyXPathsToClipboard(view, args):
             for result in getSGMLRegionsContainingCursors(view):
                 cursors.append(result[2])
             results = getNodesAtPositions(view, roots, cursors)
-            paths = getXPathOfNodes([result[0] for result in results], args)
-
-            if len(paths) > 0:
-                sublime.set_clipboard(os.linesep.join(paths))
-                message = str(len(paths)) + ' xpath(s) copied to clipboard'
-            else:
-                message = 'no xpath at cursor to copy to clipboard'
+            with performance_stats.measure(view, 'xpath_generation'):
+                paths = getXPathOfNodes([result[0] for result in results], args)
+            global remote_documents
+            if view.id() in remote_documents: # the document server may take a while to respond, so ask it from the async thread
+                sublime.set_timeout_async(lambda: copyRemoteXPathsToClipboard(view, args, paths), 0)
+                return
+            message = copyPathsToClipboard(paths)
         else:
             message = 'xml is not valid, unable to copy xpaths to clipboard'
     else:
         message = 'xpath not copied to clipboard - ensure syntax is set to xml or html'
     sublime.status_message(message)
 
+def copyRemoteXPathsToClipboard(view, args, paths):
+    """Copy the XPath(s) at the cursor(s) to the clipboard, after adding those at the cursors in the documents parsed by the document server to the given ones."""
+    try:
+        for document, positions in get_remote_contexts_from_cursors(view).items():
+            paths += [path for path in document.request('paths', positions, getXPathOptions(args)) if path is not None and path not in paths]
+    except DocumentServerError as e:
+        print('XPath: unable to get the xpaths at the cursors from the document server', repr(e))
+    sublime.status_message(copyPathsToClipboard(paths))
+
+def copyPathsToClipboard(paths):
+    """Copy the given paths to the clipboard, and return a message saying how many were copied."""
+    if len(paths) == 0:
+        return 'no xpath at cursor to copy to clipboard'
+    sublime.set_clipboard(os.linesep.join(paths))
+    return str(len(paths)) + ' xpath(s) copied to clipboard'
+
 class CopyXpathCommand(sublime_plugin.TextCommand): # example usage from python console: sublime.active_window().active_view().run_command('copy_xpath', { 'show_hierarchy_only': True })
     def run(self, edit, **args):
         """Copy XPath(s) at cursor(s) to clipboard."""
@@ -400,12 +775,22 @@ def getBoolValueFromArgsOrSettings(key, args, default):
 
 def getUniqueItems(items):
     """Return the items without any duplicates, preserving order."""
-    unique = []
+    unique = set()
     for item in items:
         if item not in unique:
-            unique.append(item)
+            unique.add(item)
             yield item
 
+class XpathTextChangeListener(sublime_plugin.TextChangeListener):
+    """Record the earliest position modified in each view whose text has been fed to an appendable tree builder, so that text appended to it can be told apart from other changes without reading the text that was already parsed."""
+    def on_text_changed(self, changes):
+        global text_changes_since_fed
+        earliest_change = min(change.a.pt for change in changes)
+        for view in self.buffer.views():
+            recorded = text_changes_since_fed.get(view.id(), None)
+            if recorded is not None:
+                text_changes_since_fed[view.id()] = (view.change_count(), min(recorded[1], earliest_change))
+
 class XpathListener(sublime_plugin.EventListener):
     def on_selection_modified_async(self, view):
         updateStatusToCurrentXPathIfSGML(view)
@@ -417,15 +802,29 @@ class XpathListener(sublime_plugin.EventListener):
         if getBoolValueFromArgsOrSettings('only_show_xpath_if_saved', None, False):
             updateStatusToCurrentXPathIfSGML(view)
 
+    def on_load(self, view):
+        recordLoadedFileStat(view)
+
+    def on_reload(self, view):
+        recordLoadedFileStat(view)
+
+    def on_revert(self, view):
+        recordLoadedFileStat(view)
+
+    def on_post_save(self, view):
+        recordLoadedFileStat(view)
+
     def on_pre_close(self, view):
-        global change_counters
-        global xml_roots
-        global xml_elements
-        global previous_first_selection
-        change_counters.pop(view.id(), None)
-        xml_roots.pop(view.id(), None)
-        xml_elements.pop(view.id(), None)
-        previous_first_selection.pop(view.id(), None)
+        global active_query_commands
+        global remote_documents
+        global loaded_file_stats
+        discardParsedTreesOfView(view.id())
+        loaded_file_stats.pop(view.id(), None)
+        active_query_commands.pop(view.id(), None)
+        performance_stats.forget(view)
+        for document in remote_documents.pop(view.id(), {}).values():
+            if document is not None and document.is_current():
+                sublime.set_timeout_async(lambda document=document: releaseRemoteDocument(document), 0)
 
         if view.file_name() is None: # if the file has no filename associated with it
             if view.settings().get('xpath_test_file', None):
@@ -435,76 +834,6 @@ class XpathListener(sublime_plugin.EventListener):
             #else:
             change_key_for_xpath_query_history(get_history_key_for_view(view), 'global')
 
-def register_xpath_extensions():
-    # http://lxml.de/extensions.html
-    ns = etree.FunctionNamespace(None)
-
-    def applyFuncToTextForItem(item, func):
-        if isinstance(item, etree._Element):
-            return func(item.xpath('string(.)'))
-        else:
-            return func(str(item))
-
-    # TODO: xpath 1 functions deal with lists by just taking the first node
-    #     - maybe we can provide optional arg to return nodeset by applying to all
-    def applyTransformFuncToTextForItems(nodes, func):
-        """If a nodeset is given, apply the transformation function to each item."""
-        if isinstance(nodes, list):
-            return [applyFuncToTextForItem(item, func) for item in nodes]
-        else:
-            return applyFuncToTextForItem(nodes, func)
-
-    def applyFilterFuncToTextForItems(nodes, func):
-        """If a nodeset is given, filter out items whose transformation function returns False.  Otherwise, return the value from the predicate."""
-        if isinstance(nodes, list):
-            return [item for item in nodes if applyFuncToTextForItem(item, func)]
-        else:
-            return applyFuncToTextForItem(nodes, func)
-
-    def printValueAndReturnUnchanged(context, nodes, title = None):
-        print_value = nodes
-        if isinstance(nodes, list):
-            if len(nodes) > 0 and isinstance(nodes[0], etree._Element):
-                paths = getExactXPathOfNodes(nodes)
-                print_value = paths
-
-        if title is None:
-            title = ''
-        else:
-            title = title + ':'
-        print('XPath:', title, 'context_node', getExactXPathOfNodes([context.context_node])[0], 'eval_context', context.eval_context, 'values', print_value)
-        return nodes
-
-    ns['upper-case'] = lambda context, nodes: applyTransformFuncToTextForItems(nodes, str.upper)
-    ns['lower-case'] = lambda context, nodes: applyTransformFuncToTextForItems(nodes, str.lower)
-    ns['ends-with'] = lambda context, nodes, ending: applyFilterFuncToTextForItems(nodes, lambda item: item.endswith(ending))
-    #ns['trim'] = lambda context, nodes: applyTransformFuncToTextForItems(nodes, str.strip) # according to the XPath 1.0 spec, the built in normalize-space function will trim the text on both sides, making this unnecessary http://www.w3.org/TR/xpath/#function-normalize-space
-    ns['print'] = printValueAndReturnUnchanged
-
-    def xpathRegexFlagsToPythonRegexFlags(xpath_regex_flags):
-        flags = 0
-        if 's' in xpath_regex_flags:
-            flags = flags | re.DOTALL
-        if 'm' in xpath_regex_flags:
-            flags = flags | re.MULTILINE
-        if 'i' in xpath_regex_flags:
-            flags = flags | re.IGNORECASE
-        if 'x' in xpath_regex_flags:
-            flags = flags | re.VERBOSE
-
-        return flags
-
-    ns['tokenize'] = lambda context, item, pattern, xpath_regex_flags = None: applyFuncToTextForItem(item, lambda text: re.split(pattern, text, maxsplit = 0, flags = xpathRegexFlagsToPythonRegexFlags(xpath_regex_flags)))
-    ns['matches'] = lambda context, item, pattern, xpath_regex_flags = None: applyFuncToTextForItem(item, lambda text: re.search(pattern, text, flags = xpathRegexFlagsToPythonRegexFlags(xpath_regex_flags)) is not None)
-    # replace
-    # avg
-    # min
-    # max
-    # abs
-    # ? adjust-dateTime-to-timezone, current-dateTime, day-from-dateTime, month-from-dateTime, days-from-duration, months-from-duration, etc.
-    # insert-before, remove, subsequence, index-of, distinct-values, reverse, unordered, empty, exists
-
-
 def plugin_loaded():
     """When the plugin is loaded, clear all variables and cache xpaths for current view if applicable."""
     global settings
@@ -513,7 +842,7 @@ def plugin_loaded():
     settings.add_on_change('reparse', settingsChanged)
     sublime.set_timeout_async(settingsChanged, 10)
 
-    register_xpath_extensions()
+    register_xpath_extensions(getExactXPathOfNodes)
 
 def plugin_unloaded():
     for view in sublime.active_window().views():
@@ -522,39 +851,116 @@ def plugin_unloaded():
     global settings
     settings.clear_on_change('reparse')
 
-def get_results_for_xpath_query_multiple_trees(query, tree_contexts, root_namespaces, **additional_variables):
-    """Given a query string and a dictionary of document trees and their context elements, compile the xpath query and execute it for each document."""
+    global completions_executor
+    global running_completions
+    if completions_executor is not None:
+        completions_executor.shutdown(wait=False)
+        completions_executor = None
+    running_completions.clear()
+
+    global window_query_executor
+    if window_query_executor is not None:
+        window_query_executor.shutdown(wait=False)
+        window_query_executor = None
+
+    global region_parse_executor
+    if region_parse_executor is not None:
+        region_parse_executor.shutdown(wait=False)
+        region_parse_executor = None
+
+    global region_parser_pool
+    if region_parser_pool is not None:
+        region_parser_pool.close()
+        region_parser_pool = None
+
+    global query_history
+    if query_history is not None:
+        query_history.close()
+        query_history = None
+
+    global document_server
+    if document_server is not None:
+        document_server.close()
+        document_server = None
+
+def get_results_for_xpath_query_multiple_trees(query, tree_contexts, root_namespaces, view = None, **additional_variables):
+    """Given a query string and a dictionary of document trees and their context elements, compile the xpath query and execute it for each document, returning the results in document order. The time taken is recorded against the view, if given."""
     matches = []
     global settings
     variables = settings.get('variables', {})
     for key in additional_variables:
         variables[key] = additional_variables[key]
 
-    for tree in tree_contexts.keys():
+    trees = sorted(tree_contexts.keys(), key=lambda tree: getNodeTagRange(tree.getroot(), 'open')[0]) # in the order the trees appear in the view
+    for tree in trees:
         namespaces = root_namespaces.get(tree.getroot(), {})
         variables['contexts'] = tree_contexts[tree]
         context = None
         if len(tree_contexts[tree]) > 0:
             context = tree_contexts[tree][0]
-        matches += get_results_for_xpath_query(query, tree, context, namespaces, **variables)
-
-    return matches
+        with performance_stats.measure(view, 'query_compile'):
+            xpath = etree.XPath(query, namespaces = { prefix: namespaces[prefix][0] for prefix in namespaces.keys() })
+        with performance_stats.measure(view, 'query_evaluate'):
+            matches.append(execute_xpath_query(tree, xpath, context, **variables))
+
+    if len(matches) == 1:
+        return matches[0]
+    return merge_results_in_document_order(list(enumerate(matches)))
+
+def get_window_query_executor():
+    """Return the thread pool that the views in a window are parsed and queried on, creating it if necessary."""
+    global window_query_executor
+    if window_query_executor is None:
+        window_query_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, int(settings.get('window_query_threads', 4))), thread_name_prefix='xpath_window_query')
+    return window_query_executor
+
+def get_trees_of_views(views, wait = True):
+    """Return the trees of each of the given views that contain any. The views that have been modified since they were last parsed are parsed in the background, concurrently in separate processes if parallel_parsing_processes is set, so it should only be called from the async thread, unless told not to wait for them, in which case only the trees that have already been parsed are returned."""
+    view_roots = [(view, ensureTreeCacheIsCurrent(view, False, False)) for view in views] # start parsing all the views before waiting for any of them
+    view_trees = []
+    for view, roots in view_roots:
+        if wait:
+            roots = ensureTreeCacheIsCurrent(view)
+        trees = [root.getroottree() for root in roots if root is not None]
+        if len(trees) > 0:
+            view_trees.append((view, trees))
+    return view_trees
+
+def get_sgml_views_in_window(window):
+    return [view for view in window.views() if containsSGML(view)]
+
+def get_results_for_xpath_query_in_views(query, view_trees):
+    """Execute the query from the document node of each of the given trees, evaluating each view concurrently, and return the results of each view that has any, in the order of the views."""
+    def results_for_view(view, trees):
+        return get_results_for_xpath_query_multiple_trees(query, { tree: [] for tree in trees }, { tree.getroot(): namespace_map_for_tree(tree) for tree in trees }, view)
+    futures = [(view, get_window_query_executor().submit(results_for_view, view, trees)) for view, trees in view_trees]
+    view_results = []
+    for view, future in futures:
+        results = future.result()
+        if len(results) > 0:
+            view_results.append((view, results))
+    return view_results
+
+def get_query_history():
+    """Return the query history, loading it if necessary. If it hasn't been stored as a journal yet, migrate it from the settings file that was used previously."""
+    global query_history
+    global settings
+    max_history = settings.get('max_query_history', 100)
+    if query_history is None:
+        query_history = QueryHistory(os.path.join(sublime.packages_path(), 'User', 'xpath_query_history.jsonl'), max_history)
+        if not query_history.load():
+            history_settings = sublime.load_settings('xpath_query_history.sublime-settings')
+            query_history.import_items(history_settings.get('history', []))
+    query_history.max_history = max_history
+    return query_history
 
 def get_xpath_query_history_for_keys(keys):
     """Return all previously used xpath queries with any of the given keys, in order.  If keys is None, return history across all keys."""
-    history_settings = sublime.load_settings('xpath_query_history.sublime-settings')
-    history = [item[0] for item in history_settings.get('history', []) if keys is None or item[1] in keys]
-    return list(reversed(list(getUniqueItems(reversed(history))))) # get the latest unique items
+    return get_query_history().queries_for_keys(keys)
 
 def remove_item_from_xpath_query_history(key, query):
     """If the given query exists in the history for the given key, remove it."""
-    history_settings = sublime.load_settings('xpath_query_history.sublime-settings')
-    history = history_settings.get('history', [])
-    item = [query, key]
-    if item in history:
-        history.remove(item)
-        history_settings.set('history', history)
-        #sublime.save_settings('xpath_query_history.sublime-settings')
+    get_query_history().remove(key, query)
 
 # def remove_key_from_xpath_query_history(key):
 #     view_history = get_xpath_query_history_for_keys([key])
@@ -564,33 +970,12 @@ def remove_item_from_xpath_query_history(key, query):
 
 def add_to_xpath_query_history_for_key(key, query):
     """Add the specified query to the history for the given key."""
-    # if it exists in the history for the view already, move the item to the bottom (i.e. make it the most recent item in the history) by removing and re-adding it
-    remove_item_from_xpath_query_history(key, query)
-
-    history_settings = sublime.load_settings('xpath_query_history.sublime-settings')
-    history = history_settings.get('history', [])
-    history.append([query, key])
-
-    # if there are more than the specified maximum number of history items, remove the excess
-    global settings
-    max_history = settings.get('max_query_history', 100)
-    history = history[-max_history:]
-
-    history_settings.set('history', history)
-    sublime.save_settings('xpath_query_history.sublime-settings')
+    # if it exists in the history for the view already, it becomes the most recent item in the history
+    get_query_history().add(key, query)
 
 def change_key_for_xpath_query_history(oldkey, newkey):
     """For all items in the history with the given oldkey, change the key to the specified newkey."""
-    history_settings = sublime.load_settings('xpath_query_history.sublime-settings')
-    history = history_settings.get('history', [])
-    items_changed = 0
-    for item in history:
-        if item[1] == oldkey:
-            item[1] = newkey
-            items_changed += 1
-    if items_changed > 0:
-        history_settings.set('history', history)
-        sublime.save_settings('xpath_query_history.sublime-settings')
+    get_query_history().change_key(oldkey, newkey)
 
 def get_history_key_for_view(view):
     """Return the key used to store history items that relate to the specified view."""
@@ -599,6 +984,86 @@ def get_history_key_for_view(view):
         key = 'buffer_' + str(view.id())
     return key
 
+RE_QUERY_NAME_TEST = re.compile(r'^(@\s*)?(?:((?![\d.\-])[\w.\-]+)\s*:)?((?![\d.\-])[\w.\-]+|\*)$')
+def query_validator_for_trees(trees):
+    """Return a function that determines whether a query could be relevant to any of the given trees, because all the namespace prefixes and the names in it's name tests exist in the tree."""
+    documents = []
+    for tree in trees:
+        element_names, attribute_names = structure_summary_for_tree(tree).local_names()
+        documents.append((namespace_map_for_tree(tree), element_names, attribute_names))
+
+    tokenizer = XPathTokenizer()
+    def is_valid(query):
+        name_tests = []
+        for token in tokenizer.tokenize(query):
+            if token.kind == 'value':
+                match = RE_QUERY_NAME_TEST.match(query[token.start:token.end].strip())
+                if match is not None:
+                    name_tests.append(match.groups())
+        for namespaces, element_names, attribute_names in documents:
+            if all((prefix is None or prefix in namespaces) and (localname == '*' or localname in (attribute_names if is_attribute else element_names)) for is_attribute, prefix, localname in name_tests):
+                return True
+        return False
+    return is_valid
+
+class SearchXpathQueryHistoryCommand(QuickPanelFromInputCommand): # example usage from python console: sublime.active_window().active_view().run_command('search_xpath_query_history', { 'global_query_history': True, 'only_queries_valid_for_document': True })
+    selected_query = None
+
+    def parse_args(self):
+        self.arguments['label'] = 'search xpath query history'
+        self.arguments['initial_value'] = self.get_value_from_args('initial_value', '')
+        self.arguments['live_mode'] = True
+        self.arguments['async'] = True
+
+        global settings
+        self.arguments['delay'] = int(settings.get('live_query_delay', 0))
+        super().parse_args()
+
+    def get_items_from_input(self):
+        history_key = get_history_key_for_view(self.view)
+        keys = None
+        if not getBoolValueFromArgsOrSettings('global_query_history', self.arguments, True):
+            keys = [history_key]
+
+        is_valid = None
+        if getBoolValueFromArgsOrSettings('only_queries_valid_for_document', self.arguments, False):
+            roots = [root for root in ensureTreeCacheIsCurrent(self.view) if root is not None]
+            is_valid = query_validator_for_trees([root.getroottree() for root in roots])
+
+        results = get_query_history().search(self.current_value, keys, history_key, is_valid, int(settings.get('max_query_history_search_results', 200)))
+        if len(results) == 0:
+            return None
+        return results
+
+    def select_remote_result(self, item):
+        """Ask the document server for the position of the result, and then move the cursor to it on the main thread."""
+        try:
+            ranges = item.document.request('ranges', item.results_id, item.index, item.index + 1, self.arguments['goto_element'], self.arguments['goto_attribute'])[1]
+        except DocumentServerError as e:
+            print('XPath: unable to get the position of the result from the document server', repr(e))
+            return
+        def select():
+            select_ranges(self.view, ranges)
+            self.refresh_selection_bug_work_around()
+        sublime.set_timeout(select, 0)
+
+    def quickpanel_selection_done(self, selected_index):
+        self.selected_query = None
+        if selected_index > -1:
+            self.selected_query = self.items[selected_index]
+        super().quickpanel_selection_done(selected_index)
+
+    def commit_input(self):
+        if self.selected_query is not None:
+            query = self.selected_query
+            sublime.set_timeout(lambda: self.view.run_command('query_xpath', { 'prefill_path_at_cursor': False, 'prefill_query': query }), 0) # once the input panel for searching has closed
+
+    def is_enabled(self, **args):
+        return isCursorInsideSGML(self.view)
+
+    def is_visible(self):
+        return containsSGML(self.view)
+
 class ShowXpathQueryHistoryCommand(sublime_plugin.TextCommand):
     history = None
 
@@ -653,9 +1118,6 @@ def namespace_map_for_tree(tree):
 
 class SelectResultsFromXpathQueryCommand(sublime_plugin.TextCommand): # example usage from python console: sublime.active_window().active_view().run_command('select_results_from_xpath_query', { 'xpath': '//*', 'goto_element': 'names' })
     def run(self, edit, **kwargs):
-        contexts = get_context_nodes_from_cursors(self.view)
-        nodes = get_results_for_xpath_query_multiple_trees(kwargs['xpath'], contexts, namespace_map_from_contexts(contexts))
-
         global settings
         goto_element = settings.get('goto_element', 'open')
         goto_attribute = settings.get('goto_attribute', 'value')
@@ -669,13 +1131,268 @@ class SelectResultsFromXpathQueryCommand(sublime_plugin.TextCommand): # example
         if 'goto_attribute' in kwargs:
             goto_attribute = kwargs['goto_attribute']
 
-        total_selectable_results, total_results = move_cursors_to_nodes(self.view, nodes, goto_element, goto_attribute)
+        if kwargs.get('all_views', False): # the views may need parsing, so that is waited for on the async thread
+            sublime.set_timeout_async(lambda: self.select_results_in_all_views(kwargs, goto_element, goto_attribute), 0)
+            return
+
+        contexts = get_context_nodes_from_cursors(self.view)
+        nodes = list(get_results_for_xpath_query_multiple_trees(kwargs['xpath'], contexts, namespace_map_from_contexts(contexts), self.view))
+        total_results = len(nodes)
+        nodes = list(get_nodes_from_document(nodes))
+        total_selectable_results = len(nodes)
+        ranges = get_ranges_of_nodes(self.view, nodes, goto_element, goto_attribute) # the positions are worked out a chunk at a time as they are selected
+
+        global remote_documents
+        if self.view.id() in remote_documents: # the document server may take a while to respond, so ask it from the async thread
+            ranges = list(ranges) # all the local positions are needed to merge the remote ones in among them
+            sublime.set_timeout_async(lambda: self.add_remote_results(kwargs, goto_element, goto_attribute, ranges, total_results, total_selectable_results), 0)
+        else:
+            self.show_results(kwargs, ranges, total_results, total_selectable_results)
+
+    def add_remote_results(self, kwargs, goto_element, goto_attribute, ranges, total_results, total_selectable_results):
+        """Execute the query in the documents parsed by the document server that contain cursors, and then show their results along with the local ones on the main thread."""
+        remote_ranges = []
+        try:
+            for document, positions in get_remote_contexts_from_cursors(self.view).items():
+                results_id, count = document.request('query', kwargs['xpath'], positions, settings.get('variables', {}))
+                selectable, document_ranges = document.request('ranges', results_id, 0, count, goto_element, goto_attribute)
+                total_results += count
+                total_selectable_results += selectable
+                remote_ranges.append((document, document_ranges))
+        except DocumentServerError as e:
+            sublime.status_message('XPath: the document server was unable to execute the query - ' + str(e))
+            return
+
+        ranges = merge_remote_items_by_region(ranges, lambda position: position[0], remote_ranges)
+        sublime.set_timeout(lambda: self.show_results(kwargs, ranges, total_results, total_selectable_results), 0)
+
+    def show_results(self, kwargs, ranges, total_results, total_selectable_results):
+        """Select or highlight the ranges of the results, and show how many there are."""
+        if getBoolValueFromArgsOrSettings('highlight_only', kwargs, False):
+            highlight_ranges(self.view, ranges, 'xpath_query_results', settings.get('highlight_results_scope', 'region.yellowish'))
+            action = ' nodes highlighted'
+        else:
+            select_ranges(self.view, ranges)
+            action = ' nodes selected'
         if total_selectable_results == total_results:
-            sublime.status_message(str(total_results) + ' nodes selected')
+            sublime.status_message(str(total_results) + action)
         else:
-            sublime.status_message(str(total_selectable_results) + ' nodes selected out of ' + str(total_results))
+            sublime.status_message(str(total_selectable_results) + action + ' out of ' + str(total_results))
         add_to_xpath_query_history_for_key(get_history_key_for_view(self.view), kwargs['xpath'])
 
+    def select_results_in_all_views(self, kwargs, goto_element, goto_attribute):
+        """Execute the query on every XML view in the window, and then select or highlight the results in each of them on the main thread. Called from the async thread."""
+        highlight_only = getBoolValueFromArgsOrSettings('highlight_only', kwargs, False)
+        try:
+            view_results = get_results_for_xpath_query_in_views(kwargs['xpath'], get_trees_of_views(get_sgml_views_in_window(self.view.window())))
+        except (ValueError, etree.XPathError) as e:
+            sublime.status_message('XPath: ' + e.__class__.__name__ + ': ' + str(e))
+            return
+
+        view_ranges = []
+        total_selectable_results = 0
+        for view, results in view_results:
+            nodes = list(get_nodes_from_document(results))
+            total_selectable_results += len(nodes)
+            view_ranges.append((view, list(get_ranges_of_nodes(view, nodes, goto_element, goto_attribute))))
+
+        def show_results():
+            for view, ranges in view_ranges:
+                if highlight_only:
+                    highlight_ranges(view, ranges, 'xpath_query_results', settings.get('highlight_results_scope', 'region.yellowish'))
+                else:
+                    select_ranges(view, ranges)
+            sublime.status_message(str(total_selectable_results) + (' nodes highlighted' if highlight_only else ' nodes selected') + ' in ' + str(len(view_results)) + ' views')
+            add_to_xpath_query_history_for_key(get_history_key_for_view(self.view), kwargs['xpath'])
+        sublime.set_timeout(show_results, 0)
+
+class RestartXpathDocumentServerCommand(sublime_plugin.WindowCommand):
+    """Stop the document server, cancelling any query it is executing, so that the documents it had parsed will be parsed again when they are next needed."""
+    def run(self):
+        global document_server
+        if document_server is not None:
+            document_server.kill() # the documents it had parsed are no longer current, so they will be parsed again
+        view = self.window.active_view()
+        if view is not None:
+            sublime.set_timeout_async(lambda: updateStatusToCurrentXPathIfSGML(view), 10)
+
+    def is_enabled(self):
+        global settings
+        return bool(settings.get('document_server_python', ''))
+
+class FindXpathInFilesCommand(sublime_plugin.WindowCommand): # example usage from python console: sublime.active_window().run_command('find_xpath_in_files', { 'xpath': '//Trade[@status="FAILED"]', 'folders': ['/path/to/trades'] })
+    """Execute an XPath query on all the matching files in the folders open in the window, using a pool of document server processes, and list the results in a view where they can be double clicked to open them."""
+    def run(self, **args):
+        global settings
+        if not settings.get('document_server_python', ''):
+            sublime.error_message('XPath: finding in files requires the document_server_python setting to be set to a Python interpreter with lxml installed.')
+            return
+        if 'xpath' not in args:
+            history = get_xpath_query_history_for_keys(None)
+            input_panel = self.window.show_input_panel('XPath query to find in files:', history[-1] if len(history) > 0 else '', lambda query: self.run(**dict(args, xpath=query)), None, None)
+            input_panel.assign_syntax('xpath.sublime-syntax')
+            return
+
+        query = args['xpath']
+        try:
+            etree.XPath(query) # so that an invalid query isn't reported for every file
+        except etree.XPathSyntaxError as e:
+            sublime.error_message('XPath: invalid query: ' + str(e))
+            return
+        folders = args.get('folders', None) or self.window.folders()
+        if len(folders) == 0:
+            sublime.status_message('XPath: no folders to find in')
+            return
+        add_to_xpath_query_history_for_key('global', query)
+
+        global file_searches
+        previous = file_searches.pop(self.window.id(), None)
+        if previous is not None:
+            previous.cancel()
+
+        view = self.window.new_file()
+        view.set_name('XPath Find Results')
+        view.set_scratch(True)
+        view.assign_syntax('Packages/Default/Find Results.hidden-tmLanguage')
+        view.settings().set('result_file_regex', r'^(\S.*):$')
+        view.settings().set('result_line_regex', r'^ +(\d+):(\d+):')
+        view.settings().set('word_wrap', False)
+        view.set_read_only(True)
+        append_to_view(view, 'Finding XPath ' + query + ' in ' + ', '.join(folders) + '\n\n')
+
+        options = { 'maxlen': 120, 'default_namespace_prefix': settings.get('default_namespace_prefix', 'default'), 'variables': settings.get('variables', {}) }
+        search = FileSearch(settings.get('document_server_python'), int(settings.get('find_in_files_processes', 4)), float(settings.get('document_server_timeout', 60)), query, options,
+            lambda path, response: sublime.set_timeout(lambda: self.show_file_results(view, search, path, response), 0),
+            lambda search: sublime.set_timeout(lambda: self.show_summary(view, search), 0)
+        )
+        file_searches[self.window.id()] = search
+        patterns = args.get('file_patterns', None) or settings.get('find_in_files_patterns', ['*.xml'])
+        max_size = float(settings.get('find_in_files_max_file_size_mb', 50)) * 1024 * 1024
+        search.start(folders, patterns, max_size)
+
+    def show_file_results(self, view, search, path, response):
+        """Append the results of a file to the results view, in the order the files were searched."""
+        lines = []
+        if response['error'] is not None:
+            lines.append('  {0}:{1}: XML parse error: {2}'.format(*response['error']))
+        elif 'failure' in response:
+            lines.append('  unable to search: ' + response['failure'])
+        for line, column, preview in response['results']:
+            if line is None:
+                lines.append('  ' + preview)
+            else:
+                lines.append('  {0}:{1}: {2}'.format(line, column, preview))
+        if view.is_valid() and len(lines) > 0:
+            append_to_view(view, path + ':\n' + '\n'.join(lines) + '\n\n')
+        self.show_progress(view, search)
+
+    def show_progress(self, view, search):
+        if view.is_valid():
+            view.set_status('xpath_find_in_files', 'XPath: ' + search.progress())
+        elif not search.cancelled: # the results view was closed
+            search.cancel()
+
+    def show_summary(self, view, search):
+        global file_searches
+        if file_searches.get(self.window.id(), None) is search:
+            del file_searches[self.window.id()]
+        if view.is_valid():
+            summary = search.progress()
+            if search.skipped > 0:
+                summary += ', ' + str(search.skipped) + ' files skipped because they are larger than find_in_files_max_file_size_mb'
+            if search.cancelled:
+                summary += ' (cancelled)'
+            append_to_view(view, summary + '\n')
+            view.erase_status('xpath_find_in_files')
+
+class CancelFindXpathInFilesCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        global file_searches
+        search = file_searches.get(self.window.id(), None)
+        if search is not None:
+            search.cancel()
+
+    def is_enabled(self):
+        global file_searches
+        return self.window.id() in file_searches
+
+def append_to_view(view, text):
+    view.run_command('append', { 'characters': text, 'force': True, 'scroll_to_end': False })
+
+class ShowXpathPerformanceStatsCommand(sublime_plugin.WindowCommand):
+    """Show how long the plugin's operations have recently taken in each XML view in the window, and the size of the documents parsed from them, in an output panel."""
+    def run(self):
+        self.window.destroy_output_panel('xpath_performance') # so that only the latest stats are shown
+        panel = self.window.create_output_panel('xpath_performance')
+        panel.settings().set('word_wrap', False)
+        append_to_view(panel, performance_stats.format_report(get_sgml_views_in_window(self.window), getDocumentSizesForView))
+        panel.set_read_only(True)
+        self.window.run_command('show_panel', { 'panel': 'output.xpath_performance' })
+
+class ShowXpathMemoryUsageCommand(sublime_plugin.WindowCommand):
+    """Show the estimated memory used by the trees parsed from all the open views, largest first, broken down by component, in an output panel, to help choose a value for the max_parsed_trees_mb setting."""
+    def run(self, count = 20):
+        views = { view.id(): view for window in sublime.windows() for view in window.views() }
+        documents = []
+        for view_id, trees in getMemoryUsageOfParsedTrees().items():
+            for index, tree in enumerate(trees):
+                if tree is not None and view_id in views:
+                    nodes, tree_usage = tree
+                    documents.append((sum(tree_usage.values()), views[view_id], index, nodes, tree_usage))
+        documents.sort(key=lambda document: document[0], reverse=True)
+
+        global settings
+        limit = float(settings.get('max_parsed_trees_mb', 0))
+        lines = ['Estimated memory used by the ' + str(len(documents)) + ' parsed documents: ' + performance_stats.format_bytes(sum(document[0] for document in documents)) + ', max_parsed_trees_mb: ' + (str(limit) if limit > 0 else 'unlimited')]
+        now = time.monotonic()
+        for total, view, index, nodes, tree_usage in documents[0:count]:
+            regions = getSGMLRegions(view)
+            lines.append('')
+            lines.append(performance_stats.view_name(view) + ' (view ' + str(view.id()) + '), last used ' + str(round(now - trees_last_used.get(view.id(), now))) + ' seconds ago')
+            lines += performance_stats.format_document(index, regions[index].size() if index < len(regions) else 0, nodes, tree_usage) # the region may have changed since it was parsed
+
+        self.window.destroy_output_panel('xpath_memory') # so that only the latest usage is shown
+        panel = self.window.create_output_panel('xpath_memory')
+        panel.settings().set('word_wrap', False)
+        append_to_view(panel, '\n'.join(lines) + '\n')
+        panel.set_read_only(True)
+        self.window.run_command('show_panel', { 'panel': 'output.xpath_memory' })
+
+def getDocumentSizesForView(view):
+    """Return the number of characters in each XML region of the view, and the number of nodes in, and estimated memory used by each component of, the tree parsed from it, or None for those if it hasn't been parsed in the plugin host."""
+    global xml_roots
+    global xml_elements
+    roots = xml_roots.get(view.id(), [])
+    elements_of_regions = xml_elements.get(view.id(), [])
+    sizes = []
+    for region_index, region in enumerate(getSGMLRegions(view)):
+        all_elements = None
+        if region_index < min(len(roots), len(elements_of_regions)):
+            all_elements = elements_of_regions[region_index]
+        if all_elements is None:
+            sizes.append((region.size(), None, None))
+        else:
+            sizes.append((region.size(), len(all_elements), tree_memory_usage(roots[region_index], all_elements)))
+    return sizes
+
+def getProfileDetailsForView(view, query = None):
+    """Return the details of the view, and the settings, to store with the profile of a slow operation in it."""
+    global settings
+    return {
+        'file': view.file_name(),
+        'view_characters': view.size(),
+        'documents': [{ 'characters': characters, 'nodes': nodes, 'estimated_memory_usage': memory_usage } for characters, nodes, memory_usage in getDocumentSizesForView(view)],
+        'query': query,
+        'settings': settings.to_dict() if hasattr(settings, 'to_dict') else None, # not available in Sublime Text 3
+    }
+
+class ClearXpathQueryHighlightsCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        erase_highlights(self.view, 'xpath_query_results')
+    
+    def is_enabled(self):
+        return has_highlights(self.view, 'xpath_query_results')
+
 class RerunLastXpathQueryAndSelectResultsCommand(sublime_plugin.TextCommand): # example usage from python console: sublime.active_window().active_view().run_command('rerun_last_xpath_query_and_select_results', { 'global_query_history': False })
     def run(self, edit, **args):
         global_history = getBoolValueFromArgsOrSettings('global_query_history', args, True)
@@ -739,9 +1456,14 @@ def get_context_nodes_from_cursors(view):
 
     invalid_trees = []
 
+    global remote_documents
+    global pending_parses
+    documents = remote_documents.get(view.id(), {})
+    pending = pending_parses.get(view.id(), None)
+    remote_futures = pending[2] if pending is not None else {}
     regions_cursors = {}
     for result in getSGMLRegionsContainingCursors(view):
-        if roots[result[1]] is None:
+        if roots[result[1]] is None and documents.get(result[1], None) is None and result[1] not in remote_futures: # regions parsed by the document server have no tree here
             invalid_trees.append(result[0])
         node = result[2]
         if isinstance(node, etree.CommentBase):
@@ -770,26 +1492,106 @@ def get_context_nodes_from_cursors(view):
 
     return contexts
 
+class ResultsPageNavigation:
+    """An item in the quick panel of query results that shows another page of the results when it is selected, or asks which result to go to if the page is None."""
+    def __init__(self, page, caption):
+        self.page = page
+        self.caption = caption
+
+    def __str__(self):
+        return self.caption
+
+class WindowResult:
+    """A result of a query that was executed on all the views in the window, and the view it is from."""
+    __slots__ = ('view', 'result')
+
+    def __init__(self, view, result):
+        self.view = view
+        self.result = result
+
+    def __eq__(self, other):
+        return isinstance(other, WindowResult) and self.view.id() == other.view.id() and self.result == other.result
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.view.id())
+
+class GotoXpathQueryResultCommand(sublime_plugin.TextCommand): # example usage from python console: sublime.active_window().active_view().run_command('goto_xpath_query_result', { 'number': 1500 })
+    def run(self, edit, **args):
+        if 'number' in args:
+            self.goto_result_number(str(args['number']))
+        else:
+            command = active_query_commands[self.view.id()]
+            count = len(command.all_results[2])
+            self.view.window().show_input_panel('go to xpath query result number (1-' + str(count) + ')', '', self.goto_result_number, None, None)
+
+    def goto_result_number(self, number):
+        try:
+            index = int(number.strip()) - 1
+        except ValueError:
+            sublime.status_message('XPath: "' + number + '" is not a result number')
+            return
+        active_query_commands[self.view.id()].goto_result_index(index)
+
+    def is_enabled(self, **args):
+        command = active_query_commands.get(self.view.id(), None)
+        return command is not None and command.all_results is not None
+
+    def is_visible(self):
+        return self.is_enabled()
+
 class QueryXpathCommand(QuickPanelFromInputCommand): # example usage from python console: sublime.active_window().active_view().run_command('query_xpath', { 'prefill_query': '//prefix:LocalName', 'live_mode': True })
     max_results_to_show = None
     contexts = None
+    remote_contexts = None # the documents parsed by the document server that contain cursors, and the positions of the cursors in them
     previous_input = None # remember previous query so that when the user next runs this command, it will be prepopulated
-
-    def cache_context_nodes(self):
-        """Cache context nodes to allow live mode to work with them."""
-        context_nodes = get_context_nodes_from_cursors(self.view)
-        change_count = self.view.change_count()
+    completion_context_cache = None # results of subqueries executed for completions while the input panel is open
+    element_previews = None # the change count of the view, and the previews of the elements in the most recent results
+    all_results = None # the query, the change count of the view and all the results, of which one page is shown at a time
+    page = 0
+    all_views = False # whether the query is executed on all the views in the window, instead of from the cursors in this view
+    window_trees = None # in window mode, the views that contain XML, and their trees
+
+    def change_count(self):
+        """Return the change count of the view, or of all the views that are queried in window mode, to determine whether the results are still current."""
+        if self.all_views:
+            return tuple((view.id(), view.change_count()) for view, trees in self.window_trees)
+        return self.view.change_count()
+
+    def cache_context_nodes(self, wait = True):
+        """Cache context nodes to allow live mode to work with them. Unless told to wait for the regions still being parsed in the background, i.e. by the document server or in the other views in window mode, which should only be done off the main thread, they are cached again once they have been parsed."""
+        if self.all_views: # the document node of each tree in the window is the context, so that completions are suggested from all of them
+            views = get_sgml_views_in_window(self.view.window())
+            self.window_trees = get_trees_of_views(views, wait)
+            context_nodes = { tree: [] for view, trees in self.window_trees for tree in trees }
+            self.remote_contexts = {}
+            still_parsing = any(isParsingInBackground(view) for view in views)
+        else:
+            context_nodes = get_context_nodes_from_cursors(self.view)
+            self.remote_contexts = get_remote_contexts_from_cursors(self.view, wait)
+            still_parsing = isParsingRemoteDocuments(self.view)
+        change_count = self.change_count()
+        if not wait and still_parsing:
+            change_count = None # so that the context nodes are cached again when the query is executed
 
         different_tree = self.contexts is None or self.contexts[0] != change_count # if the document has changed since the context nodes were cached
         self.contexts = (change_count, context_nodes, namespace_map_from_contexts(context_nodes))
+        if different_tree or self.completion_context_cache is None:
+            self.completion_context_cache = CompletionContextCache()
 
         tree_count = 0
         for root in context_nodes:
             tree_count += 1
 
-            print('XPath: context nodes: ', getExactXPathOfNodes(context_nodes[root]))
+            if not self.all_views:
+                print('XPath: context nodes: ', getExactXPathOfNodes(context_nodes[root]))
+            if different_tree: # build the structure summary and value index in the background, so that they are ready by the time completions are requested
+                sublime.set_timeout_async(lambda tree=root: structure_summary_for_tree(tree), 0)
+                value_index_for_tree(root, False)
 
-        if tree_count == 1: # if there is exactly one xml tree
+        if tree_count == 1 and not self.all_views: # if there is exactly one xml tree
             tree = next(iter(context_nodes.keys())) # get the tree
             if len(context_nodes[tree]) == 0: # if there are no context nodes
                 context_nodes[tree].append(tree.getroot()) # use the root element as the context node
@@ -801,8 +1603,17 @@ class QueryXpathCommand(QuickPanelFromInputCommand): # example usage from python
                 self.highlighted_index = 0
 
     def run(self, edit, **args):
-        self.cache_context_nodes()
-        if len(self.contexts[1].keys()) == 0: # if there are no context nodes, don't proceed to show the xpath input panel
+        self.completion_context_cache = None # the cache is only for the lifetime of the input panel
+        self.element_previews = None
+        self.all_results = None
+        self.page = 0
+        global active_query_commands
+        active_query_commands[self.view.id()] = self
+        self.all_views = args.get('all_views', False)
+        self.cache_context_nodes(False)
+        if len(self.contexts[1].keys()) == 0 and len(self.remote_contexts) == 0 and self.contexts[0] is not None: # if there are no context nodes, don't proceed to show the xpath input panel
+            if self.all_views:
+                sublime.status_message('XPath: no XML to query in the open views')
             return
         super().run(edit, **args)
 
@@ -834,6 +1645,8 @@ class QueryXpathCommand(QuickPanelFromInputCommand): # example usage from python
         self.arguments['async'] = getBoolValueFromArgsOrSettings('live_query_async', self.arguments, True)
         self.arguments['delay'] = int(settings.get('live_query_delay', 0))
         self.arguments['live_mode'] = getBoolValueFromArgsOrSettings('live_mode', self.arguments, True)
+        self.arguments['live_mode_max_results_while_typing'] = int(self.get_value_from_args('live_mode_max_results_while_typing', settings.get('live_mode_max_results_while_typing', 10000)))
+        self.arguments['live_mode_idle_delay'] = int(self.get_value_from_args('live_mode_idle_delay', settings.get('live_mode_idle_delay', 500)))
 
         self.arguments['normalize_whitespace_in_preview'] = getBoolValueFromArgsOrSettings('normalize_whitespace_in_preview', self.arguments, False)
         self.arguments['auto_completion_triggers'] = settings.get('auto_completion_triggers', '/')
@@ -847,18 +1660,16 @@ class QueryXpathCommand(QuickPanelFromInputCommand): # example usage from python
 
         super().parse_args()
 
+    @operation_profiler.profile_if_slow('query', lambda self, query: getProfileDetailsForView(self.view, query))
     def get_query_results(self, query):
         results = None
         status_text = None
         if len(query.strip()) == 0:
             status_text = 'No query entered'
         else:
-            if self.contexts[0] != self.view.change_count(): # if the document has changed since the context nodes were cached
-                self.cache_context_nodes()
-
             try:
-                results = list((result for result in get_results_for_xpath_query_multiple_trees(query, self.contexts[1], self.contexts[2])))# if not isinstance(result, etree.CommentBase)))
-            except (ValueError, etree.XPathError) as e:
+                results = self.evaluate_query(query)
+            except (ValueError, etree.XPathError, DocumentServerError) as e:
                 last_char = query.rstrip()[-1]
                 if not last_char in ('/', ':', '@', '[', '(', ','): # log exception to console only if might be useful
                     print('XPath: exception evaluating results for "' + query + '": ' + repr(e))
@@ -871,19 +1682,97 @@ class QueryXpathCommand(QuickPanelFromInputCommand): # example usage from python
                 if len(results) != 1:
                     status_text += 's'
                 status_text += ' from query'
-                if self.max_results_to_show > 0 and len(results) > self.max_results_to_show:
-                    status_text += ' (showing first ' + str(self.max_results_to_show) + ')'
-                    results = results[0:self.max_results_to_show]
+                page_size = self.max_results_to_show
+                if page_size > 0 and len(results) > page_size: # only show one page of results at a time, with items to navigate to the other pages
+                    page_count = (len(results) + page_size - 1) // page_size
+                    self.page = max(0, min(self.page, page_count - 1))
+                    first = self.page * page_size
+                    last = min(first + page_size, len(results))
+                    status_text += ' (showing ' + str(first + 1) + '-' + str(last) + ')'
+
+                    page = []
+                    if self.page > 0:
+                        page.append(ResultsPageNavigation(self.page - 1, 'Previous page (results ' + str(first - page_size + 1) + '-' + str(first) + ')'))
+                    page += results[first:last]
+                    if last < len(results):
+                        page.append(ResultsPageNavigation(self.page + 1, 'Next page (results ' + str(last + 1) + '-' + str(min(last + page_size, len(results))) + ')'))
+                    page.append(ResultsPageNavigation(None, 'Go to result number...'))
+                    results = page
         self.view.set_status('xpath_query', status_text or '')
         return results
 
+    def evaluate_query(self, query):
+        """Return all the results of the query, executing it unless it's results for the current version of the document are already known."""
+        if self.contexts[0] != self.change_count(): # if the document has changed since the context nodes were cached
+            self.cache_context_nodes()
+
+        if self.all_results is not None and self.all_results[0:2] == (query, self.contexts[0]): # if only the page to show has changed, there is no need to execute the query again
+            return self.all_results[2]
+        self.all_results = None
+        self.page = 0
+        if self.all_views: # the results are grouped by view
+            results = [WindowResult(view, result) for view, view_results in get_results_for_xpath_query_in_views(query, self.window_trees) for result in view_results]
+        else:
+            results = list((result for result in get_results_for_xpath_query_multiple_trees(query, self.contexts[1], self.contexts[2], self.view)))# if not isinstance(result, etree.CommentBase)))
+            results = merge_remote_items_by_region(results, local_result_position, self.get_remote_query_results(query))
+        self.all_results = (query, self.contexts[0], results)
+        return results
+
+    def get_remote_query_results(self, query):
+        """Execute the query in the documents parsed by the document server, and return each document with placeholders for it's results, whose previews are requested when they are shown."""
+        results = []
+        for document, positions in self.remote_contexts.items():
+            results_id, count = document.request('query', query, positions, settings.get('variables', {}))
+            results.append((document, [RemoteResult(document, results_id, index) for index in range(0, count)]))
+        return results
+
     def get_items_from_input(self):
         return self.get_query_results(self.current_value)
 
+    def count_query_results(self, query):
+        """Return the number of results the query returns, evaluating count() so that the result nodes aren't created, or None if the query doesn't return nodes or is invalid."""
+        if self.contexts[0] != self.change_count(): # if the document has changed since the context nodes were cached
+            self.cache_context_nodes()
+        count_query = 'count(' + query + '\n)' # the new line ensures that a comment at the end of the query doesn't affect the closing parenthesis
+        try:
+            if self.all_views:
+                return int(sum(count for view, counts in get_results_for_xpath_query_in_views(count_query, self.window_trees) for count in counts))
+            count = int(sum(get_results_for_xpath_query_multiple_trees(count_query, self.contexts[1], self.contexts[2], self.view)))
+            for document, positions in self.remote_contexts.items():
+                count += document.request('count', query, positions, settings.get('variables', {}))
+            return count
+        except (ValueError, TypeError, etree.XPathError, DocumentServerError):
+            return None
+
+    def process_current_input(self):
+        # while typing in live mode, if the query returns a lot of results, only show how many there are until typing pauses, as creating and showing them all could take a while
+        query = self.current_value
+        max_results = self.arguments['live_mode_max_results_while_typing']
+        same_query = self.all_results is not None and self.all_results[0:2] == (query, self.change_count()) # i.e. only the page to show has changed
+        if self.live_mode and self.input_panel is not None and max_results > 0 and not same_query and len(query.strip()) > 0:
+            count = self.count_query_results(query) # the results are only created if there aren't too many of them
+            if count is not None and count > max_results:
+                self.items = None
+                self.ignore_view_activations = True
+                self.close_quick_panel() # the results for the previous query are no longer relevant
+                self.view.set_status('xpath_query', str(count) + ' results from query (showing them when typing pauses)')
+                sublime.set_timeout_async(lambda: self.process_input_when_idle(query), self.arguments['live_mode_idle_delay'])
+                return
+        super().process_current_input()
+
+    def process_input_when_idle(self, query):
+        """Show the results for the query, if it hasn't changed since it was counted and the input panel is still open."""
+        if self.input_panel is not None and self.current_value == query and self.pending_value == query:
+            super().process_current_input()
+
     def get_items_to_show_in_quickpanel(self):
         results = self.items
         if results is None:
             return None
+        with performance_stats.measure(self.view, 'quick_panel'):
+            return self.get_previews(results)
+
+    def get_previews(self, results):
 
         # truncate each xml result at 70 chars so that it appears (more) correctly in the quick panel
         maxlen = 70
@@ -894,15 +1783,53 @@ class QueryXpathCommand(QuickPanelFromInputCommand): # example usage from python
         else:
             show_text_preview = lambda result: str(result)[0:maxlen]
 
-        unique_types_in_result = getUniqueItems((type(item) for item in results))
-        next(unique_types_in_result, None)
-        muliple_types_in_result = next(unique_types_in_result, None) is not None
-
-        show_element_preview = lambda e: [getTagName(e)[2], collapseWhitespace(e.text, maxlen), getElementXMLPreview(self.view, e, maxlen)]
+        self.fetch_remote_previews(results, maxlen)
+        def result_type(item):
+            if isinstance(item, WindowResult):
+                item = item.result
+            if isinstance(item, RemoteResult): # the type of the result in the document server is only known from it's preview
+                return etree.ElementBase if isinstance(item.preview, list) else str
+            return type(item)
 
-        def show_preview(item):
-            if isinstance(item, etree.ElementBase) and not isinstance(item, etree.CommentBase):
-                return show_element_preview(item)
+        unique_types_in_result = getUniqueItems((result_type(item) for item in results if not isinstance(item, ResultsPageNavigation)))
+        first_type = next(unique_types_in_result, None)
+        muliple_types_in_result = next(unique_types_in_result, None) is not None
+        show_three_lines = first_type is not None and issubclass(first_type, etree.ElementBase) and not issubclass(first_type, etree.CommentBase) # the page navigation items need to have as many lines as the results
+
+        # reuse the previews of elements that were also in the previous results, i.e. while the query is being typed in live mode, as long as the document hasn't changed
+        change_count = self.change_count()
+        previous_previews = {}
+        if self.element_previews is not None and self.element_previews[0] == change_count:
+            previous_previews = self.element_previews[1]
+        element_previews = {}
+        self.element_previews = (change_count, element_previews)
+
+        def show_element_preview(e, view):
+            preview = previous_previews.get(e, None)
+            if preview is None:
+                preview = [getTagName(e)[2], collapseWhitespace(e.text, maxlen), getElementXMLPreview(view, e, maxlen)]
+            element_previews[e] = preview
+            return preview
+
+        def show_preview(item, view = self.view):
+            if isinstance(item, WindowResult): # label the result with the name of the view it is from
+                show = show_preview(item.result, item.view)
+                label = os.path.basename(item.view.file_name() or item.view.name() or 'untitled') + ': '
+                if isinstance(show, list):
+                    return [label + show[0]] + show[1:]
+                return label + show
+            elif isinstance(item, ResultsPageNavigation):
+                show = str(item)
+                if muliple_types_in_result or show_three_lines:
+                    show = [show, '', '']
+                return show
+            elif isinstance(item, RemoteResult):
+                show = item.preview
+                if muliple_types_in_result and not isinstance(show, list):
+                    show = [show, '', '']
+                return show
+            elif isinstance(item, etree.ElementBase) and not isinstance(item, etree.CommentBase):
+                return show_element_preview(item, view)
             else:
                 show = show_text_preview(item)
                 if muliple_types_in_result: # if some items are elements (where we show 3 lines) and some are other node types (where we show 1 line), we need to return 3 lines to ensure Sublime will show the results correctly
@@ -911,15 +1838,75 @@ class QueryXpathCommand(QuickPanelFromInputCommand): # example usage from python
 
         return [show_preview(item) for item in results]
 
+    def fetch_remote_previews(self, results, maxlen):
+        """Request the previews of the results from the document server that are about to be shown, and don't have them yet."""
+        pending = collections.OrderedDict()
+        for item in results:
+            if isinstance(item, RemoteResult) and item.preview is None:
+                pending.setdefault((item.document, item.results_id), []).append(item)
+        for (document, results_id), items in pending.items(): # the results of each document on a page are consecutive
+            start = items[0].index
+            try:
+                previews = document.request('previews', results_id, start, items[-1].index + 1, maxlen, self.arguments['normalize_whitespace_in_preview'])
+            except DocumentServerError as e:
+                print('XPath: unable to get previews of the results from the document server', repr(e))
+                previews = []
+            for item in items:
+                if item.index - start < len(previews):
+                    item.preview = previews[item.index - start]
+                else:
+                    item.preview = '(result no longer available)'
+
     def quickpanel_selection_changed(self, selected_index):
         super().quickpanel_selection_changed(selected_index)
-        if selected_index > -1: # quick panel wasn't cancelled
-            move_cursors_to_nodes(self.view, [self.items[selected_index]], self.arguments['goto_element'], self.arguments['goto_attribute'])
+        if selected_index > -1 and not isinstance(self.items[selected_index], ResultsPageNavigation): # quick panel wasn't cancelled
+            item = self.items[selected_index]
+            if isinstance(item, WindowResult): # the view is focused once the result has been chosen, because focusing it now would close the input panel
+                move_cursors_to_nodes(item.view, [item.result], self.arguments['goto_element'], self.arguments['goto_attribute'])
+            elif isinstance(item, RemoteResult): # the document server may take a while to respond, so ask it from the async thread
+                sublime.set_timeout_async(lambda: self.select_remote_result(item), 0)
+                return
+            else:
+                move_cursors_to_nodes(self.view, [item], self.arguments['goto_element'], self.arguments['goto_attribute'])
             self.refresh_selection_bug_work_around()
             #self.view.window().focus_view(self.view) # focus the view to try getting the cursor positions to update while the quick panel is open
             #if self.input_panel is not None:
             #    self.input_panel.window().focus_view(self.input_panel)
 
+    def quickpanel_selection_done(self, selected_index):
+        if selected_index > -1 and isinstance(self.items[selected_index], ResultsPageNavigation):
+            page = self.items[selected_index].page
+            if page is None:
+                sublime.set_timeout(lambda: self.view.run_command('goto_xpath_query_result'), 0) # once the quick panel has closed
+            else:
+                self.show_results_page(page, None)
+        else:
+            item = self.items[selected_index] if selected_index > -1 else None
+            super().quickpanel_selection_done(selected_index)
+            if isinstance(item, WindowResult):
+                sublime.set_timeout(lambda: item.view.window().focus_view(item.view) if item.view.window() is not None else None, 0)
+
+    def show_results_page(self, page, highlight_index):
+        """Show the given page of the results of the current query, highlighting the result at the given index in all the results or the first result on the page."""
+        if self.all_results is None:
+            return
+        self.page = page
+        if highlight_index is None:
+            highlight_index = page * self.max_results_to_show
+        self.highlighted_result = self.all_results[2][highlight_index]
+        self.highlighted_index = highlight_index - page * self.max_results_to_show + (1 if page > 0 else 0) # allow for the previous page item
+        self.process_current_input()
+
+    def goto_result_index(self, index):
+        """Show the page containing the result at the given index, and highlight that result."""
+        if self.all_results is None or not 0 <= index < len(self.all_results[2]):
+            sublime.status_message('XPath: there is no result number ' + str(index + 1))
+            return
+        page = 0
+        if self.max_results_to_show > 0:
+            page = index // self.max_results_to_show
+        self.show_results_page(page, index)
+
     def commit_input(self):
         self.previous_input = self.current_value
         add_to_xpath_query_history_for_key(get_history_key_for_view(self.view), self.current_value)
@@ -934,13 +1921,19 @@ class QueryXpathCommand(QuickPanelFromInputCommand): # example usage from python
         settings.set('auto_complete', True)
         settings.set('auto_complete_include_snippets_when_typing', False)
         if len(self.arguments['auto_completion_triggers'] or '') > 0:
-            settings.set('auto_complete_triggers', [ {'selector': 'query.xml.xpath - string', 'characters': self.arguments['auto_completion_triggers']} ])
+            triggers = [ {'selector': 'query.xml.xpath - string', 'characters': self.arguments['auto_completion_triggers']} ]
+            quotes = ''.join(quote for quote in ('"', "'") if quote in self.arguments['auto_completion_triggers'])
+            if quotes != '' and self.arguments['intelligent_auto_complete']: # suggest values when a string that is compared to an attribute or element is opened
+                triggers.append({'selector': 'query.xml.xpath string', 'characters': quotes})
+            settings.set('auto_complete_triggers', triggers)
 
     def on_query_completions(self, prefix, locations): # moved from .sublime-completions file here - https://github.com/SublimeTextIssues/Core/issues/819
         flags = sublime.INHIBIT_WORD_COMPLETIONS
         if not self.arguments['intelligent_auto_complete']:
             flags = 0
-        return (completions_for_xpath_query(self.input_panel, prefix, locations, self.contexts[1], self.contexts[2], settings.get('variables', {}), self.arguments['intelligent_auto_complete']), flags)
+        with performance_stats.measure(self.view, 'completion'), operation_profiler.profile('completion', lambda: getProfileDetailsForView(self.view, self.input_panel.substr(sublime.Region(0, self.input_panel.size())))):
+            completions = completions_for_xpath_query(self.input_panel, prefix, locations, self.contexts[1], self.contexts[2], settings.get('variables', {}), self.arguments['intelligent_auto_complete'], self.completion_context_cache, self.remote_contexts)
+        return (completions, flags)
 
     def on_completion_committed(self):
         # show the auto complete popup again if the item that was autocompleted ended in a character that is an auto completion trigger
@@ -953,12 +1946,297 @@ class QueryXpathCommand(QuickPanelFromInputCommand): # example usage from python
         self.input_panel.window().focus_view(self.input_panel)
 
     def is_enabled(self, **args):
+        if args.get('all_views', False):
+            return self.view.window() is not None and len(get_sgml_views_in_window(self.view.window())) > 0
         return isCursorInsideSGML(self.view)
 
-    def is_visible(self):
+    def is_visible(self, **args):
+        if args.get('all_views', False):
+            return True
         return containsSGML(self.view)
 
-def completions_for_xpath_query(view, prefix, locations, contexts, namespaces, variables, intelligent):
+def value_index_for_tree(tree, wait):
+    """Return the value index of the given tree. If it hasn't been built since the tree was parsed, build it - in the background unless told to wait for it, in which case return None until it is ready."""
+    root = tree.getroot()
+    if not hasattr(root, 'value_index'):
+        root.value_index = None # mark the index as being built, so it is only built once
+        global settings
+        max_values = int(settings.get('max_value_completions', 100))
+        if wait:
+            root.value_index = ValueIndex(root, max_values)
+        else:
+            def build():
+                index = ValueIndex(root, max_values)
+                if getattr(root, 'value_index', False) is None: # if the tree hasn't changed while the index was being built
+                    root.value_index = index
+            sublime.set_timeout_async(build, 0)
+    return root.value_index
+
+RE_VALUE_COMPARISON = re.compile(r'(@\s*)?((?:(?![\d.\-])[\w.\-]+:)?(?![\d.\-])[\w.\-]+)\s*!?=\s*(["\'])([^"\']*)$')
+def completions_for_value_comparison(view, prefix, location, contexts, namespaces):
+    """If the cursor is inside a string literal that is being compared to an attribute or to a leaf element, i.e. `@attr = 'a`, return the most frequent values of that attribute or element that start with what has been typed so far. Otherwise, return None."""
+    match = RE_VALUE_COMPARISON.search(view.substr(sublime.Region(0, location)))
+    if match is None or contexts is None or len(contexts.keys()) == 0:
+        return None
+    is_attribute, name, quote, typed = match.groups()
+    is_attribute = is_attribute is not None
+
+    global settings
+    values = collections.Counter()
+    for tree in contexts.keys():
+        tree_namespaces = namespaces[tree.getroot()]
+
+        # resolve the prefix of the name to a namespace, like lxml does when the query is executed
+        qualified_name = name
+        ns_prefix, _, localname = name.rpartition(':')
+        if ns_prefix != '':
+            if ns_prefix not in tree_namespaces:
+                continue
+            qualified_name = '{' + tree_namespaces[ns_prefix][0] + '}' + localname
+
+        # wait for the index to be built if the document is small, otherwise let it build in the background so that typing isn't blocked. The size is known from the ordinal of the root's last descendant, without walking the whole tree
+        last_ordinal = lastDescendantOrdinal(tree.getroot())
+        wait = last_ordinal is not None and last_ordinal < int(settings.get('value_completions_max_elements_to_wait_for', 100000))
+        index = value_index_for_tree(tree, wait)
+        if index is not None:
+            for value, count in index.values_for(qualified_name, is_attribute, typed):
+                values[value] += count
+
+    if not typed.endswith(prefix): # Sublime will only replace the prefix with the completion, so the completion must exclude what was typed before the prefix
+        prefix = ''
+    close_quote = quote
+    if view.substr(location) == quote: # if the string has already been closed, i.e. by auto pairing of quotes
+        close_quote = ''
+
+    return [
+        sublime.CompletionItem(
+            value,
+            annotation=('Attribute' if is_attribute else 'Text') + ' value',
+            completion=value[len(typed) - len(prefix):] + close_quote,
+            completion_format=sublime.COMPLETION_FORMAT_TEXT,
+            kind=sublime.KIND_VARIABLE,
+            details=str(count) + ' occurrence' + ('s' if count != 1 else '')
+        ) for value, count in values.most_common()]
+
+def completion_names_from_nodes(nodes):
+    """Return the names of the elements, as (tag, prefix) tuples, and the names of the attributes, in Clark notation, in the given xpath query results."""
+    element_names = collections.OrderedDict()
+    attribute_names = collections.OrderedDict()
+    for result in nodes:
+        if isinstance(result, etree._Element):
+            if isinstance(result.tag, str): # comments and processing instructions have no name to suggest
+                element_names[(result.tag, result.prefix)] = None
+        elif isinstance(result, etree._ElementUnicodeResult):
+            if result.is_attribute:
+                attribute_names[result.attrname] = None
+        else: # debug, are we missing something we could suggest?
+            pass
+    return (list(element_names.keys()), list(attribute_names.keys()))
+
+class CompletionContextCache:
+    """Remember the results of the subqueries that were executed to find the context for completions, so that they don't need to be executed again while the rest of the query is being typed."""
+    MAX_ENTRIES = 64
+
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock() # completions for multiple trees are found in parallel
+
+    def get(self, key):
+        """Return the results and whether they are all nodes for the given key, or None if they are not cached."""
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, results):
+        with self.lock:
+            self.entries[key] = (results, all(isinstance(result, (etree._Element, etree._ElementTree)) for result in results))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.MAX_ENTRIES:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+def evaluate_completion_context_query(context_cache, chain, completion_contexts, evaluate):
+    """Return the results of the last query in the chain, from the cache if possible. If a query that this one extends with more location steps is cached, only evaluate the additional steps, from it's results."""
+    entry = context_cache.get(chain)
+    if entry is not None:
+        return entry[0]
+
+    *previous, query = chain
+    start_contexts, rest = completion_contexts, query
+    for pos in reversed(range(1, len(query))): # find the longest cached query that this one extends
+        if query[pos] == '/' and query[pos - 1] != '/':
+            entry = context_cache.get(tuple(previous) + (query[0:pos].rstrip(), ))
+            if entry is not None and entry[1]: # the steps can only continue from nodes
+                start_contexts, rest = entry[0], '$expression_contexts' + query[pos:]
+                break
+
+    results = evaluate(rest, start_contexts)
+    context_cache.put(chain, results)
+    return results
+
+def completion_names_for_tree(tree, context_nodes, subqueries, exec_query, prefix, namespaces, variables, context_cache = None):
+    """Return the names of the elements and attributes to suggest for the tree, by executing the subqueries one after the other from the given context nodes, or None if the subqueries are invalid."""
+    # if the context can be determined from the names of the nodes alone, use the structure summary instead of evaluating the queries against the whole tree
+    completion_names = completion_names_from_structure_summary(tree, context_nodes, subqueries[0:-1] + [subqueries[-1] + '*'], namespaces)
+    if completion_names is not None:
+        return completion_names
+
+    if context_cache is None:
+        context_cache = CompletionContextCache()
+
+    xpath_variables = variables.copy()
+    xpath_variables['contexts'] = context_nodes
+    xpath_variables['expression_contexts'] = None
+    xpath_variables['_prefix'] = prefix
+
+    def evaluate(query, completion_contexts):
+        if query[0] not in ('$', '/', '('):
+            query = '$expression_contexts/' + query
+        xpath_variables['expression_contexts'] = completion_contexts
+        return get_results_for_xpath_query(query, tree, None, namespaces, **xpath_variables)
+        # TODO: if result is not a node, break out as we can't offer any useful suggestions (currently we just get an exception: Non-Element values not supported at this point - got 'example string') when it tries $expression_contexts/*
+
+    # split off the last location step of the final subquery, so that the nodes it is relative to can be cached for the next completion request
+    exec_suffix = exec_query[len(subqueries[-1]):]
+    match = re.match(r'^(.*[^/\s])\s*(//?[^/\[\]()"\']*)$', subqueries[-1].strip())
+    if match is None:
+        context_queries, exec_query = subqueries[0:-1], exec_query
+    else:
+        context_queries, exec_query = subqueries[0:-1] + [match.group(1)], '$expression_contexts' + match.group(2) + exec_suffix
+
+    completion_contexts = context_nodes
+    chain = (tree, tuple(context_nodes))
+    query = None
+    try:
+        for query in context_queries:
+            query = query.strip()
+            if query != '':
+                chain += (query, )
+                completion_contexts = evaluate_completion_context_query(context_cache, chain, completion_contexts, evaluate)
+        query = exec_query
+        if query != '':
+            completion_contexts = evaluate(query, completion_contexts)
+    except (ValueError, etree.XPathError) as e: # xpath query invalid, just show static contexts
+        print('XPath: exception obtaining completions for subquery "' + query + '": ' + repr(e))
+        return None
+
+    return completion_names_from_nodes(completion_contexts)
+
+def completion_items_for_names(completion_names, prefix, last_location_step, namespaces):
+    """Return completion items for the names of the elements and attributes, using the prefixes that the query expects for their namespaces."""
+    completions = []
+    element_names, attribute_names = completion_names
+    for tag, element_prefix in element_names: # add a completion with the full name of the element
+        q = etree.QName(tag)
+        ns, localname = q.namespace, q.localname
+        fullname = localname
+        if element_prefix is not None:
+            fullname = element_prefix + ':' + localname
+        if not fullname.startswith(prefix):
+            continue
+        ns_prefix = ''
+        if ns is not None: # ensure we get the prefix that we have mapped to the namespace for the query
+            ns_prefix = next((nsprefix for nsprefix in namespaces.keys() if namespaces[nsprefix] == (ns, element_prefix or '')), None) # find the first prefix in the map that relates to this uri
+            if ns_prefix:
+                fullname = ns_prefix + ':' + localname
+            else:
+                print('XPath warning: unable to find', ns, element_prefix, ' in root namespaces', namespaces, 'while generating completions')
+        if not last_location_step.endswith(':') or last_location_step.endswith('::') or last_location_step.endswith(ns_prefix + ':'): # ensure `prefix :` works correctly and also `different_prefix_to_suggestion:` (note that we don't do this for attributes - attributes are not allowed spaces before the colon, and if the prefix differs when there is no space, Sublime will replace it with the completion anyway)
+            completion = fullname
+        else:
+            completion = localname
+        completions.append(
+            sublime.CompletionItem.snippet_completion(
+                fullname,
+                fullname,
+                annotation='Element',
+                kind=sublime.KIND_MARKUP
+            )
+        )
+    for name in attribute_names: # add a completion with the name of the attribute
+        q = etree.QName(name)
+        attrname = q.localname
+        if q.namespace is not None:
+            attrname = next((nsprefix for nsprefix in namespaces.keys() if namespaces[nsprefix][0] == q.namespace)) + ':' + attrname # find the first prefix in the map that relates to this uri
+        if not (attrname.startswith(prefix) or q.localname.startswith(prefix)):
+            continue
+        completions.append(
+            sublime.CompletionItem.snippet_completion(
+                attrname,
+                attrname,
+                annotation='Attribute',
+                kind=sublime.KIND_MARKUP
+            )
+        ) # values are suggested separately, by completions_for_value_comparison
+    return completions
+
+def completions_for_trees(contexts, subqueries, exec_query, prefix, last_location_step, namespaces, variables, context_cache = None):
+    """Return the element and attribute completions from all the trees, evaluating them in parallel and merging the results of those that complete within the latency budget."""
+    def completions_for_tree(tree):
+        root = tree.getroot()
+        completion_names = completion_names_for_tree(tree, contexts[tree], subqueries, exec_query, prefix, namespaces[root], variables, context_cache)
+        if completion_names is None:
+            return []
+        return completion_items_for_names(completion_names, prefix, last_location_step, namespaces[root])
+
+    results = evaluate_completions_within_budget(completions_for_tree, list(contexts.keys()), 'trees')
+
+    completions = []
+    seen = set()
+    for result in results:
+        for completion in result:
+            key = (completion.trigger, completion.annotation)
+            if key not in seen:
+                seen.add(key)
+                completions.append(completion)
+    return completions
+
+def completions_for_remote_documents(remote_contexts, subqueries, prefix, last_location_step):
+    """Return the element and attribute completions from the documents parsed by the document server, which can only be determined from their structure summaries, waiting for them no longer than the latency budget."""
+    def completions_for_document(document, positions):
+        try:
+            completion_names = document.request('completion_names', positions, subqueries[0:-1] + [subqueries[-1] + '*'])
+        except (DocumentServerError, etree.XPathError) as e:
+            print('XPath: unable to get completions from the document server', repr(e))
+            return []
+        if completion_names is None:
+            return []
+        return completion_items_for_names(completion_names, prefix, last_location_step, document.namespaces)
+
+    results = evaluate_completions_within_budget(lambda document: completions_for_document(document, remote_contexts[document]), list(remote_contexts.keys()), 'documents in the document server')
+    return [completion for result in results for completion in result]
+
+def evaluate_completions_within_budget(function, sources, description):
+    """Evaluate the completions for each of the trees or remote documents on the completions thread pool, and return the results of those that are ready within the latency budget, in the same order. Those that aren't ready are cancelled if they haven't started yet. While one is still running, no more work is submitted for it's tree or document, so that later keystrokes aren't queued behind it."""
+    global settings
+    global running_completions
+    for source, future in list(running_completions.items()):
+        if future.done():
+            del running_completions[source]
+
+    budget = int(settings.get('completions_time_budget_ms', 250)) / 1000
+    futures = collections.OrderedDict((source, get_completions_executor().submit(function, source)) for source in sources if source not in running_completions)
+    done, not_done = concurrent.futures.wait(futures.values(), timeout=budget)
+    for source, future in futures.items():
+        if future in not_done and not future.cancel(): # it has already started, so can't be cancelled
+            running_completions[source] = future
+    if len(futures) < len(sources) or len(not_done) > 0:
+        print('XPath: completions from', len(sources) - len(done), 'of', len(sources), description, 'were not ready within', budget, 'seconds')
+    return [future.result() for future in futures.values() if future in done]
+
+def get_completions_executor():
+    """Return the thread pool that completions for multiple trees are evaluated on, creating it if necessary."""
+    global completions_executor
+    if completions_executor is None:
+        completions_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, int(settings.get('completions_threads', 4))), thread_name_prefix='xpath_completions')
+    return completions_executor
+
+def completions_for_xpath_query(view, prefix, locations, contexts, namespaces, variables, intelligent, context_cache = None, remote_contexts = None):
     def completions_axis_specifiers():
         completions = ['ancestor', 'ancestor-or-self', 'attribute', 'child', 'descendant', 'descendant-or-self', 'following', 'following-sibling', 'namespace', 'parent', 'preceding', 'preceding-sibling', 'self']
         return [
@@ -1008,6 +2286,11 @@ def completions_for_xpath_query(view, prefix, locations, contexts, namespaces, v
             kind=sublime.KIND_VARIABLE
         ) for key in sorted(variables.keys()) if key.startswith(prefix)]
 
+    if intelligent and len(locations) == 1:
+        value_completions = completions_for_value_comparison(view, prefix, locations[0], contexts, namespaces)
+        if value_completions is not None:
+            return value_completions
+
     prev_chars = []
     positions = []
     for location in locations:
@@ -1059,72 +2342,11 @@ def completions_for_xpath_query(view, prefix, locations, contexts, namespaces, v
 
                 #print('XPath: completion context queries:', subqueries[0:-1], 'completion query:', exec_query, 'prefix:', prefix)
 
-                # TODO: check all trees, not just the first one
-                tree = list(contexts.keys())[0]
-                completion_contexts = contexts[tree]
-
-                xpath_variables = variables.copy()
-                xpath_variables['contexts'] = contexts[tree]
-                xpath_variables['expression_contexts'] = None
-                xpath_variables['_prefix'] = prefix
-
-                for query in subqueries[0:-1] + [exec_query]:
-                    if query != '':
-                        if query[0] not in ('$', '/', '('):
-                            query = '$expression_contexts/' + query
-                        xpath_variables['expression_contexts'] = completion_contexts
-                        try:
-                            completion_contexts = get_results_for_xpath_query(query, tree, None, namespaces[tree.getroot()], **xpath_variables)
-                            # TODO: if result is not a node, break out as we can't offer any useful suggestions (currently we just get an exception: Non-Element values not supported at this point - got 'example string') when it tries $expression_contexts/*
-                        except (ValueError, etree.XPathError) as e: # xpath query invalid, just show static contexts
-                            completion_contexts = None
-                            print('XPath: exception obtaining completions for subquery "' + query + '": ' + repr(e))
-                            break
-
-                if completion_contexts is not None:
-                    for result in completion_contexts:
-                        if isinstance(result, etree._Element): # if it is an Element, add a completion with the full name of the element
-                            ns, localname, fullname = getTagName(result)
-                            ns_prefix = ''
-                            if ns is not None: # ensure we get the prefix that we have mapped to the namespace for the query
-                                root = result.getroottree().getroot()
-                                ns_prefix = next((nsprefix for nsprefix in namespaces[root].keys() if namespaces[root][nsprefix] == (ns, result.prefix or '')), None) # find the first prefix in the map that relates to this uri
-                                if ns_prefix:
-                                    fullname = ns_prefix + ':' + localname
-                                else:
-                                    print('XPath warning: unable to find', ns, result.prefix, ' in root namespaces', namespaces[root], 'while generating completions')
-                            if not last_location_step.endswith(':') or last_location_step.endswith('::') or last_location_step.endswith(ns_prefix + ':'): # ensure `prefix :` works correctly and also `different_prefix_to_suggestion:` (note that we don't do this for attributes - attributes are not allowed spaces before the colon, and if the prefix differs when there is no space, Sublime will replace it with the completion anyway)
-                                completion = fullname
-                            else:
-                                completion = localname
-                            completions.append(
-                                sublime.CompletionItem.snippet_completion(
-                                    fullname,
-                                    fullname,
-                                    annotation='Element',
-                                    kind=sublime.KIND_MARKUP
-                                )
-                            )
-                        elif isinstance(result, etree._ElementUnicodeResult): # if it is an attribute, add a completion with the name of the attribute
-                            if result.is_attribute:
-                                q = etree.QName(result.attrname)
-                                attrname = q.localname
-                                if q.namespace is not None:
-                                    root = result.getparent().getroottree().getroot()
-                                    attrname = next((nsprefix for nsprefix in namespaces[root].keys() if namespaces[root][nsprefix][0] == q.namespace)) + ':' + attrname # find the first prefix in the map that relates to this uri
-                                completions.append(
-                                    sublime.CompletionItem.snippet_completion(
-                                        attrname,
-                                        attrname,
-                                        annotation='Attribute',
-                                        kind=sublime.KIND_MARKUP
-                                    )
-                                ) # NOTE: can get the value with: result.getparent().get(result.attrname) - in case we ever want to do something fancy like suggest possible values when doing `@attr = *autocomplete*` etc.
-                        else: # debug, are we missing something we could suggest?
-                            #completions.append((str(result) + '\t' + str(type(result)), str(result)))
-                            pass
-
-                    completions = list(getUniqueItems(completions))
+                if len(contexts) > 0:
+                    completions += completions_for_trees(contexts, subqueries, exec_query, prefix, last_location_step, namespaces, variables, context_cache)
+                if remote_contexts:
+                    seen = set((completion.trigger, completion.annotation) for completion in completions)
+                    completions += [completion for completion in completions_for_remote_documents(remote_contexts, subqueries, prefix, last_location_step) if (completion.trigger, completion.annotation) not in seen]
 
         if include_generics:
             generics = []
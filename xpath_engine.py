@@ -0,0 +1,316 @@
+import sys
+import bisect
+import codecs
+import argparse
+from lxml import etree
+
+try:
+    from .lxml_parser import *
+    from .lxml_index import structure_summary_for_tree, completion_names_from_structure_summary
+    from .xpath_tokenizer import XPathTokenizer, parse_xpath_query_for_completions_from_tokens
+except ImportError: # when running from the command line or in the document server, the modules are imported from the folder that is on the path
+    from lxml_parser import *
+    from lxml_index import structure_summary_for_tree, completion_names_from_structure_summary
+    from xpath_tokenizer import XPathTokenizer, parse_xpath_query_for_completions_from_tokens
+
+# Everything here works on character offsets into the text that was parsed, so that it can be used without an editor, i.e. by the document server, benchmarks and the command line.
+
+def node_spans(node):
+    """Generator for the distinct (node, begin, end, is_final) spans within this element - the text between it's child elements belongs to the element itself."""
+    pos = getNodeTagRange(node, 'open')[0]
+
+    for child in node.iterchildren():
+        if isinstance(child, LocationAwareElement): # skip comments
+            child_begin = getNodeTagRange(child, 'open')[0]
+            yield (node, pos, child_begin, True)
+            pos = getNodeTagRange(child, 'close')[1]
+            yield (child, child_begin, pos, len(child) == 0)
+
+    yield (node, pos, getNodeTagRange(node, 'close')[1], True)
+
+def ranges_intersect(outer, inner, include_beginning):
+    """Return whether the (begin, end) ranges intersect, the same way the editor does. An empty inner range at the beginning of the outer range only counts if include_beginning is set, so that a cursor at <hello>text|<world />|</hello> is in 'hello/world' rather than '/hello'."""
+    outer_begin, outer_end = outer
+    inner_begin, inner_end = inner
+    intersects = (outer_begin == inner_begin and outer_end == inner_end) or (outer_begin < inner_begin < outer_end) or (outer_begin < inner_end < outer_end) or (inner_begin < outer_begin < inner_end) or (inner_begin < outer_end < inner_end)
+    return intersects or (include_beginning and inner_begin == inner_end and outer_begin <= inner_begin <= outer_end)
+
+def nodes_at_positions(roots, positions):
+    """Given a sorted list of root elements and non-overlapping (begin, end) positions, return the nodes that relate to each position, as (node, indexes of the positions, span begin, span end, whether the span is the node itself) - efficiently, without searching through unnecessary children and stopping once all are found."""
+
+    def relevance(span, start_index, max_index, include_beginning):
+        """Look through all sorted positions from the starting index to the max, to find those that match the span. If there is a gap, stop looking."""
+        found_one = False
+        for index in range(start_index, max_index + 1):
+            if ranges_intersect(span, positions[index], include_beginning):
+                yield index
+                found_one = True
+            elif found_one: # if we have found something previously, there is no need to check positions after this non-match, because they are sorted
+                break
+            elif index > start_index + 1 and not found_one: # if we haven't found anything, there is no need to check positions after start_index + 1, because they are sorted
+                break
+
+    def matchSpan(span, start_index, max_index, include_beginning):
+        """Return the indexes that match the span, as well as the first index that was found and the last index that was found."""
+        matches = list(relevance(span, start_index, max_index, include_beginning))
+        if len(matches) > 0:
+            start_index = matches[0]
+            max_index = matches[-1]
+
+        return (matches, start_index, max_index)
+
+    def getMatches(node, next_match_index, max_index, final_matches):
+        """Check the node and it's children for all matches within the specified range."""
+        found_match_at_last_expected_position_in_node = False
+        for span_node, pos_start, pos_end, is_final in node_spans(node):
+            matches, first_match_index, last_match_index = matchSpan((pos_start, pos_end), next_match_index, max_index, span_node == node)
+
+            if len(matches) > 0: # if matches were found
+                if last_match_index == max_index: # if the last index that matched is the maximum index that could match inside this node
+                    found_match_at_last_expected_position_in_node = True # it could be the last match inside this node
+                if is_final:
+                    final_matches.append((span_node, matches, pos_start, pos_end, span_node == node))
+                    next_match_index = last_match_index # the next index to search is the last index that matched
+                else:
+                    next_match_index = getMatches(span_node, first_match_index, last_match_index, final_matches) # the next index to search is the last index that matched
+            elif found_match_at_last_expected_position_in_node: # no match this time. If we have previously found the match at the last expected position within this node, then it was the last match in the node
+                break # stop looking for further matches
+
+        return next_match_index
+
+    matches = []
+    start_match_index = 0
+    for root in roots:
+        if root is not None:
+            last_match_index = len(positions) - 1
+
+            root_span = (getNodeTagRange(root, 'open')[0], getNodeTagRange(root, 'close')[1])
+            root_matches, start_match_index, last_match_index = matchSpan(root_span, start_match_index, last_match_index, True)
+            if len(root_matches) > 0: # skip the tree if it doesn't participate in the match (saves iterating through all children of root element unnecessarily)
+                start_match_index = getMatches(root, start_match_index, last_match_index, matches)
+
+    return matches
+
+def element_xml_preview(node, maxlen, substr):
+    """Generate the xml string for the given element, up to the specified number of characters, reading the text with substr(begin, end)."""
+    begin = getNodeTagRange(node, 'open')[0]
+    end = getNodeTagRange(node, 'close')[1]
+    if maxlen >= 0: # only read as much of the element as could be shown, as it could span most of the document
+        end = min(end, begin + maxlen + 1)
+    return collapseWhitespace(substr(begin, end), maxlen)
+
+def chunks(start, end, chunk_size): # inspired by http://stackoverflow.com/a/18854817/4473405
+    """Return a generator that will split the range into chunks of the specified size."""
+    return ((i, min(i + chunk_size, end)) for i in range(start, end, chunk_size))
+
+def subqueries_for_completions(query):
+    """Return the relevant sub queries of the given query, when completions are desired at the end of it."""
+    return parse_xpath_query_for_completions_from_tokens(query, XPathTokenizer().tokenize(query))
+
+XML_DECLARATION_ENCODING = re.compile(br'<\?xml[^>]*?\sencoding\s*=\s*["\']([A-Za-z][A-Za-z0-9._-]*)["\']')
+
+def xml_file_encoding(data):
+    """Return the encoding of the XML file with the given contents, from it's byte order mark or XML declaration, or UTF-8 if it has neither."""
+    for bom, encoding in ((codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'), (codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16')):
+        if data.startswith(bom):
+            return encoding
+    match = XML_DECLARATION_ENCODING.match(data)
+    return match.group(1).decode('ascii') if match is not None else 'utf-8'
+
+class XMLDocument:
+    """An XML document parsed from text, that can be queried, and whose nodes can be found and described by their character offsets in the text."""
+    def __init__(self, offset = 0, default_namespace_prefix = 'default'):
+        self.offset = offset # the position of the start of the text, i.e. when it is one region of a larger view
+        self.default_namespace_prefix = default_namespace_prefix
+        self.builder = LocationAwareTreeBuilder(position_offset=offset, collect_ids=False, huge_tree=True, remove_blank_text=False, encoding='utf-8') # the text is already decoded, and lxml passes it on as UTF-8, whatever encoding it's XML declaration gives
+        self.chunks = []
+        self.parse_error = None # the first error raised while feeding the text, which is raised when it is closed
+        self.text = None
+        self.tree = None
+        self.all_elements = None
+        self.namespaces = None
+        self.elements = None # only the elements, in document order, and the positions their open tags begin at
+        self.element_starts = None
+        self.line_starts = None
+
+    @classmethod
+    def from_text(cls, text, offset = 0, default_namespace_prefix = 'default'):
+        """Parse the text, raising an etree.XMLSyntaxError if it isn't well formed."""
+        document = cls(offset, default_namespace_prefix)
+        document.feed(text)
+        document.close()
+        return document
+
+    @classmethod
+    def from_file(cls, path, default_namespace_prefix = 'default', newline = None):
+        """Parse the file, decoding it like an XML parser would, raising a UnicodeDecodeError or LookupError if it can't be. By default, line endings are normalized, like they are in the editor, so that the offsets match. Use newline='' for offsets of the characters in the file."""
+        with open(path, 'rb') as f:
+            data = f.read()
+        text = data.decode(xml_file_encoding(data))
+        if newline is None:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        return cls.from_text(text, 0, default_namespace_prefix)
+
+    def feed(self, chunk):
+        self.chunks.append(chunk)
+        if self.parse_error is None:
+            try:
+                self.builder.feed(chunk)
+            except etree.XMLSyntaxError as e:
+                self.parse_error = e
+
+    def close(self):
+        self.text = ''.join(self.chunks)
+        self.chunks = None
+        builder = self.builder
+        self.builder = None
+        if self.parse_error is not None:
+            raise self.parse_error
+        root, all_namespaces, self.all_elements = builder.close()
+        root.all_namespaces = all_namespaces
+        self.tree = etree.ElementTree(root)
+        self.namespaces = unique_namespace_prefixes(all_namespaces, self.default_namespace_prefix)
+        root.unique_namespaces = self.namespaces
+        self.elements = [node for node in self.all_elements if isinstance(node, LocationAwareElement)]
+        self.element_starts = [getNodeTagRange(node, 'open')[0] for node in self.elements]
+
+    def substr(self, begin, end):
+        return self.text[begin - self.offset:end - self.offset]
+
+    def line_and_column(self, position):
+        """Return the 1-based line and column of the given position."""
+        if self.line_starts is None:
+            self.line_starts = [0] + [match.end() for match in re.finditer('\n', self.text)]
+        line = bisect.bisect_right(self.line_starts, position - self.offset)
+        return (line, position - self.offset - self.line_starts[line - 1] + 1)
+
+    def node_at(self, position):
+        """Return the innermost element that contains the given position, or None."""
+        index = bisect.bisect_right(self.element_starts, position) - 1
+        if index < 0:
+            return None
+        node = self.elements[index]
+        while node is not None and getNodeTagRange(node, 'close')[1] < position:
+            node = node.getparent()
+        return node
+
+    def nodes_at(self, positions):
+        nodes = []
+        for position in positions:
+            node = self.node_at(position)
+            if node is not None and node not in nodes:
+                nodes.append(node)
+        return nodes
+
+    def query(self, query, positions = None, variables = {}):
+        """Execute the query from the elements at the given positions, or the document node if there are none, with the elements available as the $contexts variable."""
+        context_nodes = self.nodes_at(positions or [])
+        context = None
+        if len(context_nodes) > 0:
+            context = context_nodes[0]
+        variables = dict(variables)
+        variables['contexts'] = context_nodes
+        return get_results_for_xpath_query(query, self.tree, context, self.namespaces, **variables)
+
+    def ranges(self, nodes, element_position_type = 'open', attribute_position_type = 'value'):
+        """Return the (begin, end) positions of the given nodes."""
+        return list(getRangesOfNodes(nodes, element_position_type, attribute_position_type, self.substr))
+
+    def paths(self, nodes, **options):
+        """Return the xpaths of the given nodes, with the options accepted by getNodePaths."""
+        return getNodePaths(nodes, lambda tree: self.namespaces, **options)
+
+    def exact_path(self, node):
+        """Return the xpath that matches only the given element, attribute, text node, comment or processing instruction."""
+        if getattr(node, 'is_attribute', False):
+            name = etree.QName(node.attrname)
+            step = '@' + name.localname
+            if name.namespace == XML_NAMESPACE: # the xml prefix is bound implicitly
+                step = '@xml:' + name.localname
+            elif name.namespace is not None:
+                prefix = next((prefix for prefix in self.namespaces.keys() if self.namespaces[prefix][0] == name.namespace), None)
+                if prefix is None:
+                    step = "@*[local-name() = '" + name.localname + "' and namespace-uri() = '" + name.namespace + "']"
+                else:
+                    step = '@' + prefix + ':' + name.localname
+            return self.paths([node.getparent()], include_attributes=False)[0] + '/' + step
+        elif getattr(node, 'is_text', False) or getattr(node, 'is_tail', False): # the parent of tail text is the element it follows
+            index = 1
+            parent = node.getparent()
+            if node.is_tail: # count the text nodes before it, which are the text of it's parent and the tails of the preceding siblings
+                sibling = parent
+                parent = sibling.getparent()
+                index += (1 if parent.text else 0) + sum(1 for preceding in sibling.itersiblings(preceding=True) if preceding.tail)
+            return self.paths([parent], include_attributes=False)[0] + '/text()[' + str(index) + ']'
+        elif isinstance(node, (etree.CommentBase, etree.PIBase)):
+            node_type = etree.CommentBase if isinstance(node, etree.CommentBase) else etree.PIBase
+            index = 1 + sum(1 for preceding in node.itersiblings(preceding=True) if isinstance(preceding, node_type))
+            parent = node.getparent()
+            parent_path = '' if parent is None else self.paths([parent], include_attributes=False)[0] # outside the root element
+            return parent_path + '/' + ('comment()' if node_type is etree.CommentBase else 'processing-instruction()') + '[' + str(index) + ']'
+        return self.paths([node], include_attributes=False)[0]
+
+    def completion_names(self, positions, queries):
+        """Return the names of the elements and attributes the queries could return from the elements at the given positions, if they can be determined from the structure summary, otherwise None."""
+        return completion_names_from_structure_summary(self.tree, self.nodes_at(positions) or [self.tree], queries, self.namespaces)
+
+    def preview(self, result, maxlen, normalize_whitespace = True):
+        """Return the preview of a result, with three lines for elements and one line for other results."""
+        if isinstance(result, etree.ElementBase) and not isinstance(result, etree.CommentBase):
+            return [getTagName(result)[2], collapseWhitespace(result.text, maxlen), element_xml_preview(result, maxlen, self.substr)]
+        elif normalize_whitespace:
+            return collapseWhitespace(str(result), maxlen)
+        return str(result)[0:maxlen]
+
+def main(args = None):
+    """Print the exact xpaths and positions of the results of a query, or of the nodes at the given offsets, in each file."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('files', nargs='+', metavar='FILE')
+    parser.add_argument('-q', '--query', help='the XPath query to execute from the document node of each file')
+    parser.add_argument('-o', '--offset', type=int, action='append', default=[], help='a character offset to print the xpath of the element at, can be given more than once')
+    parser.add_argument('--default-namespace-prefix', default='default', help='the prefix used for namespaces without one')
+    parser.add_argument('--variable', action='append', default=[], metavar='NAME=VALUE', help='a string variable available to the query, can be given more than once')
+    args = parser.parse_args(args)
+    if args.query is None and len(args.offset) == 0:
+        parser.error('either a query or an offset is required')
+    variables = dict(variable.split('=', 1) for variable in args.variable)
+
+    register_xpath_extensions(lambda nodes: getNodePaths(nodes, lambda tree: tree.getroot().unique_namespaces))
+    failed = False
+    for path in args.files:
+        try:
+            document = XMLDocument.from_file(path, args.default_namespace_prefix, newline='') # offsets of the characters in the file, rather than in the editor
+        except (OSError, etree.XMLSyntaxError, UnicodeDecodeError, LookupError) as e: # i.e. the file is in an encoding other than the one it declares
+            print(path + ': ' + str(e), file=sys.stderr)
+            failed = True
+            continue
+
+        for offset in args.offset:
+            nodes = document.nodes_at([offset])
+            print(path + ':' + str(offset) + ': ' + (document.paths(nodes)[0] if len(nodes) > 0 else '(no element)'))
+        if args.query is not None:
+            try:
+                results = document.query(args.query, None, variables)
+            except etree.XPathError as e:
+                print(args.query + ': ' + str(e), file=sys.stderr)
+                return 2
+            for result in results:
+                if documentOrderKey(result) is None: # not a node in the document, i.e. a number
+                    print(path + ': ' + str(result))
+                    continue
+                try:
+                    begin, end = next(iter(document.ranges([result], 'entire', 'entire')), (None, None))
+                    if begin is None:
+                        print(path + ': ' + collapseWhitespace(str(result), 70))
+                        continue
+                    line, column = document.line_and_column(begin)
+                    xpath = document.exact_path(result)
+                except Exception as e: # so that the other results are still printed
+                    print(path + ': unable to describe the result ' + repr(collapseWhitespace(str(result), 70)) + ': ' + repr(e), file=sys.stderr)
+                    failed = True
+                    continue
+                print('{0}:{1}:{2}: {3}-{4}: {5}'.format(path, line, column, begin, end, xpath))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,190 @@
+import re
+import collections
+
+Token = collections.namedtuple('Token', ['start', 'end', 'kind', 'expects_operand'])
+
+QNAME = r'(?![\d.\-])[\w.\-]+'
+PREFIX = r'(?:' + QNAME + r'\s*:(?!:))?'
+AXES = r'(?:ancestor(?:-or-self)?|attribute|child|descendant(?:-or-self)?|following(?:-sibling)?|namespace|parent|preceding(?:-sibling)?|self)'
+
+# each rule is a regex, the kind of token it produces and whether an operand is expected after it (None means the expectation is unchanged)
+# the kinds are those needed to split the query for completions: `open` and `close` brackets, argument `separator`s, `operator`s and everything else is a `value`
+RULES_ANYWHERE = [
+    (re.compile(r'\s+'), 'value', None),
+    (re.compile(r'\(:(?:[^:]|:(?!\)))*(?::\)|$)'), 'value', None), # comment
+    (re.compile(r'"[^"]*"?|\'[^\']*\'?'), 'value', False), # string literal, possibly not yet terminated
+]
+RULES_OPERAND = [
+    (re.compile(r'-*\('), 'open', True), # subexpression
+    (re.compile(r'-*(?:\d+\.\d*|\.?\d+)'), 'value', False), # number
+    (re.compile(r'\$(?:' + QNAME + r')?'), 'value', False), # variable reference
+    (re.compile(AXES + r'\s*::\s*'), 'value', True), # axis name
+    (re.compile(r'(?:comment|text|processing-instruction|node)\s*\(\s*\)'), 'value', False), # node type
+    (re.compile(PREFIX + QNAME + r'\s*\('), 'open', True), # function call
+    (re.compile(r'@\s*(?:' + PREFIX + r'(?:' + QNAME + r'|\*))'), 'value', False), # attribute
+    (re.compile(r'@'), 'value', True),
+    (re.compile(PREFIX + r'(?:' + QNAME + r'|\*)'), 'value', False), # name test
+    (re.compile(r'\.\.?'), 'value', False), # abbreviated axis step
+]
+RULES_OPERATOR = [
+    (re.compile(r'(?:and|or|mod|div)(?![\w.\-])'), 'operator', True), # operator names are only operators when an operand is not expected
+    (re.compile(r'\*|\+|-|!?=|<=?|>=?'), 'operator', True),
+]
+RULES_PUNCTUATION = [
+    (re.compile(r'\|'), 'operator', True),
+    (re.compile(r'//?'), 'value', True), # location step
+    (re.compile(r'[\[(]'), 'open', True),
+    (re.compile(r'[\])]'), 'close', False),
+    (re.compile(r','), 'separator', True),
+    (re.compile(r'::'), 'value', True),
+    (re.compile(r'[^)\]\s]'), 'value', False), # unexpected character
+]
+
+def next_token(text, pos, expects_operand):
+    """Return the token at the given position in the XPath expression."""
+    rules = RULES_ANYWHERE + (RULES_OPERAND if expects_operand else RULES_OPERATOR) + RULES_PUNCTUATION
+    for regex, kind, then_expects_operand in rules:
+        match = regex.match(text, pos)
+        if match is not None and match.end() > pos:
+            if then_expects_operand is None:
+                then_expects_operand = expects_operand
+            return Token(pos, match.end(), kind, then_expects_operand)
+
+class XPathTokenizer:
+    """Split an XPath 1.0 expression into tokens, remembering the tokens from the previous expression, so that only the part after an edit needs to be tokenized again."""
+    LOOKBEHIND_TOKENS = 2 # some tokens depend on what follows them, i.e. a function name followed by an open parenthesis, so these are tokenized again too
+
+    def __init__(self):
+        self.text = ''
+        self.tokens = []
+
+    def tokenize(self, text):
+        """Return the tokens for the given text."""
+        common_length = 0
+        max_common_length = min(len(text), len(self.text))
+        while common_length < max_common_length and text[common_length] == self.text[common_length]:
+            common_length += 1
+
+        keep = 0
+        while keep < len(self.tokens) and self.tokens[keep].end < common_length:
+            keep += 1
+        significant_tokens = 0
+        while keep > 0 and significant_tokens < self.LOOKBEHIND_TOKENS:
+            keep -= 1
+            if self.tokens[keep].kind != 'value' or self.text[self.tokens[keep].start:self.tokens[keep].end].strip() != '':
+                significant_tokens += 1
+
+        tokens = self.tokens[0:keep]
+        pos = 0
+        expects_operand = True
+        if len(tokens) > 0:
+            pos = tokens[-1].end
+            expects_operand = tokens[-1].expects_operand
+
+        while pos < len(text):
+            token = next_token(text, pos, expects_operand)
+            tokens.append(token)
+            pos = token.end
+            expects_operand = token.expects_operand
+
+        self.text = text
+        self.tokens = tokens
+        return tokens
+
+def parse_xpath_query_for_completions_from_tokens(text, tokens):
+    """Given an XPath query and it's tokens, return the relevant sub queries that should be executed one after the other to find the context for completions at the end of the query."""
+    query_parts = [(token.kind, text[token.start:token.end]) for token in tokens]
+
+    # parse the xpath expression into a tree
+    tree = {
+        'open': '',
+        'close': '',
+        'children': [{ 'value': '' }],
+        'parent': None
+    }
+    node = tree
+    for kind, part in query_parts:
+        if kind == 'open': # an opening bracket increments the depth
+            child = {}
+            child['open'] = part
+            child['parent'] = node
+            child['children'] = [{ 'value': '' }]
+            node['children'].append(child)
+            node = child
+        elif kind == 'close': # a closing bracket decrements the depth, and moves everything in the depth above to the new depth
+            if node['parent'] is None: # ignore stray closing brackets
+                continue
+            node['close'] = part
+            node = node['parent']
+            node['children'].append({ 'value': '' })
+        elif kind == 'separator':
+            node['children'].append({ 'separator': part })
+        elif kind == 'operator':
+            node['children'].append({ 'operator': part })
+        else:
+            if 'value' not in node['children'][-1]:
+                node['children'].append({ 'value': '' })
+            node['children'][-1]['value'] += part
+
+    # flatten the tree where possible
+    def flatten(node, everything):
+        children = [{ 'value': '' }]
+        for child in node['children']:
+            if 'value' not in children[-1]:
+                children.append({ 'value': '' })
+            if 'open' in child:
+                if 'close' in child:
+                    children[-1]['value'] += child['open']
+                    children[-1]['value'] += flatten(child, True)[0]['value']
+                    children[-1]['value'] += child['close']
+                else:
+                    newchild = child.copy()
+                    newchild['children'] = flatten(newchild, False)
+                    del newchild['parent']
+                    children.append(newchild)
+            else:
+                include = everything or 'value' in child
+                if include:
+                    if 'value' not in children[-1]:
+                        children.append({ 'value': '' })
+                    children[-1]['value'] += child[list(child.keys())[0]]
+                else:
+                    children.append(child)
+        return children
+
+    flattened = { 'children': flatten(tree, False) }
+
+    # split the rest of the tree into subqueries that should be executed on the results of the previous one
+    subqueries = {0: ''}
+
+    def split(node, level):
+        children = node['children']
+        relevant = []
+        for child in reversed(children):
+            if 'operator' in child or 'separator' in child: # take the children from the end, until we reach an operator or a separator
+                break
+            else:
+                relevant.append(child)
+        for child in reversed(relevant):
+            if 'open' in child:
+                if 'close' not in child:
+                    level += 1
+                    subqueries.setdefault(level, '')
+                else:
+                    subqueries[level] += child['open']
+
+                split(child, level)
+                if 'close' in child:
+                    subqueries[level] += child['close']
+            else:
+                subqueries[level] += child[list(child.keys())[0]]
+
+    split(flattened, 0)
+
+    queries = []
+    levels = sorted(subqueries.keys())
+    for key in levels:
+        subquery = subqueries[key].strip()
+        if subquery != '' or key == levels[-1]:
+            queries.append(subquery)
+    return queries